@@ -22,17 +22,12 @@ import logging
 import csv
 import time
 import re
+import shutil
+import argparse
 
-NOW = time.time()
-
-if not os.path.exists("logs"):
-    os.mkdir("logs")
+import acs_instrument
 
-logging.basicConfig(
-    filename=os.path.join("logs",__file__+time.strftime('.%Y%m%d_%H%M%S.log', time.localtime(NOW))),
-    format='(asctime)|(levelno)|(levelname)|(filename)|(lineno)|(message)',
-    level=logging.DEBUG
-    )
+NOW = time.time()
 
 
 def parse_ACS_filename(filename):
@@ -105,7 +100,253 @@ def burst_name(longname):
     return retval
 
 
-def assemble_metadata(topdir='acs', output_filename='all_metadata.csv'):
+# Columns with more distinct values than this only get a distinct
+# count in the stats file, not a per-value frequency table.
+STATS_MAX_VALUES = 1000
+
+
+def stats_filename_for(metadata_filename):
+    """Name of the column statistics file that goes with a metadata file.
+
+    >>> stats_filename_for('all_metadata.csv')
+    'all_metadata_stats.csv'
+    """
+    return os.path.splitext(metadata_filename)[0] + '_stats.csv'
+
+
+class ColumnStatsCollector(object):
+    """Accumulate per-column row counts, distinct counts and (for low
+    cardinality columns) value frequencies while the metadata is written,
+    so colsearch can estimate rule selectivity without a second pass.
+    """
+    def __init__(self, header, max_values=STATS_MAX_VALUES):
+        self.header = header
+        self.max_values = max_values
+        self.rows = 0
+        self.values = {h: {} for h in header}
+        self.hashes = {}
+
+    def add(self, row):
+        self.rows += 1
+        for h, v in zip(self.header, row):
+            v = str(v)
+            if h in self.hashes:
+                self.hashes[h].add(hash(v))
+                continue
+            counts = self.values[h]
+            counts[v] = counts.get(v, 0) + 1
+            if len(counts) > self.max_values:
+                # too many values to be useful: keep a distinct count only.
+                self.hashes[h] = set(hash(k) for k in counts)
+                del self.values[h]
+
+    def write(self, stats_filename):
+        with open(stats_filename, 'w', encoding='utf-8', newline='') as fp:
+            writer = csv.writer(fp)
+            writer.writerow(['COLNAME', 'STAT', 'VALUE', 'COUNT'])
+            writer.writerow(['', 'rows', '', self.rows])
+            for h in self.header:
+                if h in self.hashes:
+                    writer.writerow([h, 'distinct', '', len(self.hashes[h])])
+                else:
+                    writer.writerow([h, 'distinct', '', len(self.values[h])])
+                    for v in sorted(self.values[h]):
+                        writer.writerow([h, 'value', v, self.values[h][v]])
+
+
+def partition_dir_for(metadata_filename):
+    """Directory holding the partitioned copy of a metadata file.
+
+    >>> partition_dir_for('all_metadata.csv')
+    'all_metadata'
+    """
+    return os.path.splitext(metadata_filename)[0]
+
+
+CATALOG_FILENAME = 'catalog.csv'
+CATALOG_HEADER = ['ACS_YEAR', 'GEOTYPE', 'TABLE', 'PATH', 'ROWS']
+
+
+def geotype_of(filename):
+    """The geography type (places or non_places) of a file in the tree
+    made by burst, from its path; '' if the path doesn't say.
+
+    >>> geotype_of('acs/non_places/2014/ACS_14_1YR_S0102_with_ann.csv')
+    'non_places'
+    >>> geotype_of('ACS_14_1YR_S0102_with_ann.csv')
+    ''
+    """
+    parts = os.path.normpath(filename).split(os.sep)
+    for t in ['places', 'non_places']:
+        if t in parts:
+            return t
+    return ''
+
+
+def walk_order_key(filename):
+    """Sort key putting FILENAMEs in the order find_metadata_files
+    walks them, which is the order of the rows in all_metadata.csv:
+    a directory's own files first, then its subdirectories.
+
+    >>> sorted(['acs/places/b.csv', 'acs/z.csv', 'acs/non_places/a.csv'], key=walk_order_key)
+    ['acs/z.csv', 'acs/non_places/a.csv', 'acs/places/b.csv']
+    """
+    dirpath, fn = os.path.split(os.path.normpath(filename))
+    return (dirpath.split(os.sep), fn)
+
+
+def partitions_current(metadata_filename, partition_dir=None):
+    """Whether the partitioned copy exists and is at least as new as
+    the flat file. write_metadata writes the catalog last, so a flat
+    file newer than it was rewritten on its own (by assemble_metadata.py,
+    say), and the partitions are stale."""
+    if partition_dir is None:
+        partition_dir = partition_dir_for(metadata_filename)
+    catalog_filename = os.path.join(partition_dir, CATALOG_FILENAME)
+    if not os.path.exists(catalog_filename):
+        return False
+    if not os.path.exists(metadata_filename):
+        return True
+    return os.stat(catalog_filename).st_mtime_ns >= os.stat(metadata_filename).st_mtime_ns
+
+
+class PartitionWriter(object):
+    """Write metadata rows into a partitioned layout,
+        <partition_dir>/<ACS_YEAR>/<GEOTYPE>/<TABLE>.csv
+    each file having the same header as all_metadata.csv, plus a
+    catalog.csv listing every partition and its row count so readers
+    can pick partitions without opening them.
+    """
+    def __init__(self, partition_dir, header):
+        if os.path.exists(os.path.join(partition_dir, CATALOG_FILENAME)):
+            # a previous build of ours; start over.
+            shutil.rmtree(partition_dir)
+        os.makedirs(partition_dir, mode=0o755, exist_ok=True)
+        self.partition_dir = partition_dir
+        self.header = header
+        self.catalog = {}
+
+    def write(self, year, geotype, table, rows):
+        key = (str(year), geotype, table)
+        relpath = os.path.join(str(year), geotype or '_', table+'.csv')
+        path = os.path.join(self.partition_dir, relpath)
+        if key not in self.catalog:
+            os.makedirs(os.path.dirname(path), mode=0o755, exist_ok=True)
+            self.catalog[key] = [relpath, 0]
+            with open(path, 'w', encoding='utf-8', newline='') as fp:
+                csv.writer(fp).writerow(self.header)
+        with open(path, 'a', encoding='utf-8', newline='') as fp:
+            csv.writer(fp).writerows(rows)
+        self.catalog[key][1] += len(rows)
+
+    def close(self):
+        with open(os.path.join(self.partition_dir, CATALOG_FILENAME), 'w', encoding='utf-8', newline='') as fp:
+            writer = csv.writer(fp)
+            writer.writerow(CATALOG_HEADER)
+            for key in sorted(self.catalog):
+                writer.writerow(list(key) + self.catalog[key])
+
+
+GEO_INDEX_FILENAME = 'geo_index.csv'
+GEO_INDEX_HEADER = ['GEO.id', 'GEO.id2', 'FILENAME', 'OFFSET', 'ROW']
+
+
+def build_geo_index(topdir='acs', index_filename=GEO_INDEX_FILENAME):
+    """Index every _with_ann.csv data file under topdir by geography:
+    one row per (geography, file) with the byte offset and data row
+    number of that geography's line, so a geography's values can be
+    fetched with a seek instead of a scan (see acs_aff_geoindex.py).
+    """
+    with open(index_filename, 'w', encoding='utf-8', newline='') as out_fp:
+        writer = csv.writer(out_fp)
+        writer.writerow(GEO_INDEX_HEADER)
+        for (dirpath, dirnames, filenames) in os.walk(topdir):
+            dirnames.sort()
+            filenames.sort()
+            for fn in filenames:
+                if parse_ACS_filename(fn).get('kind', '') != '_with_ann.csv':
+                    continue
+                path = os.path.join(dirpath, fn)
+                with acs_instrument.stage('geo_index'), open(path, 'rb') as in_fp:
+                    offset = 0
+                    for lineno, line in enumerate(in_fp):
+                        if lineno >= 2 and line.strip() != b'':
+                            # GEO.id and GEO.id2 lead the line and are short,
+                            # so there's no need to parse the whole row.
+                            geo = next(csv.reader([line[:256].decode('utf-8', 'replace')]))
+                            writer.writerow([geo[0], geo[1], path, offset, lineno-2])
+                        offset += len(line)
+                acs_instrument.count('data_files')
+                acs_instrument.count('data_bytes', offset)
+
+
+NAME_DETAILS = ["EST_OR_MARGIN", "NAME", "ROLLUP1", "ROLLUP2"]
+METADATA_HEADER = ['FILENAME', 'ACS_YEAR', 'ACS_SPAN', 'TABLE', 'SHORTCOLNAME', 'LONGCOLNAME'] + NAME_DETAILS
+
+
+def find_metadata_files(topdir='acs'):
+    """Yield (dirpath, filename, parse_ACS_filename details) for every
+    _metadata.csv file under topdir, in sorted order."""
+    for (dirpath, dirnames, filenames) in os.walk(topdir):
+        dirnames.sort()
+        filenames.sort()
+        for fn in filenames:
+            acs = parse_ACS_filename(fn)
+            if acs.get('kind', '') == '_metadata.csv':
+                yield (dirpath, fn, acs)
+
+
+def metadata_rows(dirpath, fn, acs):
+    """The all_metadata.csv rows (lists, in METADATA_HEADER order) for one
+    _metadata.csv file."""
+    with_ann_fn = re.sub('_metadata', '_with_ann', fn)
+    output_rows = []
+    with acs_instrument.stage('metadata_files'), open(os.path.join(dirpath, fn), 'r', encoding='utf-8') as in_fp:
+        reader = csv.reader(in_fp)
+        for row in reader:
+            details = burst_name(row[1])
+            output_row = [
+                os.path.join(dirpath,with_ann_fn), 
+                acs['year'], 
+                acs['span'], 
+                acs['table']]
+            output_row += row
+            output_row += [details.get(h, '') for h in NAME_DETAILS]
+            output_rows.append(output_row)
+    acs_instrument.count('metadata_files')
+    acs_instrument.count('metadata_bytes', os.path.getsize(os.path.join(dirpath, fn)))
+    acs_instrument.count('rows', len(output_rows))
+    return output_rows
+
+
+def write_metadata(groups, output_filename='all_metadata.csv', stats_filename=None, partition_dir=None):
+    """Write all_metadata.csv, its column statistics and its partitioned
+    copy from groups, an iterable of (year, geotype, table, rows) with
+    rows as from metadata_rows."""
+    if stats_filename is None:
+        stats_filename = stats_filename_for(output_filename)
+    if partition_dir is None:
+        partition_dir = partition_dir_for(output_filename)
+    with open(output_filename, 'w', encoding='utf-8', newline='') as out_fp:
+        writer = csv.writer(out_fp)
+        writer.writerow(METADATA_HEADER)
+        stats = ColumnStatsCollector(METADATA_HEADER)
+        partitions = PartitionWriter(partition_dir, METADATA_HEADER)
+        for year, geotype, table, rows in groups:
+            writer.writerows(rows)
+            for row in rows:
+                stats.add(row)
+            with acs_instrument.stage('partitions'):
+                partitions.write(year, geotype, table, rows)
+    # The catalog goes last, once the flat file is closed, so it's never
+    # older than the flat file it matches (see partitions_current).
+    with acs_instrument.stage('partitions'):
+        partitions.close()
+    with acs_instrument.stage('stats'):
+        stats.write(stats_filename)
+
+
+def assemble_metadata(topdir='acs', output_filename='all_metadata.csv', stats_filename=None, partition_dir=None):
     """Assemble all of the metadata from the _metadata files under the
     top level directory. Assumption is that you have a big tree of 
     American Fact Finder data named like "ACS_10_5YR_S1901_with_ann.csv"
@@ -113,33 +354,26 @@ def assemble_metadata(topdir='acs', output_filename='all_metadata.csv'):
     
     The goal is to assemble a complete set of metadata across all files
     that can be searched for common names.
+
+    Column statistics for the colsearch rule planner are written next
+    to the output (see stats_filename_for) unless stats_filename is given.
+    The same rows are also written partitioned by year, geography type
+    and table (see PartitionWriter) under partition_dir, which defaults
+    to partition_dir_for(output_filename).
     """
-    with open(output_filename, 'w', encoding='utf-8', newline='') as out_fp:
-        writer = csv.writer(out_fp)
-        name_details = ["EST_OR_MARGIN", "NAME", "ROLLUP1", "ROLLUP2"]
-        header = ['FILENAME', 'ACS_YEAR', 'ACS_SPAN', 'TABLE', 'SHORTCOLNAME', 'LONGCOLNAME']
-        writer.writerow(header + name_details)
-        for (dirpath, dirnames, filenames) in os.walk(topdir):
-            dirnames.sort()
-            filenames.sort()
-            for fn in filenames:
-                acs = parse_ACS_filename(fn)
-                if acs.get('kind', '') == '_metadata.csv':
-                    with_ann_fn = re.sub('_metadata', '_with_ann', fn)
-                    with open(os.path.join(dirpath, fn), 'r', encoding='utf-8') as in_fp:
-                        reader = csv.reader(in_fp)
-                        for row in reader:
-                            details = burst_name(row[1])
-                            output_row = [
-                                os.path.join(dirpath,with_ann_fn), 
-                                acs['year'], 
-                                acs['span'], 
-                                acs['table']]
-                            output_row += row
-                            output_row += [details.get(h, '') for h in name_details]
-                            writer.writerow(output_row)
+    groups = ((acs['year'], geotype_of(dirpath), acs['table'], metadata_rows(dirpath, fn, acs)) for (dirpath, fn, acs) in find_metadata_files(topdir))
+    write_metadata(groups, output_filename, stats_filename, partition_dir)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Assemble metadata from a tree of American Fact Finder downloads.')
+    acs_instrument.add_arguments(parser)
+    return parser.parse_args(args)
 
 
 if __name__ == '__main__':
+    acs_instrument.setup_logging(__file__)
+    acs_instrument.start(__file__, parse_args())
     assemble_metadata()
+    build_geo_index()
     
@@ -0,0 +1,271 @@
+# Benchmarks for the American Fact Finder tools.
+#
+# Copyright 2016 R. A. Reitmeyer
+#
+# Run as
+#     python3 acs_aff_benchmark.py scan -n 500000 -j 8
+# to time acs_aff_colsearch.pattern_scan on synthetic metadata with
+# 1 through 8 processes, or
+#     python3 acs_aff_benchmark.py stages synth -t 80 -g 500 -o bench.json
+# to time each stage of the pipeline (burst, assemble_metadata,
+# pattern_scan, table_shell_extract) on a synthetic corpus made by
+# acs_aff_synth.py, which is generated in synth/ first if not there.
+# Stages report best wall time, CPU time and peak Python memory (from a
+# separate tracemalloc run, so tracing doesn't slow the timed runs).
+# Results are written as CSV to stdout and, with -o, as JSON along with
+# the git commit, so runs can be compared between commits.
+
+# Requires Python3.
+
+# Copyright R. A. Reitmeyer
+# Released under the GNU Public License, version 2, or later.
+
+import os
+import sys
+import re
+import csv
+import time
+import json
+import random
+import shutil
+import platform
+import resource
+import argparse
+import subprocess
+import tracemalloc
+
+import acs_aff_colsearch
+import acs_aff_assemble_metadata
+import acs_aff_burst
+import acs_aff_synth
+import table_shell_extract
+
+
+SCAN_RULES = [
+    {'colname': 'LONGCOLNAME', 'pattern': acs_aff_colsearch.expand_all_patterns(acs_aff_colsearch.flip_quotes('income.*({year} inflation-adjusted dollars)')), 'flags': re.IGNORECASE},
+    {'colname': 'NAME', 'pattern': '(households|families).*(median|mean)', 'flags': re.IGNORECASE},
+    {'colname': 'EST_OR_MARGIN', 'pattern': '^ESTIMATE$'},
+    ]
+
+
+def synthetic_metadata(rows, seed=0):
+    """Make a list of metadata records shaped like all_metadata.csv rows,
+    with enough variety in the long names to exercise the regexes.
+    """
+    rnd = random.Random(seed)
+    subjects = ['INCOME AND BENEFITS', 'EMPLOYMENT STATUS', 'HOUSEHOLDS BY TYPE', 'SEX AND AGE', 'OCCUPATION']
+    universes = ['Total population', 'Households', 'Families', 'Population 16 years and over', 'Civilian employed population 16 years and over']
+    details = ['Median household income ({year} inflation-adjusted dollars)',
+               'Mean family income ({year} inflation-adjusted dollars)',
+               'In labor force - Civilian labor force',
+               'Under 5 years', 'Female', 'With earnings']
+    rollups = ['Total', 'Male', 'Female', 'Foreign born', 'Native']
+    md = []
+    for i in range(rows):
+        year = str(2005 + rnd.randrange(10))
+        est = rnd.choice(['Estimate', 'Margin of Error'])
+        name = ' - '.join([rnd.choice(universes), rnd.choice(subjects), rnd.choice(details).format(year=year)])
+        rollup1 = rnd.choice(rollups)
+        table = 'S{0:04d}'.format(rnd.randrange(100, 2800))
+        md.append({
+            'FILENAME': 'acs/places/{0}/ACS_{1}_1YR_{2}_with_ann.csv'.format(year, year[2:], table),
+            'ACS_YEAR': year,
+            'ACS_SPAN': '1',
+            'TABLE': table,
+            'SHORTCOLNAME': 'HC01_{0}_VC{1:02d}'.format('EST' if est == 'Estimate' else 'MOE', rnd.randrange(1, 200)),
+            'LONGCOLNAME': '; '.join([rollup1, est, name]),
+            'EST_OR_MARGIN': est,
+            'NAME': name,
+            'ROLLUP1': rollup1,
+            'ROLLUP2': '',
+            })
+    return md
+
+
+def bench_pattern_scan(rows, max_processes, repeat=3):
+    """Time pattern_scan over synthetic metadata for 1..max_processes
+    processes, keeping the best of repeat runs. Returns a list of dicts
+    with processes, rows, matches, seconds and speedup."""
+    md = synthetic_metadata(rows)
+    results = []
+    for processes in range(1, max_processes+1):
+        best = None
+        for r in range(repeat):
+            start = time.perf_counter()
+            matches = acs_aff_colsearch.pattern_scan(md, SCAN_RULES, processes=processes)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        results.append({'processes': processes, 'rows': rows, 'matches': len(matches), 'seconds': best})
+    for r in results:
+        r['speedup'] = results[0]['seconds'] / r['seconds']
+    return results
+
+
+def measure(fn, setup=None, repeat=3):
+    """Run fn repeat times (calling setup, untimed, before each) and
+    once more under tracemalloc. Returns a dict with the best wall and
+    CPU seconds, peak traced bytes and peak RSS of this process and its
+    children (KB), plus 'result', fn's return value from the last run."""
+    best = None
+    best_cpu = None
+    for r in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        start_cpu = time.process_time()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        elapsed_cpu = time.process_time() - start_cpu
+        if best is None or elapsed < best:
+            best = elapsed
+            best_cpu = elapsed_cpu
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        result = fn()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'seconds': best,
+        'cpu_seconds': best_cpu,
+        'peak_bytes': peak,
+        'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'child_maxrss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        'result': result,
+        }
+
+
+STAGES = ['burst', 'assemble_metadata', 'pattern_scan', 'table_shell_extract']
+
+
+def bench_stages(corpus_dir, stages=STAGES, repeat=3, processes=None):
+    """Time each stage, in pipeline order, on the corpus in corpus_dir.
+    Each stage works on the previous stage's output. Returns a list of
+    dicts with stage, items (files or rows handled) and the measure()
+    figures (pattern_scan also reports matches). Stages not asked for
+    are only run, untimed, if their output is missing."""
+    acs_dir = os.path.join(corpus_dir, 'acs')
+    raw_dir = os.path.join(corpus_dir, 'raw')
+    metadata = os.path.join(corpus_dir, 'all_metadata.csv')
+    shells_dir = os.path.join(corpus_dir, 'table_shells')
+
+    def clear_acs():
+        if os.path.exists(acs_dir):
+            shutil.rmtree(acs_dir)
+
+    def burst():
+        acs_aff_burst.burst(topdir=corpus_dir, raw_dir=raw_dir)
+        return sum(len(filenames) for (dirpath, dirnames, filenames) in os.walk(acs_dir))
+
+    def assemble():
+        acs_aff_assemble_metadata.assemble_metadata(topdir=acs_dir, output_filename=metadata)
+        with open(metadata, 'r', encoding='utf-8') as fp:
+            return sum(1 for line in fp) - 1
+
+    md = []
+    def scan():
+        return len(acs_aff_colsearch.pattern_scan(md, SCAN_RULES, acs_aff_colsearch.load_stats(metadata), processes))
+
+    def shells():
+        table_shell_extract.extract_all(shells_dir, os.path.join(corpus_dir, 'shells.csv'), processes, cache_dir=None)
+        return len(table_shell_extract.find_shells(shells_dir))
+
+    jobs = {
+        'burst': (burst, clear_acs, acs_dir),
+        'assemble_metadata': (assemble, None, metadata),
+        'pattern_scan': (scan, None, None),
+        'table_shell_extract': (shells, None, None),
+        }
+    results = []
+    for stage in STAGES:
+        fn, setup, made = jobs[stage]
+        if stage == 'pattern_scan' and stage in stages:
+            md[:] = acs_aff_colsearch.load_metadata(metadata)
+        if stage in stages:
+            m = measure(fn, setup, repeat)
+            result = m.pop('result')
+            results.append(dict(stage=stage, items=len(md) if stage == 'pattern_scan' else result, **m))
+            if stage == 'pattern_scan':
+                results[-1]['matches'] = result
+        elif made is not None and not os.path.exists(made):
+            fn()  # untimed, to make input for a later stage
+    return results
+
+
+def git_commit():
+    """The commit this checkout is at, or '' outside a git tree."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def write_json(results, filename, args):
+    """Write results to filename as JSON, with what's needed to compare
+    them against another run."""
+    report = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'args': vars(args),
+        'results': results,
+        }
+    with open(filename, 'w', encoding='utf-8') as fp:
+        json.dump(report, fp, indent=2)
+        fp.write('\n')
+
+
+def output(results):
+    if len(results) == 0:
+        return
+    fieldnames = []
+    for r in results:
+        fieldnames += [k for k in r if k not in fieldnames]
+    writer = csv.DictWriter(sys.stdout, fieldnames=fieldnames)
+    writer.writeheader()
+    for r in results:
+        writer.writerow(r)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the ACS AFF tools.')
+    subparsers = parser.add_subparsers(dest='bench')
+    scan = subparsers.add_parser('scan', help='pattern_scan scaling from 1 to N processes')
+    scan.add_argument('-n', dest='rows', type=int, default=200000, help='number of synthetic metadata rows')
+    scan.add_argument('-j', dest='max_processes', type=int, default=os.cpu_count() or 1, help='maximum number of processes')
+    scan.add_argument('--repeat', dest='repeat', type=int, default=3, help='runs per setting; best is reported')
+    scan.add_argument('-o', dest='json', default=None, help='also write results to this JSON file')
+    stages = subparsers.add_parser('stages', help='time each pipeline stage on a synthetic corpus')
+    stages.add_argument('corpus_dir', help='corpus directory; generated by acs_aff_synth if missing')
+    stages.add_argument('-s', dest='stages', nargs='+', choices=STAGES, default=STAGES, help='stages to time')
+    stages.add_argument('-y', dest='years', type=int, nargs=2, default=[2005, 2014], metavar=('FIRST', 'LAST'), help='range of ACS years, when generating')
+    stages.add_argument('-t', dest='tables', type=int, default=80, help='tables per year, when generating')
+    stages.add_argument('-g', dest='geographies', type=int, default=500, help='geographies per geography type, when generating')
+    stages.add_argument('-j', dest='processes', type=int, default=None, help='number of processes (default: all cores)')
+    stages.add_argument('--repeat', dest='repeat', type=int, default=3, help='runs per stage; best is reported')
+    stages.add_argument('-o', dest='json', default=None, help='also write results to this JSON file')
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    if args.bench == 'scan':
+        results = bench_pattern_scan(args.rows, args.max_processes, args.repeat)
+    elif args.bench == 'stages':
+        if not os.path.exists(os.path.join(args.corpus_dir, 'raw')):
+            acs_aff_synth.make_corpus(args.corpus_dir, list(range(args.years[0], args.years[1]+1)), args.tables, args.geographies)
+        results = bench_stages(args.corpus_dir, args.stages, args.repeat, args.processes)
+    else:
+        return
+    output(results)
+    if args.json is not None:
+        write_json(results, args.json, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -43,17 +43,11 @@ import time
 import re
 import zipfile
 import shutil
+import argparse
 
-NOW = time.time()
-
-if not os.path.exists("logs"):
-    os.mkdir("logs")
+import acs_instrument
 
-logging.basicConfig(
-    filename=os.path.join("logs",__file__+time.strftime('.%Y%m%d_%H%M%S.log', time.localtime(NOW))),
-    format='(asctime)|(levelno)|(levelname)|(filename)|(lineno)|(message)',
-    level=logging.DEBUG
-    )
+NOW = time.time()
 
 def parse_zipfilename(filename):
     basename = os.path.basename(filename)
@@ -68,6 +62,29 @@ def parse_zipfilename(filename):
     return retval
     
 
+def burst_zip(fullpath, acs_dir):
+    """Extract one AFF zip into acs_dir/<type>/<year>/. Returns the paths
+    of the extracted files, or [] if the name isn't an AFF zip name."""
+    zinfo = parse_zipfilename(fullpath)
+    if zinfo == {}:
+        return []
+    type_dir = os.path.join(acs_dir, zinfo['type'])
+    year_dir = os.path.join(type_dir, str(zinfo['year']))
+    os.makedirs(year_dir, mode=0o755, exist_ok=True)
+    with acs_instrument.stage('extract'), zipfile.ZipFile(fullpath, 'r') as zip:
+        # sanity check the zip file
+        names = zip.namelist()
+        for n in names:
+            assert not n.startswith('/')
+            assert n.find('..') == -1
+        # extract all files.
+        zip.extractall(path=year_dir)
+        acs_instrument.count('zips')
+        acs_instrument.count('files', len(names))
+        acs_instrument.count('bytes', sum(i.file_size for i in zip.infolist()))
+    return [os.path.join(year_dir, n) for n in names if not n.endswith('/')]
+
+
 def burst(topdir='.', raw_dir='raw'):
     acs_dir = os.path.join(topdir, 'acs')
     if os.path.exists(acs_dir):
@@ -76,24 +93,16 @@ def burst(topdir='.', raw_dir='raw'):
     os.mkdir(acs_dir, mode=0o755)
     for (dirpath, dirnames, filenames) in os.walk(raw_dir):
         for fn in filenames:
-            fullpath = os.path.join(dirpath, fn)
-            zinfo = parse_zipfilename(fn)
-            if zinfo != {}:
-                type_dir = os.path.join(acs_dir, zinfo['type'])
-                year_dir = os.path.join(type_dir, str(zinfo['year']))
-                if not os.path.exists(type_dir):
-                    os.mkdir(type_dir, mode=0o755)
-                if not os.path.exists(year_dir):
-                    os.mkdir(year_dir, mode=0o755)
-                with zipfile.ZipFile(fullpath, 'r') as zip:
-                    # sanity check the zip file
-                    names = zip.namelist()
-                    for n in names:
-                        assert not n.startswith('/')
-                        assert n.find('..') == -1
-                    # extract all files.
-                    zip.extractall(path=year_dir)
+            burst_zip(os.path.join(dirpath, fn), acs_dir)
                 
 
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Burst American Fact Finder zips into an acs/ tree.')
+    acs_instrument.add_arguments(parser)
+    return parser.parse_args(args)
+
+
 if __name__ == '__main__':
+    acs_instrument.setup_logging(__file__)
+    acs_instrument.start(__file__, parse_args())
     burst()
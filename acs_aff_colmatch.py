@@ -0,0 +1,185 @@
+# Link columns across adjacent years by long-name similarity.
+#
+# Copyright 2016 R. A. Reitmeyer
+#
+# Long column names drift from year to year, eg
+#     EMPLOYMENT STATUS - In labor force - Civilian labor force
+# becomes
+#     EMPLOYMENT STATUS - Population 16 years and over - In labor force - Civilian labor force
+# so colsearch regexes have to be written by hand to find them. This
+# tool proposes, for each column in year N, the most similar columns in
+# years N-1 and N+1 of the same (or a related) table, scored by the
+# Jaccard similarity of the words in NAME plus ROLLUP1/ROLLUP2.
+#
+# Comparing every pair of columns is quadratic, so candidates come from
+# a MinHash / locality-sensitive-hashing index: each column's token set
+# is reduced to a MinHash signature, the signature is cut into bands,
+# and only columns sharing at least one band bucket get scored.
+
+# Requires Python3.
+
+# Copyright R. A. Reitmeyer
+# Released under the GNU Public License, version 2, or later.
+
+import os
+import sys
+import re
+import csv
+import zlib
+import random
+import logging
+import argparse
+
+import acs_aff_colsearch
+
+
+MINHASH_PERMUTATIONS = 64
+LSH_BAND_ROWS = 2
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+
+def tokens(rec):
+    """Token set for a metadata record: lowercased words of the
+    year-abstracted NAME, plus the rollups tagged so a "Male" rollup
+    never matches a "male" word in the name.
+
+    >>> sorted(tokens({'NAME': 'EMPLOYMENT STATUS - In labor force', 'ROLLUP1': 'Total', 'ROLLUP2': ''}))
+    ['employment', 'force', 'in', 'labor', 'rollup:total', 'status']
+    """
+    retval = set(re.findall('[a-z0-9{}]+', acs_aff_colsearch.abstract_year(rec['NAME']).lower()))
+    for k in ['ROLLUP1', 'ROLLUP2']:
+        if rec.get(k, '') != '':
+            retval.add('rollup:' + rec[k].lower())
+    return retval
+
+
+def table_family(table):
+    """Tables that are variants of one another (race iterations like
+    B19013A, Puerto Rico versions like S0102PR) share a family.
+
+    >>> table_family('S0102PR'), table_family('B19013A'), table_family('S0102')
+    ('S0102', 'B19013', 'S0102')
+    """
+    m = re.match('[A-Z]+[0-9]+', table)
+    if m:
+        return m.group(0)
+    return table
+
+
+def jaccard(a, b):
+    if len(a) == 0 and len(b) == 0:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def make_permutations(num_perm=MINHASH_PERMUTATIONS, seed=1):
+    rnd = random.Random(seed)
+    return [(rnd.randrange(1, MERSENNE_PRIME), rnd.randrange(0, MERSENNE_PRIME)) for i in range(num_perm)]
+
+
+def minhash(token_set, permutations):
+    """MinHash signature of a token set: for each (a, b) permutation,
+    the minimum of (a*h + b) mod p over the token hashes."""
+    hashes = [zlib.crc32(t.encode('utf-8')) for t in token_set]
+    if len(hashes) == 0:
+        return tuple(MAX_HASH for p in permutations)
+    return tuple(min(((a*h + b) % MERSENNE_PRIME) & MAX_HASH for h in hashes) for a, b in permutations)
+
+
+def unique_columns(md):
+    """One record per (year, table, short name, long name): the same
+    columns appear once per geography type and span in the metadata."""
+    seen = set()
+    retval = []
+    for rec in md:
+        if rec['NAME'] == '':
+            continue # GEO.id and friends
+        key = (rec['ACS_YEAR'], rec['TABLE'], rec['SHORTCOLNAME'], rec['LONGCOLNAME'])
+        if key not in seen:
+            seen.add(key)
+            retval.append(rec)
+    return retval
+
+
+def build_index(cols, num_perm=MINHASH_PERMUTATIONS, band_rows=LSH_BAND_ROWS):
+    """Build the LSH index: a dict from (year, table family,
+    EST_OR_MARGIN, band number, band signature) to a list of column
+    positions. Also returns each column's token set and signature."""
+    permutations = make_permutations(num_perm)
+    col_tokens = []
+    col_sigs = []
+    buckets = {}
+    for i, rec in enumerate(cols):
+        t = tokens(rec)
+        sig = minhash(t, permutations)
+        col_tokens.append(t)
+        col_sigs.append(sig)
+        block = (rec['ACS_YEAR'], table_family(rec['TABLE']), rec['EST_OR_MARGIN'])
+        for band, start in enumerate(range(0, num_perm, band_rows)):
+            buckets.setdefault(block + (band, sig[start:start+band_rows]), []).append(i)
+    return buckets, col_tokens, col_sigs
+
+
+def link_columns(md, top=3, threshold=0.3, num_perm=MINHASH_PERMUTATIONS, band_rows=LSH_BAND_ROWS):
+    """For each column in each year, propose up to `top` columns from the
+    adjacent years of the same table family with Jaccard similarity at
+    least `threshold`. Returns a list of dicts, best match first within
+    each column."""
+    cols = unique_columns(md)
+    buckets, col_tokens, col_sigs = build_index(cols, num_perm, band_rows)
+    logging.info('colmatch: %d columns, %d LSH buckets', len(cols), len(buckets))
+    retval = []
+    for i, rec in enumerate(cols):
+        candidates = set()
+        year = int(rec['ACS_YEAR'])
+        family = table_family(rec['TABLE'])
+        sig = col_sigs[i]
+        for other_year in [year-1, year+1]:
+            block = (str(other_year), family, rec['EST_OR_MARGIN'])
+            for band, start in enumerate(range(0, num_perm, band_rows)):
+                candidates.update(buckets.get(block + (band, sig[start:start+band_rows]), []))
+        scored = []
+        for j in candidates:
+            score = jaccard(col_tokens[i], col_tokens[j])
+            if score >= threshold:
+                scored.append((score, j))
+        scored.sort(key=lambda s: (-s[0], cols[s[1]]['ACS_YEAR'], cols[s[1]]['SHORTCOLNAME']))
+        for score, j in scored[:top]:
+            other = cols[j]
+            retval.append({
+                'ACS_YEAR': rec['ACS_YEAR'],
+                'TABLE': rec['TABLE'],
+                'SHORTCOLNAME': rec['SHORTCOLNAME'],
+                'LONGCOLNAME': rec['LONGCOLNAME'],
+                'MATCH_YEAR': other['ACS_YEAR'],
+                'MATCH_TABLE': other['TABLE'],
+                'MATCH_SHORTCOLNAME': other['SHORTCOLNAME'],
+                'MATCH_LONGCOLNAME': other['LONGCOLNAME'],
+                'SCORE': '{0:.3f}'.format(score),
+                })
+    return retval
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Propose matching Census columns in adjacent years.')
+    parser.add_argument('-m', dest='metadata', default='all_metadata.csv', help='assembled metadata file')
+    parser.add_argument('-k', dest='top', type=int, default=3, help='matches to report per column')
+    parser.add_argument('-t', dest='threshold', type=float, default=0.3, help='minimum Jaccard similarity')
+    parser.add_argument('-r', dest='rules', nargs=2, action='append', help='only link columns matching this case-insensitive COLNAME PATTERN rule')
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    md = acs_aff_colsearch.load_metadata(args.metadata)
+    if args.rules is not None:
+        rules = [{'colname': r[0], 'pattern': acs_aff_colsearch.expand_all_patterns(acs_aff_colsearch.flip_quotes(r[1])), 'flags': re.IGNORECASE} for r in args.rules]
+        md = acs_aff_colsearch.pattern_scan(md, rules, acs_aff_colsearch.load_stats(args.metadata))
+    links = link_columns(md, args.top, args.threshold)
+    header = ['ACS_YEAR', 'TABLE', 'SHORTCOLNAME', 'MATCH_YEAR', 'MATCH_TABLE', 'MATCH_SHORTCOLNAME', 'SCORE', 'LONGCOLNAME', 'MATCH_LONGCOLNAME']
+    acs_aff_colsearch.output(header, links)
+
+
+if __name__ == '__main__':
+    main()
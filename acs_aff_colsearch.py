@@ -19,25 +19,101 @@ import logging
 import argparse
 import pprint
 import pdb
+import multiprocessing
+
+import acs_aff_assemble_metadata
+import acs_result_cache
+import acs_instrument
+import acs_workbook
 
 NOW = time.time()
 
-if not os.path.exists("logs"):
-    os.mkdir("logs")
 
-logging.basicConfig(
-    filename=os.path.join('logs',__file__+time.strftime('.%Y%m%d_%H%M%S.log', time.localtime(NOW))),
-    format='(asctime)|(levelno)|(levelname)|(filename)|(lineno)|(message)',
-    level=logging.DEBUG
-    )
+def load_metadata(metadata_filename='all_metadata.csv', rules=None, geotypes=None):
+    """Load the assembled metadata as a list of dicts.
 
+    If the partitioned copy written by assemble_metadata exists and is
+    not older than the flat file, only the partitions that can hold rows
+    matching the rules on ACS_YEAR and TABLE (and, if given, the
+    geotypes: 'places' and/or 'non_places') are read, and the rows are
+    returned in flat file order. Otherwise the flat file is read and
+    geotypes filtered row by row. Rules are not otherwise applied;
+    that's pattern_scan's job.
 
-def load_metadata(metadata_filename='all_metadata.csv', build_cmd='python3 acs_aff_assemble_metadata.py'):
-    if not os.path.exists(metadata_filename):
-        assert(os.system(build_cmd) == 0)
+    If neither exists, it is built first with acs_pipeline.
+    """
+    partition_dir = acs_aff_assemble_metadata.partition_dir_for(metadata_filename)
+    catalog_filename = os.path.join(partition_dir, acs_aff_assemble_metadata.CATALOG_FILENAME)
+    if not os.path.exists(metadata_filename) and not os.path.exists(catalog_filename):
+        import acs_pipeline  # not at the top: acs_pipeline imports the tools that import us
+        status = acs_pipeline.Pipeline(metadata_filename=metadata_filename).run(['metadata'], report=logging.info)
+        if status.get('metadata') not in ['run', 'skip']:
+            raise RuntimeError('could not build {0}: pipeline status {1}'.format(metadata_filename, status))
+    if acs_aff_assemble_metadata.partitions_current(metadata_filename, partition_dir):
+        retval = []
+        for path in select_partitions(catalog_filename, rules, geotypes):
+            with open(os.path.join(partition_dir, path), 'r', newline='', encoding='utf-8') as fp:
+                retval += [ rec for rec in csv.DictReader(fp) ]
+        # each FILENAME's rows are in one partition, in order, so a
+        # stable sort by FILENAME restores the flat file's order.
+        retval.sort(key=lambda rec: acs_aff_assemble_metadata.walk_order_key(rec['FILENAME']))
+        return retval
+    if os.path.exists(catalog_filename):
+        logging.info('%s is newer than its partitions; reading it instead', metadata_filename)
     with open(metadata_filename, 'r', newline='', encoding='utf-8') as fp:
         reader = csv.DictReader(fp)
+        if geotypes is not None:
+            return [ rec for rec in reader if acs_aff_assemble_metadata.geotype_of(rec['FILENAME']) in geotypes ]
         return [ rec for rec in reader ]
+
+
+def select_partitions(catalog_filename, rules=None, geotypes=None):
+    """Return the paths (relative to the partition directory) of the
+    partitions whose ACS_YEAR, TABLE and GEOTYPE can satisfy the rules.
+    Every row in a partition shares those values, so testing the rule
+    against the catalog entry is exact, not a heuristic.
+    """
+    prune_rules = [r for r in (rules or []) if r['colname'] in ['ACS_YEAR', 'TABLE']]
+    steps = [(step['colname'], step['match']) for step in plan_rules(prune_rules)]
+    retval = []
+    total = 0
+    with open(catalog_filename, 'r', newline='', encoding='utf-8') as fp:
+        for part in csv.DictReader(fp):
+            total += 1
+            if geotypes is not None and part['GEOTYPE'] not in geotypes:
+                continue
+            if all(match(part[colname]) for colname, match in steps):
+                retval.append(part['PATH'])
+    logging.info('select_partitions: reading %d of %d partitions', len(retval), total)
+    return retval
+
+
+def load_stats(metadata_filename='all_metadata.csv'):
+    """Load the column statistics written by assemble_metadata next to
+    the metadata file, as a dict with 'rows', 'distinct' (colname to
+    distinct count) and 'values' (colname to {value: count}, only for
+    low-cardinality columns). Returns None if there are no stats, in
+    which case the planner falls back to per-kind guesses.
+    """
+    stats_filename = acs_aff_assemble_metadata.stats_filename_for(metadata_filename)
+    if not os.path.exists(stats_filename):
+        return None
+    retval = {
+        'source': (os.path.abspath(stats_filename), os.path.getmtime(stats_filename)),
+        'rows': 0,
+        'distinct': {},
+        'values': {},
+        }
+    with open(stats_filename, 'r', newline='', encoding='utf-8') as fp:
+        for rec in csv.DictReader(fp):
+            count = int(rec['COUNT'])
+            if rec['STAT'] == 'rows':
+                retval['rows'] = count
+            elif rec['STAT'] == 'distinct':
+                retval['distinct'][rec['COLNAME']] = count
+            elif rec['STAT'] == 'value':
+                retval['values'].setdefault(rec['COLNAME'], {})[rec['VALUE']] = count
+    return retval
         
 
 def flip_quotes(pattern):
@@ -87,28 +163,344 @@ def abstract_year(value):
     return re.sub('(?P<year>[0-9]{4})', '{year}', value)
 
 
-def pattern_scan(md, rules):
-    """Search for cols matching the given rules (rules AND'd together).
-    Each rule is a small dict with keys for colname, pattern, and
-    (optionally) flags. If flags is not given, re.IGNORECASE is assumed.
+def make_rule(colname, pattern, ignore_case=True):
+    """A pattern_scan rule from a user's pattern, as -r and -R make
+    them: parens literal and {year} standing for any year.
+
+    >>> make_rule('LONGCOLNAME', 'income ({year} dollars)') == {'colname': 'LONGCOLNAME', 'pattern': 'income \\\\((?P<year>[0-9]{4}) dollars\\\\)', 'flags': re.IGNORECASE}
+    True
+    """
+    return {'colname': colname, 'pattern': expand_all_patterns(flip_quotes(pattern)), 'flags': re.IGNORECASE if ignore_case else 0}
+
+
+# Rule kinds, cheapest first. Relative per-row cost of evaluating each
+# kind, and the selectivity guessed when there are no column stats.
+RULE_EXACT = 'exact'
+RULE_PREFIX = 'prefix'
+RULE_SUBSTRING = 'substring'
+RULE_REGEX = 'regex'
+RULE_COST = {RULE_EXACT: 1.0, RULE_PREFIX: 1.0, RULE_SUBSTRING: 2.0, RULE_REGEX: 10.0}
+RULE_GUESS = {RULE_EXACT: 0.05, RULE_PREFIX: 0.1, RULE_SUBSTRING: 0.25, RULE_REGEX: 0.5}
+
+REGEX_SPECIALS = '.^$*+?{}[]|()'
+
+# Plans kept by plan_rules; past this many, the oldest is dropped, so a
+# long-lived MetadataIndex serving ad hoc queries doesn't grow forever.
+PLAN_CACHE_SIZE = 256
+
+_PLAN_CACHE = {}
+
+
+def regex_literal(pattern):
+    """Return the literal string a regex pattern matches, or None if the
+    pattern uses any regex feature beyond escaped punctuation.
+
+    >>> regex_literal('median income \\(dollars\\)')
+    'median income (dollars)'
+    >>> regex_literal('VC[0-9]+') is None
+    True
+    >>> regex_literal('\\d') is None
+    True
+    """
+    retval = ''
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            if i+1 >= len(pattern) or pattern[i+1].isalnum():
+                return None
+            retval += pattern[i+1]
+            i += 2
+            continue
+        if c in REGEX_SPECIALS:
+            return None
+        retval += c
+        i += 1
+    return retval
+
+
+def classify_rule(pattern, flags=re.IGNORECASE):
+    """Classify a rule pattern as exact, prefix, literal-substring or full
+    regex. Returns (kind, literal); literal is None for full regexes.
+    Case-insensitive literals must be ASCII: beyond ASCII, str.lower
+    and the re module's case folding can disagree, so those stay regexes.
+
+    >>> classify_rule('^ESTIMATE$')
+    ('exact', 'ESTIMATE')
+    >>> classify_rule('^Total')
+    ('prefix', 'Total')
+    >>> classify_rule('Civilian labor force')
+    ('substring', 'Civilian labor force')
+    >>> classify_rule('\\(dollars\\)$')
+    ('regex', None)
+    >>> classify_rule('^ESTIMATE$', re.IGNORECASE|re.MULTILINE)
+    ('regex', None)
+    >>> classify_rule('Straße'), classify_rule('Straße', 0)
+    (('regex', None), ('substring', 'Straße'))
+    """
+    if flags & ~re.IGNORECASE:
+        return (RULE_REGEX, None)
+    body = pattern
+    anchored_start = body.startswith('^')
+    if anchored_start:
+        body = body[1:]
+    anchored_end = False
+    if body.endswith('$'):
+        # only an anchor if the dollar sign is not itself escaped
+        backslashes = len(body[:-1]) - len(body[:-1].rstrip('\\'))
+        if backslashes % 2 == 0:
+            anchored_end = True
+            body = body[:-1]
+    literal = regex_literal(body)
+    if literal is None:
+        return (RULE_REGEX, None)
+    if flags & re.IGNORECASE and not all(ord(c) < 128 for c in literal):
+        return (RULE_REGEX, None)
+    if anchored_start and anchored_end:
+        return (RULE_EXACT, literal)
+    if anchored_start:
+        return (RULE_PREFIX, literal)
+    if anchored_end:
+        return (RULE_REGEX, None)
+    return (RULE_SUBSTRING, literal)
+
+
+def make_matcher(kind, literal, regex, ignore_case):
+    """Build a one-argument predicate for a classified rule."""
+    if kind == RULE_REGEX:
+        search = regex.search
+        return lambda v: search(v) is not None
+    if ignore_case:
+        # lower, not casefold: casefold('ß') is 'ss', which re.IGNORECASE
+        # doesn't match.
+        literal = literal.lower()
+        if kind == RULE_EXACT:
+            return lambda v: v.lower() == literal
+        if kind == RULE_PREFIX:
+            return lambda v: v.lower().startswith(literal)
+        return lambda v: v.lower().find(literal) != -1
+    if kind == RULE_EXACT:
+        return lambda v: v == literal
+    if kind == RULE_PREFIX:
+        return lambda v: v.startswith(literal)
+    return lambda v: v.find(literal) != -1
+
+
+def estimate_selectivity(step, stats):
+    """Estimate the fraction of rows a planned rule will pass. Uses the
+    value frequencies from the stats file when the column has them, a
+    1/distinct guess for exact matches on other columns, and a fixed
+    per-kind guess otherwise.
+    """
+    if stats is None or stats['rows'] == 0:
+        return RULE_GUESS[step['kind']]
+    values = stats['values'].get(step['colname'])
+    if values is not None:
+        matched = sum(count for v, count in values.items() if step['match'](v))
+        return matched / stats['rows']
+    if step['kind'] == RULE_EXACT and stats['distinct'].get(step['colname']):
+        return 1.0 / stats['distinct'][step['colname']]
+    return RULE_GUESS[step['kind']]
+
+
+def plan_rules(rules, stats=None):
+    """Turn a list of rules into an ordered plan: a list of steps, each
+    a dict with colname, kind, match (a predicate), cost and selectivity.
+    Steps are ordered so the cheapest, most selective rules run first
+    (ascending cost / (1 - selectivity)), which is the best order for
+    AND'd predicates. The last PLAN_CACHE_SIZE plans are cached across
+    calls, and the caller's rule dicts are left untouched.
     """
+    key = (tuple((r['colname'], r['pattern'], r.get('flags', re.IGNORECASE)) for r in rules),
+           None if stats is None else stats['source'])
+    if key in _PLAN_CACHE:
+        return _PLAN_CACHE[key]
+    plan = []
+    for colname, pattern, flags in key[0]:
+        kind, literal = classify_rule(pattern, flags)
+        regex = re.compile(pattern, flags) if kind == RULE_REGEX else None
+        step = {
+            'colname': colname,
+            'pattern': pattern,
+            'kind': kind,
+            'match': make_matcher(kind, literal, regex, bool(flags & re.IGNORECASE)),
+            'cost': RULE_COST[kind],
+            }
+        step['selectivity'] = estimate_selectivity(step, stats)
+        plan.append(step)
+    plan.sort(key=lambda step: step['cost'] / max(1.0 - step['selectivity'], 1e-6))
+    logging.debug('plan: %s', [(step['colname'], step['kind'], step['selectivity']) for step in plan])
+    if len(_PLAN_CACHE) >= PLAN_CACHE_SIZE:
+        del _PLAN_CACHE[next(iter(_PLAN_CACHE))]
+    _PLAN_CACHE[key] = plan
+    return plan
+
+
+# Below this many metadata rows, pattern_scan stays serial: starting a
+# process pool costs more than it saves.
+PARALLEL_MIN_ROWS = 50000
+
+# Rows per work unit handed to a pattern_scan worker.
+PARALLEL_CHUNK_ROWS = 10000
+
+_SCAN_STATE = {}
+
+
+def _scan_init(md, rules, stats):
+    """Pool initializer: stash the scan inputs in the worker. The pool
+    is always forked (see pattern_scan), so these are inherited rather
+    than pickled."""
+    _SCAN_STATE['md'] = md
+    _SCAN_STATE['rules'] = rules
+    _SCAN_STATE['stats'] = stats
+
+
+def _scan_range(md, steps, start, end):
+    """Scan md[start:end] and return a list of (index, LONGCOLNAME_ar,
+    NAME_ar) for each matching row, and the number of rule evaluations."""
     retval = []
-    for r in rules:
-        r['regex'] = re.compile(r['pattern'], r.get('flags', re.IGNORECASE))
-    for rec in md:
+    evaluations = 0
+    for i in range(start, end):
+        rec = md[i]
         use = True
-        for r in rules:
-            if r['regex'].search(rec[r['colname']]) is None:
+        for colname, match in steps:
+            evaluations += 1
+            if not match(rec[colname]):
                 use = False
                 break
         if use:
-            rec['LONGCOLNAME_ar'] = abstract_year(rec['LONGCOLNAME'])
-            rec['NAME_ar'] = abstract_year(rec['NAME'])
+            retval.append((i, abstract_year(rec['LONGCOLNAME']), abstract_year(rec['NAME'])))
+    return retval, evaluations
+
 
-            retval.append(rec)
+def _scan_chunk(bounds):
+    """Pool worker: plan the rules locally (plans hold closures, so they
+    are not shipped between processes) and scan one chunk."""
+    steps = [(step['colname'], step['match']) for step in plan_rules(_SCAN_STATE['rules'], _SCAN_STATE['stats'])]
+    return _scan_range(_SCAN_STATE['md'], steps, bounds[0], bounds[1])
+
+
+def pattern_scan(md, rules, stats=None, processes=None):
+    """Search for cols matching the given rules (rules AND'd together).
+    Each rule is a small dict with keys for colname, pattern, and
+    (optionally) flags. If flags is not given, re.IGNORECASE is assumed.
+    Rules are evaluated in the order chosen by plan_rules, using
+    column stats from load_stats if given.
+
+    With processes=None the scan runs on all cores once md has at least
+    PARALLEL_MIN_ROWS rows, and serially otherwise; processes=1 forces
+    a serial scan. Results are in md order either way. The parallel
+    scan needs the fork start method, so workers inherit md instead of
+    each unpickling a copy (which costs more than the scan saves); where
+    fork isn't available the scan is serial.
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+        if len(md) < PARALLEL_MIN_ROWS:
+            processes = 1
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        processes = 1
+    if processes <= 1:
+        steps = [(step['colname'], step['match']) for step in plan_rules(rules, stats)]
+        hits, evaluations = _scan_range(md, steps, 0, len(md))
+    else:
+        bounds = [(start, min(start+PARALLEL_CHUNK_ROWS, len(md))) for start in range(0, len(md), PARALLEL_CHUNK_ROWS)]
+        with multiprocessing.get_context('fork').Pool(processes, initializer=_scan_init, initargs=(md, rules, stats)) as pool:
+            chunks = pool.map(_scan_chunk, bounds)
+        hits = [h for chunk, n in chunks for h in chunk]
+        evaluations = sum(n for chunk, n in chunks)
+    acs_instrument.count('rows_scanned', len(md))
+    acs_instrument.count('regex_evaluations', evaluations)
+    retval = []
+    for i, longcolname_ar, name_ar in hits:
+        rec = md[i]
+        rec['LONGCOLNAME_ar'] = longcolname_ar
+        rec['NAME_ar'] = name_ar
+        retval.append(rec)
     return retval
 
 
+def summarize_years(cols):
+    """The -y summary of pattern_scan results: one dict per distinct
+    LONGCOLNAME_ar with the tables, short column names and years it
+    appears in, most years first. Returns (header, summary)."""
+    longnames = {}
+    for c in cols:
+        rec = {}
+        if c['LONGCOLNAME_ar'] in longnames:
+            prior = longnames[c['LONGCOLNAME_ar']]
+            rec['years'] = set([c['ACS_YEAR']]) | prior['years']
+            rec['tables'] = set([c['TABLE']]) | prior['tables']
+            rec['shortcolnames'] = set([c['SHORTCOLNAME']]) | prior['shortcolnames']
+        else:
+            rec['years'] = set([c['ACS_YEAR']])
+            rec['tables'] = set([c['TABLE']])
+            rec['shortcolnames'] = set([c['SHORTCOLNAME']])
+        longnames[c['LONGCOLNAME_ar']] = rec
+    # order by count and summarize years
+    longnames_order = sorted([(len(longnames[k]['years']),k) for k in longnames], reverse=True)
+    header = ['count', 'LONGCOLNAME_ar', 'tables', 'shortcolnames', 'years']
+    summary = [{'count':c, 
+                'LONGCOLNAME_ar':k, 
+                'tables': ' '.join(sorted(longnames[k]['tables'])), 
+                'shortcolnames': ' '.join(sorted(longnames[k]['shortcolnames'])),
+                'years':' '.join(sorted(longnames[k]['years']))} 
+               for c,k in longnames_order]
+    return header, summary
+
+
+class MetadataIndex(object):
+    """The assembled metadata and its column stats, loaded once for
+    any number of searches in one process (a notebook or a service),
+    rather than once per search as the command line does.
+
+        index = MetadataIndex('all_metadata.csv')
+        cols = index.search([make_rule('LONGCOLNAME', 'civilian labor force')])
+
+    If the metadata files change on disk, the next search reloads them.
+    """
+    def __init__(self, metadata_filename='all_metadata.csv', geotypes=None, processes=1):
+        self.metadata_filename = metadata_filename
+        self.geotypes = geotypes
+        self.processes = processes
+        self.md = None
+        self.stats = None
+        self.fingerprint = None
+        self.reload()
+
+    def inputs(self):
+        """The files whose change means a reload: the flat file, the
+        stats, and the partition catalog, which is rewritten whenever
+        the partitions are (so the partitions needn't be walked)."""
+        partition_dir = acs_aff_assemble_metadata.partition_dir_for(self.metadata_filename)
+        return [self.metadata_filename,
+                acs_aff_assemble_metadata.stats_filename_for(self.metadata_filename),
+                os.path.join(partition_dir, acs_aff_assemble_metadata.CATALOG_FILENAME)]
+
+    def reload(self):
+        """Load (or load again) the metadata and stats."""
+        self.md = load_metadata(self.metadata_filename, geotypes=self.geotypes)
+        self.stats = load_stats(self.metadata_filename)
+        self.fingerprint = acs_result_cache.input_fingerprint(self.inputs())
+
+    def __len__(self):
+        return len(self.md)
+
+    def search(self, rules, processes=None):
+        """pattern_scan the loaded metadata. Each result is a copy, so
+        later searches don't change earlier results."""
+        if acs_result_cache.input_fingerprint(self.inputs()) != self.fingerprint:
+            logging.info('MetadataIndex: %s changed, reloading', self.metadata_filename)
+            self.reload()
+        if processes is None:
+            processes = self.processes
+        return [dict(rec) for rec in pattern_scan(self.md, rules, self.stats, processes)]
+
+    def summarize_years(self, rules, processes=None):
+        """search, summarized as colsearch -y does. Returns (header, summary)."""
+        return summarize_years(self.search(rules, processes))
+
+
 def parse_args(args=None):
     parser = argparse.ArgumentParser(description='Search Census columns.')
     parser.add_argument('-e', dest='est_only', action='store_true', help='Just search estimates')
@@ -116,6 +508,11 @@ def parse_args(args=None):
     parser.add_argument('-R', dest='sensitive_rules', nargs=2, action='append', help='define case-sensitive rule as a COLNAME PATTERN pair')
     parser.add_argument('-y', dest="years_only", action="store_true", help="Just report pattern and matching years")
     parser.add_argument('-c', dest="output_cols", nargs="*", help="list of output columns")
+    parser.add_argument('-g', dest="geotypes", nargs="+", choices=['places', 'non_places'], help="only search these geography types")
+    parser.add_argument('-j', dest="processes", type=int, default=None, help="number of processes to scan with (default: all cores for large metadata, else 1)")
+    parser.add_argument('-x', dest="xlsx", default=None, help="write an Excel workbook (the -y summary and a sheet per table, by year) to this file instead of CSV to stdout")
+    parser.add_argument('--no-cache', dest="cache", action="store_false", help="don't use or update the result cache")
+    acs_instrument.add_arguments(parser)
     return parser.parse_args(args)
                         
 
@@ -126,55 +523,74 @@ def output(header, recs):
         writer.writerow([r[k] for k in header])
 
 
+XLSX_HEADER = ['TABLE', 'ACS_YEAR', 'SHORTCOLNAME', 'LONGCOLNAME_ar']
+
+
+def output_xlsx(filename, cols):
+    titles = acs_workbook.write_workbook(filename, acs_workbook.colsearch_sheets(cols))
+    print('{0} sheets written to {1}'.format(len(titles), filename))
+
+
 def main():
     args = parse_args()
+    acs_instrument.setup_logging(__file__)
+    acs_instrument.start(__file__, args)
     rules = []
     if args.insensitive_rules is not None:
         for r in args.insensitive_rules:
-            rules.append({'colname': r[0], 'pattern': expand_all_patterns(flip_quotes(r[1])), 'flags': re.IGNORECASE})
+            rules.append(make_rule(r[0], r[1]))
     if args.sensitive_rules is not None:
         for r in args.sensitive_rules:
-            rules.append({'colname': r[0], 'pattern': expand_all_patterns(flip_quotes(r[1])), 'flags': 0})
+            rules.append(make_rule(r[0], r[1], ignore_case=False))
     if args.est_only is not None and args.est_only:
-        rules.append({'colname': 'EST_OR_MARGIN', 'pattern': '^ESTIMATE$'})
-        pass
+        rules.append(make_rule('EST_OR_MARGIN', '^ESTIMATE$'))
     # substitute year pattern
-    md = load_metadata('all_metadata.csv', 'python3 acs_aff_assemble_metadata.py')
-    cols = pattern_scan(md, rules)
-    if args.years_only is not None and args.years_only:
-        longnames = {}
-        for c in cols:
-            rec = {}
-            if c['LONGCOLNAME_ar'] in longnames:
-                prior = longnames[c['LONGCOLNAME_ar']]
-                rec['years'] = set([c['ACS_YEAR']]) | prior['years']
-                rec['tables'] = set([c['TABLE']]) | prior['tables']
-                rec['shortcolnames'] = set([c['SHORTCOLNAME']]) | prior['shortcolnames']
-            else:
-                rec['years'] = set([c['ACS_YEAR']])
-                rec['tables'] = set([c['TABLE']])
-                rec['shortcolnames'] = set([c['SHORTCOLNAME']])
-                                                                            
-                                                                        
-            longnames[c['LONGCOLNAME_ar']] = rec
-        # order by count and summarize years
-        longnames_order = sorted([(len(longnames[k]['years']),k) for k in longnames], reverse=True)
-        header = ['count', 'LONGCOLNAME_ar', 'tables', 'shortcolnames', 'years']
-        summary = [{'count':c, 
-                    'LONGCOLNAME_ar':k, 
-                    'tables': ' '.join(sorted(longnames[k]['tables'])), 
-                    'shortcolnames': ' '.join(sorted(longnames[k]['shortcolnames'])), 
-                    'years':' '.join(sorted(longnames[k]['years']))} 
-                   for c,k in longnames_order]
-
-        output(header, summary)
+    cache = acs_result_cache.ResultCache()
+    key = acs_result_cache.query_key('colsearch', {
+        'rules': [[r['colname'], r['pattern'], r.get('flags', re.IGNORECASE)] for r in rules],
+        'years_only': args.years_only,
+        'output_cols': args.output_cols,
+        'geotypes': args.geotypes,
+        'xlsx': args.xlsx is not None,
+        }, ['all_metadata.csv', acs_aff_assemble_metadata.partition_dir_for('all_metadata.csv')],
+        [sys.modules[__name__], acs_aff_assemble_metadata, acs_workbook])
+    if args.cache:
+        with acs_instrument.stage('cache_lookup'):
+            cached = cache.get(key)
+        if cached is not None:
+            acs_instrument.count('cache_hits')
+            with acs_instrument.stage('output'):
+                if args.xlsx is not None:
+                    output_xlsx(args.xlsx, cached[1])
+                else:
+                    output(*cached)
+            return
+    with acs_instrument.stage('load_metadata'):
+        md = load_metadata('all_metadata.csv', rules, args.geotypes)
+    with acs_instrument.stage('pattern_scan'):
+        cols = pattern_scan(md, rules, load_stats('all_metadata.csv'), args.processes)
+    acs_instrument.count('matches', len(cols))
+    if args.xlsx is not None:
+        if args.cache:
+            cache.put(key, XLSX_HEADER, cols)
+        with acs_instrument.stage('output'):
+            output_xlsx(args.xlsx, cols)
+    elif args.years_only is not None and args.years_only:
+        header, summary = summarize_years(cols)
+        if args.cache:
+            cache.put(key, header, summary)
+        with acs_instrument.stage('output'):
+            output(header, summary)
     else:
         header = ['LONGCOLNAME_ar', 'ACS_YEAR', 'ACS_SPAN', 'EST_OR_MARGIN', 'NAME_ar', 'ROLLUP1', 'ROLLUP2', 'SHORTCOLNAME', 'TABLE', 'FILENAME', 'LONGCOLNAME', 'NAME']
         if args.output_cols is not None:
             for c in args.output_cols:
                 assert c in md[0].keys()
             header = args.output_cols
-        output(header, cols)
+        if args.cache:
+            cache.put(key, header, cols)
+        with acs_instrument.stage('output'):
+            output(header, cols)
         
 
 
@@ -0,0 +1,160 @@
+# Build and slice a metric x geography x year cube of ACS estimates.
+#
+# Copyright 2016 R. A. Reitmeyer
+#
+# Dashboards keep slicing the metrics of interest by geography and year.
+# This tool runs the trend extraction once (acs_aff_trend.py, which
+# handles SHORTCOLNAME changes between eras) and stores the values as
+# dense arrays in a directory:
+#     est.npy, moe.npy   float64, shape (metric, geography, year), NaN
+#                        where there is no value
+#     metrics.txt        metric labels, one per line, in axis order
+#     geographies.csv    GEO.id, GEO.id2, GEO.display-label, GEOTYPE
+#     years.txt          ACS years, in axis order
+# The arrays are opened memory-mapped, so slices like "all years for one
+# place" or "one metric across every county in 2014" are views into the
+# files rather than copies. A cube holds one span; build with
+#     python3 acs_aff_cube.py -s 1 -o cube
+# The 2005 files record no span (ACS_SPAN is ''), so they are left out
+# of every cube, even though the 2005 estimates were all 1-year ones.
+
+# Requires Python3.
+
+# Copyright R. A. Reitmeyer
+# Released under the GNU Public License, version 2, or later.
+
+import os
+import sys
+import csv
+import logging
+import argparse
+
+import numpy
+import numpy.lib.format
+
+import acs_aff_colsearch
+import acs_aff_trend
+import acs_aff_values
+
+
+GEO_HEADER = ['GEO.id', 'GEO.id2', 'GEO.display-label', 'GEOTYPE']
+
+
+def build_cube(records, cube_dir, metrics=None):
+    """Write the cube for long-format acs_aff_trend records (with
+    margins) into cube_dir. Metric axis order follows `metrics` (the
+    load_metrics list) if given, else first appearance. Records must
+    all be for one span."""
+    if len(records) == 0:
+        raise ValueError('no records to build a cube from')
+    spans = set(r['ACS_SPAN'] for r in records)
+    if len(spans) > 1:
+        raise ValueError('records mix spans {0}; build one cube per span'.format(sorted(spans)))
+    metric_labels = []
+    for m in (metrics or records):
+        if m['METRIC'] not in metric_labels:
+            metric_labels.append(m['METRIC'])
+    metric_index = {m: i for i, m in enumerate(metric_labels)}
+    years = sorted(set(r['ACS_YEAR'] for r in records))
+    year_index = {y: i for i, y in enumerate(years)}
+    geographies = []
+    geo_index = {}
+    for r in records:
+        if r['GEO.id'] not in geo_index:
+            geo_index[r['GEO.id']] = len(geographies)
+            geographies.append({k: r[k] for k in GEO_HEADER})
+        else:
+            # keep the latest label
+            geographies[geo_index[r['GEO.id']]]['GEO.display-label'] = r['GEO.display-label']
+    shape = (len(metric_labels), len(geographies), len(years))
+    os.makedirs(cube_dir, mode=0o755, exist_ok=True)
+    planes = {}
+    for plane in ['est', 'moe']:
+        planes[plane] = numpy.lib.format.open_memmap(os.path.join(cube_dir, plane+'.npy'), mode='w+', dtype=numpy.float64, shape=shape)
+        planes[plane][...] = numpy.nan
+    # scatter all the values in one vectorized assignment per plane
+    for plane, est_or_margin in [('est', 'Estimate'), ('moe', 'Margin of Error')]:
+        recs = [r for r in records if r['EST_OR_MARGIN'] == est_or_margin and r['METRIC'] in metric_index]
+        m = numpy.fromiter((metric_index[r['METRIC']] for r in recs), dtype=numpy.int64, count=len(recs))
+        g = numpy.fromiter((geo_index[r['GEO.id']] for r in recs), dtype=numpy.int64, count=len(recs))
+        y = numpy.fromiter((year_index[r['ACS_YEAR']] for r in recs), dtype=numpy.int64, count=len(recs))
+        v = acs_aff_values.parse_column([r['VALUE'] for r in recs])[0]
+        planes[plane][m, g, y] = v
+        planes[plane].flush()
+    with open(os.path.join(cube_dir, 'metrics.txt'), 'w', encoding='utf-8') as fp:
+        fp.write(''.join(m+'\n' for m in metric_labels))
+    with open(os.path.join(cube_dir, 'years.txt'), 'w', encoding='utf-8') as fp:
+        fp.write(''.join(y+'\n' for y in years))
+    with open(os.path.join(cube_dir, 'geographies.csv'), 'w', encoding='utf-8', newline='') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(GEO_HEADER)
+        for geo in geographies:
+            writer.writerow([geo[k] for k in GEO_HEADER])
+    logging.info('build_cube: %s metrics x geographies x years', shape)
+    return shape
+
+
+class Cube(object):
+    """A cube directory opened memory-mapped, with label indexes.
+    est and moe are (metric, geography, year) arrays; the slicing
+    methods return views, not copies."""
+    def __init__(self, cube_dir, mmap_mode='r'):
+        self.est = numpy.load(os.path.join(cube_dir, 'est.npy'), mmap_mode=mmap_mode)
+        self.moe = numpy.load(os.path.join(cube_dir, 'moe.npy'), mmap_mode=mmap_mode)
+        with open(os.path.join(cube_dir, 'metrics.txt'), 'r', encoding='utf-8') as fp:
+            self.metrics = [l.rstrip('\n') for l in fp]
+        with open(os.path.join(cube_dir, 'years.txt'), 'r', encoding='utf-8') as fp:
+            self.years = [l.rstrip('\n') for l in fp]
+        with open(os.path.join(cube_dir, 'geographies.csv'), 'r', newline='', encoding='utf-8') as fp:
+            self.geographies = list(csv.DictReader(fp))
+        self.metric_index = {m: i for i, m in enumerate(self.metrics)}
+        self.year_index = {y: i for i, y in enumerate(self.years)}
+        self.geo_index = {}
+        for i, geo in enumerate(self.geographies):
+            self.geo_index[geo['GEO.id']] = i
+            self.geo_index[geo['GEO.id2']] = i
+
+    def geography(self, geo_id):
+        """All metrics and years for one geography: (est, moe), each
+        metric x year."""
+        g = self.geo_index[geo_id]
+        return self.est[:, g, :], self.moe[:, g, :]
+
+    def metric_year(self, metric, year):
+        """One metric across every geography in one year: (est, moe)."""
+        m = self.metric_index[metric]
+        y = self.year_index[str(year)]
+        return self.est[m, :, y], self.moe[m, :, y]
+
+    def metric(self, metric):
+        """One metric for every geography and year: (est, moe), each
+        geography x year."""
+        m = self.metric_index[metric]
+        return self.est[m, :, :], self.moe[m, :, :]
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Build a metric x geography x year cube.')
+    parser.add_argument('-o', dest='cube_dir', default='cube', help='output directory')
+    parser.add_argument('-m', dest='metrics', default=acs_aff_trend.METRICS_FILENAME, help='metrics of interest file')
+    parser.add_argument('-M', dest='metadata', default='all_metadata.csv', help='assembled metadata file')
+    parser.add_argument('-s', dest='span', required=True, choices=['1', '3', '5'], help='ACS span to build the cube for (2005, with no recorded span, is never included)')
+    parser.add_argument('-g', dest='geotypes', nargs='+', choices=['places', 'non_places'], help='only these geography types')
+    parser.add_argument('-j', dest='processes', type=int, default=None, help='number of processes (default: all cores)')
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    metrics = acs_aff_trend.load_metrics(args.metrics)
+    md = acs_aff_colsearch.load_metadata(args.metadata, None, args.geotypes)
+    records = acs_aff_trend.extract_trends(metrics, md, None, args.span, True, args.processes)
+    try:
+        shape = build_cube(records, args.cube_dir, metrics)
+    except ValueError as e:
+        sys.exit('no cube written: {0}'.format(e))
+    print('cube {0} written to {1}'.format(shape, args.cube_dir))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+# Point lookups of one geography across all American Fact Finder files.
+#
+# Copyright 2016 R. A. Reitmeyer
+#
+# acs_aff_assemble_metadata.py writes geo_index.csv, which records for
+# every geography (GEO.id and GEO.id2) the _with_ann.csv files it
+# appears in, with the byte offset of its line. This tool uses that
+# index to pull one geography's values from every table and year with
+# a seek per file instead of a scan. Run as
+#     python3 acs_aff_geoindex.py 0500000US06001
+# to get every value for Alameda County, one CSV row per column.
+
+# Requires Python3.
+
+# Copyright R. A. Reitmeyer
+# Released under the GNU Public License, version 2, or later.
+
+import os
+import sys
+import csv
+import logging
+import argparse
+
+import acs_aff_colsearch
+import acs_aff_assemble_metadata
+
+
+class GeoIndex(object):
+    """In-memory form of geo_index.csv. Both GEO.id and GEO.id2 map to
+    the list of (filename, offset, row) entries for the geography.
+    File headers are read once and kept.
+    """
+    def __init__(self, index_filename=acs_aff_assemble_metadata.GEO_INDEX_FILENAME):
+        self.entries = {}
+        self.headers = {}
+        with open(index_filename, 'r', newline='', encoding='utf-8') as fp:
+            for rec in csv.DictReader(fp):
+                entry = (rec['FILENAME'], int(rec['OFFSET']), int(rec['ROW']))
+                self.entries.setdefault(rec['GEO.id'], []).append(entry)
+                if rec['GEO.id2'] != rec['GEO.id']:
+                    self.entries.setdefault(rec['GEO.id2'], []).append(entry)
+
+    def header(self, filename):
+        if filename not in self.headers:
+            with open(filename, 'r', newline='', encoding='utf-8') as fp:
+                self.headers[filename] = next(csv.reader(fp))
+        return self.headers[filename]
+
+    def lookup(self, geo_id):
+        """The (filename, offset, row) entries for a GEO.id or GEO.id2."""
+        return self.entries.get(geo_id, [])
+
+    def fetch(self, geo_id):
+        """Read a geography's row from every file it appears in. Returns
+        a list of (filename, {SHORTCOLNAME: value}) pairs."""
+        retval = []
+        for filename, offset, row in self.lookup(geo_id):
+            with open(filename, 'rb') as fp:
+                fp.seek(offset)
+                line = fp.readline().decode('utf-8')
+            values = next(csv.reader([line]))
+            retval.append((filename, dict(zip(self.header(filename), values))))
+        return retval
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Fetch one geography's values from every table and year.")
+    parser.add_argument('geo_ids', nargs='+', help='GEO.id or GEO.id2 values')
+    parser.add_argument('-i', dest='index', default=acs_aff_assemble_metadata.GEO_INDEX_FILENAME, help='geography index file')
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    index = GeoIndex(args.index)
+    recs = []
+    for geo_id in args.geo_ids:
+        for filename, values in index.fetch(geo_id):
+            acs = acs_aff_assemble_metadata.parse_ACS_filename(filename)
+            for colname, value in values.items():
+                recs.append({
+                    'GEO.id': values.get('GEO.id', ''),
+                    'ACS_YEAR': acs.get('year', ''),
+                    'ACS_SPAN': acs.get('span', ''),
+                    'TABLE': acs.get('table', ''),
+                    'SHORTCOLNAME': colname,
+                    'VALUE': value,
+                    'FILENAME': filename,
+                    })
+    acs_aff_colsearch.output(['GEO.id', 'ACS_YEAR', 'ACS_SPAN', 'TABLE', 'SHORTCOLNAME', 'VALUE', 'FILENAME'], recs)
+
+
+if __name__ == '__main__':
+    main()
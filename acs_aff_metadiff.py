@@ -0,0 +1,140 @@
+# Report per-table column changes between two ACS years.
+#
+# Copyright 2016 R. A. Reitmeyer
+#
+# When a new ACS year lands, we want to know, table by table, which
+# columns were added, removed, renumbered (same year-abstracted long
+# name, new SHORTCOLNAME) or renamed (same SHORTCOLNAME, new long name).
+# Run as
+#     python3 acs_aff_metadiff.py 2013 2014
+# to get one CSV row per changed column for every table at once.
+#
+# Every table is handled in one pass: each year's columns go into hash
+# tables keyed by (TABLE, year-abstracted LONGCOLNAME) and by (TABLE,
+# SHORTCOLNAME), and the other year is probed against them, so the cost
+# is linear in the metadata size rather than pairwise.
+
+# Requires Python3.
+
+# Copyright R. A. Reitmeyer
+# Released under the GNU Public License, version 2, or later.
+
+import os
+import sys
+import csv
+import logging
+import argparse
+
+import acs_aff_colsearch
+
+
+UNCHANGED = 'unchanged'
+ADDED = 'added'
+REMOVED = 'removed'
+RENUMBERED = 'renumbered'
+RENAMED = 'renamed'
+
+
+def year_columns(md, year, span=None):
+    """The distinct (TABLE, SHORTCOLNAME, year-abstracted LONGCOLNAME)
+    columns for one year (and optionally one span), in metadata order."""
+    seen = set()
+    retval = []
+    for rec in md:
+        if rec['ACS_YEAR'] != year:
+            continue
+        if span is not None and rec['ACS_SPAN'] != span:
+            continue
+        col = (rec['TABLE'], rec['SHORTCOLNAME'], acs_aff_colsearch.abstract_year(rec['LONGCOLNAME']))
+        if col not in seen:
+            seen.add(col)
+            retval.append(col)
+    return retval
+
+
+def diff_columns(old_cols, new_cols):
+    """Classify the change for each column between two lists of
+    (TABLE, SHORTCOLNAME, LONGCOLNAME_ar) tuples. Returns a list of
+    (TABLE, change, old column or None, new column or None).
+
+    >>> old = [('S0102', 'VC01', 'a'), ('S0102', 'VC02', 'b'), ('S0102', 'VC03', 'c'), ('S0102', 'VC04', 'd')]
+    >>> new = [('S0102', 'VC01', 'a'), ('S0102', 'VC12', 'b'), ('S0102', 'VC03', 'c2'), ('S0102', 'VC05', 'e')]
+    >>> [(t, change) for t, change, o, n in diff_columns(old, new)]
+    [('S0102', 'unchanged'), ('S0102', 'renumbered'), ('S0102', 'renamed'), ('S0102', 'added'), ('S0102', 'removed')]
+    """
+    old_by_long = {}
+    old_by_short = {}
+    for col in old_cols:
+        old_by_long.setdefault((col[0], col[2]), []).append(col)
+        old_by_short.setdefault((col[0], col[1]), []).append(col)
+    matched_old = set()
+    retval = []
+    pending = []
+    # First pass: exact matches and renumbers, probing on the long name.
+    for col in new_cols:
+        candidates = [o for o in old_by_long.get((col[0], col[2]), []) if o not in matched_old]
+        same = [o for o in candidates if o[1] == col[1]]
+        if same:
+            matched_old.add(same[0])
+            retval.append((col[0], UNCHANGED, same[0], col))
+        elif candidates:
+            matched_old.add(candidates[0])
+            retval.append((col[0], RENUMBERED, candidates[0], col))
+        else:
+            pending.append(col)
+    # Second pass: renames, probing on the short name among what's left.
+    for col in pending:
+        candidates = [o for o in old_by_short.get((col[0], col[1]), []) if o not in matched_old]
+        if candidates:
+            matched_old.add(candidates[0])
+            retval.append((col[0], RENAMED, candidates[0], col))
+        else:
+            retval.append((col[0], ADDED, None, col))
+    for col in old_cols:
+        if col not in matched_old:
+            retval.append((col[0], REMOVED, col, None))
+    return retval
+
+
+def diff_years(md, old_year, new_year, span=None, include_unchanged=False):
+    """Diff every table between two years. Returns a list of dicts, one
+    per column change, sorted by table."""
+    changes = diff_columns(year_columns(md, old_year, span), year_columns(md, new_year, span))
+    retval = []
+    for table, change, old, new in changes:
+        if change == UNCHANGED and not include_unchanged:
+            continue
+        retval.append({
+            'TABLE': table,
+            'CHANGE': change,
+            'OLD_SHORTCOLNAME': old[1] if old else '',
+            'NEW_SHORTCOLNAME': new[1] if new else '',
+            'OLD_LONGCOLNAME_ar': old[2] if old else '',
+            'NEW_LONGCOLNAME_ar': new[2] if new else '',
+            })
+    # stable sort keeps metadata order within each table
+    retval.sort(key=lambda r: r['TABLE'])
+    logging.info('metadiff %s..%s: %d changes', old_year, new_year, len(retval))
+    return retval
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Diff Census column metadata between two years.')
+    parser.add_argument('old_year', help='earlier ACS year, eg 2013')
+    parser.add_argument('new_year', help='later ACS year, eg 2014')
+    parser.add_argument('-m', dest='metadata', default='all_metadata.csv', help='assembled metadata file')
+    parser.add_argument('-s', dest='span', default=None, help='only compare this ACS span (1, 3 or 5)')
+    parser.add_argument('-a', dest='include_unchanged', action='store_true', help='also report unchanged columns')
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    md = acs_aff_colsearch.load_metadata(args.metadata)
+    changes = diff_years(md, args.old_year, args.new_year, args.span, args.include_unchanged)
+    header = ['TABLE', 'CHANGE', 'OLD_SHORTCOLNAME', 'NEW_SHORTCOLNAME', 'OLD_LONGCOLNAME_ar', 'NEW_LONGCOLNAME_ar']
+    acs_aff_colsearch.output(header, changes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+# Generate a synthetic American Fact Finder corpus for benchmarks.
+#
+# Copyright 2016 R. A. Reitmeyer
+#
+# The real downloads run to many GB, which makes them awkward for
+# measuring acs_aff_burst.py, acs_aff_assemble_metadata.py,
+# acs_aff_colsearch.py or table_shell_extract.py. This tool writes a
+# look-alike corpus of any size:
+#     <outdir>/raw/acs_{places,non_places}_<year>_<range>.zip
+#         holding ACS_yy_1YR_<TABLE>_metadata.csv and
+#         ACS_yy_1YR_<TABLE>_with_ann.csv members (ACS_05_EST_... for
+#         2005), forty tables to a zip as AFF did
+#     <outdir>/table_shells/<year>/<TABLE>.xlsx
+#         table shells with indented descriptions
+# The same arguments always give the same zips, byte for byte, and
+# shells with the same content (openpyxl stamps the save time). Column
+# names drift between years the way the real ones do: VC numbers shift
+# in 2010, the universe prefix is dropped from 2013, subject titles are
+# title-cased in 2006-2008, and dollar amounts name the year. A few
+# cells carry annotations like (X), ***** and N. Run as
+#     python3 acs_aff_synth.py synth -y 2005 2014 -t 80 -g 500
+
+# Requires Python3.
+
+# Copyright R. A. Reitmeyer
+# Released under the GNU Public License, version 2, or later.
+
+import os
+import sys
+import io
+import csv
+import random
+import zipfile
+import logging
+import argparse
+
+
+SUBJECTS = [
+    ('SEX AND AGE', 'Total population', ['Under 5 years', '5 to 9 years', '10 to 14 years', '15 to 19 years', '20 to 24 years', '65 years and over', 'Median age (years)']),
+    ('INCOME AND BENEFITS', 'Households', ['Less than $10,000', '$10,000 to $14,999', '$200,000 or more', 'Median household income ({year} inflation-adjusted dollars)', 'Mean household income ({year} inflation-adjusted dollars)']),
+    ('EMPLOYMENT STATUS', 'Population 16 years and over', ['In labor force', 'In labor force - Civilian labor force', 'In labor force - Civilian labor force - Employed', 'In labor force - Civilian labor force - Unemployed', 'In labor force - Armed Forces', 'Not in labor force']),
+    ('HOUSEHOLDS BY TYPE', 'Households', ['Family households (families)', 'Family households (families) - Married-couple family', 'Nonfamily households', 'Average household size', 'Average family size']),
+    ('OCCUPATION', 'Civilian employed population 16 years and over', ['Management, business, science, and arts occupations', 'Service occupations', 'Sales and office occupations', 'Production, transportation, and material moving occupations']),
+    ]
+ROLLUPS = ['Total', 'Male', 'Female']
+ANNOTATIONS = ['(X)', '*****', 'N', '-', '**']
+TABLES_PER_ZIP = 40
+ZIP_DATE_TIME = (2016, 1, 1, 0, 0, 0)
+
+
+def table_name(i):
+    """Name of the i'th synthetic table.
+
+    >>> table_name(0), table_name(7)
+    ('S0100', 'S0107')
+    """
+    return 'S{0:04d}'.format(100+i)
+
+
+def acs_prefix(year, span=1):
+    """AFF file name prefix for a year.
+
+    >>> acs_prefix(2005), acs_prefix(2014)
+    ('ACS_05_EST', 'ACS_14_1YR')
+    """
+    if year == 2005:
+        return 'ACS_05_EST'
+    return 'ACS_{0:02d}_{1}YR'.format(year % 100, span)
+
+
+def table_columns(i, year):
+    """(SHORTCOLNAME, LONGCOLNAME) pairs for the data columns of the i'th
+    table in a year, estimates and margins, with the year's drift."""
+    subject, universe, lines = SUBJECTS[i % len(SUBJECTS)]
+    if 2006 <= year <= 2008:
+        subject = subject.title()
+    shift = 2 if year >= 2010 else 0
+    retval = []
+    for hc, rollup in enumerate(ROLLUPS, 1):
+        for vc, line in enumerate(lines, 1):
+            name = '{0} - {1}'.format(subject, line.format(year=year))
+            if year < 2013:
+                name = '{0} - {1}'.format(universe, name)
+            for kind, est_or_margin in [('EST', 'Estimate'), ('MOE', 'Margin of Error')]:
+                retval.append(('HC{0:02d}_{1}_VC{2:02d}'.format(hc, kind, vc+shift), '{0}; {1}; {2}'.format(rollup, est_or_margin, name)))
+    return retval
+
+
+def geographies(geotype, count):
+    """(GEO.id, GEO.id2, GEO.display-label) of synthetic places (in
+    California) or counties."""
+    if geotype == 'places':
+        return [('1600000US06{0:05d}'.format(g), '06{0:05d}'.format(g), 'Place {0} city, California'.format(g)) for g in range(count)]
+    return [('0500000US06{0:03d}'.format(g), '06{0:03d}'.format(g), 'County {0}, California'.format(g)) for g in range(count)]
+
+
+def csv_bytes(rows):
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerows(rows)
+    return out.getvalue().encode('utf-8')
+
+
+def write_member(z, name, data):
+    """Add a member with a fixed timestamp, so zips are reproducible."""
+    z.writestr(zipfile.ZipInfo(name, date_time=ZIP_DATE_TIME), data, compress_type=zipfile.ZIP_DEFLATED)
+
+
+def table_members(rnd, i, year, geos):
+    """(metadata name, metadata bytes, with_ann name, with_ann bytes) for
+    one table, year and list of geographies."""
+    prefix = '{0}_{1}'.format(acs_prefix(year), table_name(i))
+    columns = [('GEO.id', 'Id'), ('GEO.id2', 'Id2'), ('GEO.display-label', 'Geography')] + table_columns(i, year)
+    metadata = csv_bytes(columns)
+    rows = [[c[0] for c in columns], [c[1] for c in columns]]
+    for geo in geos:
+        values = []
+        for short, long in columns[3:]:
+            if rnd.random() < 0.01:
+                values.append(rnd.choice(ANNOTATIONS))
+            elif '_MOE_' in short:
+                values.append('+/-{0}'.format(rnd.randrange(1, 2000)))
+            elif 'Median' in long or 'Mean' in long or 'Average' in long:
+                values.append('{0:.1f}'.format(rnd.uniform(1, 100000)))
+            else:
+                values.append(str(rnd.randrange(0, 100000)))
+        rows.append(list(geo) + values)
+    with_ann = csv_bytes(rows)
+    return prefix+'_metadata.csv', metadata, prefix+'_with_ann.csv', with_ann
+
+
+def write_zips(raw_dir, years, tables, geo_count, seed=0):
+    """Write the acs_{places,non_places}_<year>_<range>.zip archives.
+    Returns their paths."""
+    os.makedirs(raw_dir, mode=0o755, exist_ok=True)
+    written = []
+    for geotype in ['places', 'non_places']:
+        geos = geographies(geotype, geo_count)
+        for year in years:
+            rnd = random.Random('{0}/{1}/{2}'.format(seed, geotype, year))
+            for first in range(0, tables, TABLES_PER_ZIP):
+                last = min(first+TABLES_PER_ZIP, tables) - 1
+                table_range = '{0}-{1}'.format(first+1 if first else 0, last+1)
+                path = os.path.join(raw_dir, 'acs_{0}_{1}_{2}.zip'.format(geotype, year, table_range))
+                with zipfile.ZipFile(path, 'w') as z:
+                    for i in range(first, last+1):
+                        md_name, md_data, ann_name, ann_data = table_members(rnd, i, year, geos)
+                        write_member(z, md_name, md_data)
+                        write_member(z, ann_name, ann_data)
+                written.append(path)
+    logging.info('write_zips: %d zips under %s', len(written), raw_dir)
+    return written
+
+
+def write_shells(shells_dir, years, tables):
+    """Write a table shell workbook per table and year, under
+    shells_dir/<year>/. Returns their paths."""
+    import datetime
+    import openpyxl
+    from openpyxl.styles import Alignment
+    written = []
+    for year in years:
+        year_dir = os.path.join(shells_dir, str(year))
+        os.makedirs(year_dir, mode=0o755, exist_ok=True)
+        for i in range(tables):
+            subject, universe, lines = SUBJECTS[i % len(SUBJECTS)]
+            table = table_name(i)
+            workbook = openpyxl.Workbook()
+            workbook.properties.created = workbook.properties.modified = datetime.datetime(*ZIP_DATE_TIME)
+            worksheet = workbook.active
+            worksheet.append(['Table ID', 'Line', 'Stub'])
+            worksheet.append([table, None, subject])
+            worksheet.append([table, None, 'Universe:  {0}'.format(universe)])
+            worksheet.append([table, 1, 'Total:'])
+            line = 1
+            for rollup in ROLLUPS[1:]:
+                line += 1
+                worksheet.append([table, line, rollup+':'])
+                worksheet.cell(row=worksheet.max_row, column=3).alignment = Alignment(indent=1)
+                for detail in lines:
+                    for depth, part in enumerate(detail.format(year=year).split(' - ')):
+                        line += 1
+                        worksheet.append([table, line, part])
+                        worksheet.cell(row=worksheet.max_row, column=3).alignment = Alignment(indent=2+depth)
+            path = os.path.join(year_dir, table+'.xlsx')
+            workbook.save(path)
+            written.append(path)
+    logging.info('write_shells: %d shells under %s', len(written), shells_dir)
+    return written
+
+
+def make_corpus(outdir, years, tables, geo_count, seed=0, shells=True):
+    """Write a complete synthetic corpus under outdir: raw/ zips and,
+    if shells, table_shells/. Returns {'zips': [...], 'shells': [...]}."""
+    retval = {'zips': write_zips(os.path.join(outdir, 'raw'), years, tables, geo_count, seed), 'shells': []}
+    if shells:
+        retval['shells'] = write_shells(os.path.join(outdir, 'table_shells'), years, tables)
+    return retval
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Generate a synthetic American Fact Finder corpus.')
+    parser.add_argument('outdir', help='output directory')
+    parser.add_argument('-y', dest='years', type=int, nargs=2, default=[2005, 2014], metavar=('FIRST', 'LAST'), help='range of ACS years')
+    parser.add_argument('-t', dest='tables', type=int, default=80, help='tables per year')
+    parser.add_argument('-g', dest='geographies', type=int, default=500, help='geographies per geography type')
+    parser.add_argument('--seed', dest='seed', type=int, default=0, help='random seed')
+    parser.add_argument('--no-shells', dest='shells', action='store_false', help="don't write table shells")
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    corpus = make_corpus(args.outdir, list(range(args.years[0], args.years[1]+1)), args.tables, args.geographies, args.seed, args.shells)
+    print('{0} zips and {1} shells written under {2}'.format(len(corpus['zips']), len(corpus['shells']), args.outdir))
+
+
+if __name__ == '__main__':
+    main()
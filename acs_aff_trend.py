@@ -0,0 +1,353 @@
+# Extract metrics of interest from American Fact Finder data, by year.
+#
+# Copyright 2016 R. A. Reitmeyer
+#
+# acs_aff_metrics_of_interest.csv lists, for each metric, the TABLE and
+# the SHORTCOLNAME (and LONGCOLNAME) it has had in each era, since
+# column names move around from year to year. Using the assembled
+# metadata to find the _with_ann.csv file each column lives in, this
+# tool reads just those columns out of every year's files and writes
+# one table of values. Run as
+#     python3 acs_aff_trend.py > trend.csv
+# for long format (one row per metric, year and geography) or
+#     python3 acs_aff_trend.py -w > trend.csv
+# for wide format (one row per metric and geography, one column per year),
+# or
+#     python3 acs_aff_trend.py -x trend.xlsx
+# for a workbook of the wide format with a sheet per metric.
+#
+# Files are read in parallel. Each _with_ann.csv row is only split as
+# far as the last wanted column, so the hundreds of other columns in a
+# table are never turned into fields. Results are kept in the result
+# cache (acs_result_cache.py) until the metrics file, the metadata or
+# the acs/ tree changes; --no-cache skips it.
+
+# Requires Python3.
+
+# Copyright R. A. Reitmeyer
+# Released under the GNU Public License, version 2, or later.
+
+import os
+import sys
+import re
+import csv
+import logging
+import argparse
+import concurrent.futures
+
+import acs_aff_colsearch
+import acs_aff_assemble_metadata
+import acs_result_cache
+import acs_workbook
+
+
+METRICS_FILENAME = 'acs_aff_metrics_of_interest.csv'
+GEO_COLS = ['GEO.id', 'GEO.id2', 'GEO.display-label']
+LONG_HEADER = ['METRIC', 'TABLE', 'ACS_YEAR', 'ACS_SPAN', 'GEOTYPE'] + GEO_COLS + ['SHORTCOLNAME', 'EST_OR_MARGIN', 'VALUE']
+
+
+def table_key(table):
+    """Table names are written with and without zero padding (S101 and
+    S0101); compare them by prefix and number.
+
+    >>> table_key('S101') == table_key('S0101')
+    True
+    >>> table_key('S0101PR') == table_key('S0101')
+    False
+    """
+    m = re.match('(?P<prefix>[A-Z]+)(?P<number>[0-9]+)(?P<suffix>.*)$', table)
+    if m is None:
+        return (table, 0, '')
+    return (m.group('prefix'), int(m.group('number')), m.group('suffix'))
+
+
+def margin_colname(shortcolname):
+    """The margin of error column that goes with an estimate column.
+
+    >>> margin_colname('HC01_EST_VC33')
+    'HC01_MOE_VC33'
+    >>> margin_colname('HD01_VD03')
+    'HD02_VD03'
+    """
+    if '_EST_' in shortcolname:
+        return shortcolname.replace('_EST_', '_MOE_')
+    return re.sub('^HD01_', 'HD02_', shortcolname)
+
+
+def load_metrics(metrics_filename=METRICS_FILENAME):
+    """Load the metrics of interest. Each metric is a dict with METRIC
+    (the "Interesting Metric" text, or its first long name if that's
+    blank), TABLE, NOTES, and 'shortcolnames' / 'longcolnames': lists of
+    (first year, name) for each era the name applies from.
+    """
+    retval = []
+    with open(metrics_filename, 'r', newline='', encoding='utf-8') as fp:
+        reader = csv.reader(fp)
+        header = next(reader)
+        short_eras = []
+        long_eras = []
+        for i, h in enumerate(header):
+            m = re.search('(?P<year>[0-9]{4})', h)
+            if m and h.startswith('SHORTCOLNAME'):
+                short_eras.append((i, int(m.group('year'))))
+            elif m and h.startswith('LONGCOLNAME'):
+                long_eras.append((i, int(m.group('year'))))
+        metric_col = header.index('Interesting Metric')
+        notes_col = header.index('NOTES')
+        for row in reader:
+            if row[0] == '':
+                continue # a note, not a metric
+            shortcolnames = [(year, row[i]) for i, year in short_eras if row[i] != '']
+            longcolnames = [(year, row[i]) for i, year in long_eras if row[i] != '']
+            retval.append({
+                'METRIC': row[metric_col] or (longcolnames[0][1] if longcolnames else shortcolnames[0][1]),
+                'TABLE': row[0],
+                'NOTES': row[notes_col],
+                'shortcolnames': shortcolnames,
+                'longcolnames': longcolnames,
+                })
+    return retval
+
+
+def era_value(eras, year):
+    """The name in effect for a year, from a list of (first year, name).
+
+    >>> era_value([(2005, 'HC01_EST_VC33'), (2010, 'HC01_EST_VC35')], 2009)
+    'HC01_EST_VC33'
+    >>> era_value([(2005, 'HC01_EST_VC33'), (2010, 'HC01_EST_VC35')], 2014)
+    'HC01_EST_VC35'
+    """
+    retval = None
+    for first_year, name in eras:
+        if first_year <= int(year):
+            retval = name
+    return retval
+
+
+def plan_reads(metrics, md, years=None, span=None, moe=False):
+    """Work out which columns to read from which files. Returns a dict
+    from _with_ann.csv filename to a dict with the file's ACS_YEAR,
+    ACS_SPAN, GEOTYPE and 'columns': {SHORTCOLNAME: [(metric, EST_OR_MARGIN)]}.
+    """
+    by_table = {}
+    for metric in metrics:
+        by_table.setdefault(table_key(metric['TABLE']), []).append(metric)
+    retval = {}
+    for rec in md:
+        if years is not None and rec['ACS_YEAR'] not in years:
+            continue
+        if span is not None and rec['ACS_SPAN'] != span:
+            continue
+        for metric in by_table.get(table_key(rec['TABLE']), []):
+            shortcolname = era_value(metric['shortcolnames'], rec['ACS_YEAR'])
+            if shortcolname is None:
+                continue
+            wanted = [(shortcolname, 'Estimate')]
+            if moe:
+                wanted.append((margin_colname(shortcolname), 'Margin of Error'))
+            for colname, est_or_margin in wanted:
+                if rec['SHORTCOLNAME'] != colname:
+                    continue
+                longcolname = era_value(metric['longcolnames'], rec['ACS_YEAR'])
+                if est_or_margin == 'Estimate' and longcolname is not None and longcolname != rec['LONGCOLNAME']:
+                    logging.warning('%s %s %s: long name is %r, metrics file says %r', rec['ACS_YEAR'], rec['TABLE'], colname, rec['LONGCOLNAME'], longcolname)
+                f = retval.setdefault(rec['FILENAME'], {
+                    'ACS_YEAR': rec['ACS_YEAR'],
+                    'ACS_SPAN': rec['ACS_SPAN'],
+                    'TABLE': rec['TABLE'],
+                    'GEOTYPE': acs_aff_assemble_metadata.geotype_of(rec['FILENAME']),
+                    'columns': {},
+                    })
+                targets = f['columns'].setdefault(colname, [])
+                if (metric['METRIC'], est_or_margin) not in targets:
+                    targets.append((metric['METRIC'], est_or_margin))
+    return retval
+
+
+def split_fields(line, n):
+    """The first n fields of a CSV line. Quoted fields are parsed one at
+    a time; once there are no more quotes the rest of the line is split
+    with a single str.split bounded at n fields, so columns past the
+    last one wanted are never split out. A short line gives fewer.
+
+    >>> split_fields('"0500000US06001","06001","Alameda County, California",1,2,3,4\\r\\n', 5)
+    ['0500000US06001', '06001', 'Alameda County, California', '1', '2']
+    >>> split_fields('a,"x""y",z', 3)
+    ['a', 'x"y', 'z']
+    >>> split_fields('a,b', 3)
+    ['a', 'b']
+    """
+    line = line.rstrip('\r\n')
+    fields = []
+    pos = 0
+    while len(fields) < n:
+        if line.startswith('"', pos):
+            end = pos + 1
+            while True:
+                end = line.find('"', end)
+                if end == -1:
+                    raise ValueError('unterminated quoted field: '+line)
+                if line.startswith('"', end+1):
+                    end += 2
+                    continue
+                break
+            fields.append(line[pos+1:end].replace('""', '"'))
+            pos = end + 2
+            if pos > len(line):
+                break
+        elif line.find('"', pos) == -1:
+            fields += line[pos:].split(',', n - len(fields))[:n - len(fields)]
+            break
+        else:
+            comma = line.find(',', pos)
+            if comma == -1:
+                fields.append(line[pos:])
+                break
+            fields.append(line[pos:comma])
+            pos = comma + 1
+    return fields
+
+
+def read_columns(filename, colnames):
+    """Read the GEO columns and the named columns from a _with_ann.csv
+    file. The first header row has the short column names; the second
+    has the long names and is skipped. Returns a list of (GEO.id,
+    GEO.id2, GEO.display-label, {colname: value}) tuples. Rows too
+    short to hold every wanted column (a truncated file, say) are
+    logged and skipped.
+    """
+    retval = []
+    with open(filename, 'r', newline='', encoding='utf-8') as fp:
+        header = next(csv.reader([fp.readline()]))
+        fp.readline() # long column names
+        idx = [header.index(c) for c in GEO_COLS]
+        wanted = [(c, header.index(c)) for c in colnames if c in header]
+        missing = [c for c in colnames if c not in header]
+        if missing:
+            logging.warning('%s: no columns %s', filename, missing)
+        n = max(idx + [i for c, i in wanted]) + 1
+        for lineno, line in enumerate(fp, 3):
+            if line.strip() == '':
+                continue
+            fields = split_fields(line, n)
+            if len(fields) < n:
+                logging.warning('%s: line %d has %d of the %d fields needed; skipped', filename, lineno, len(fields), n)
+                continue
+            retval.append((fields[idx[0]], fields[idx[1]], fields[idx[2]], {c: fields[i] for c, i in wanted}))
+    return retval
+
+
+def _read_job(job):
+    return read_columns(job[0], job[1])
+
+
+def extract_trends(metrics, md, years=None, span=None, moe=False, processes=None):
+    """Extract every metric for every year and geography. Returns a list
+    of dicts keyed by LONG_HEADER, in metric, year, file order."""
+    plan = plan_reads(metrics, md, years, span, moe)
+    filenames = sorted(plan)
+    jobs = [(fn, sorted(plan[fn]['columns'])) for fn in filenames]
+    logging.info('extract_trends: reading %d columns from %d files', sum(len(j[1]) for j in jobs), len(jobs))
+    retval = []
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        for fn, rows in zip(filenames, pool.map(_read_job, jobs)):
+            f = plan[fn]
+            for geo_id, geo_id2, label, values in rows:
+                for colname, targets in f['columns'].items():
+                    if colname not in values:
+                        continue
+                    for metric, est_or_margin in targets:
+                        retval.append({
+                            'METRIC': metric,
+                            'TABLE': f['TABLE'],
+                            'ACS_YEAR': f['ACS_YEAR'],
+                            'ACS_SPAN': f['ACS_SPAN'],
+                            'GEOTYPE': f['GEOTYPE'],
+                            'GEO.id': geo_id,
+                            'GEO.id2': geo_id2,
+                            'GEO.display-label': label,
+                            'SHORTCOLNAME': colname,
+                            'EST_OR_MARGIN': est_or_margin,
+                            'VALUE': values[colname],
+                            })
+    order = {m['METRIC']: i for i, m in enumerate(metrics)}
+    retval.sort(key=lambda r: (order[r['METRIC']], r['ACS_YEAR']))
+    return retval
+
+
+def widen(records):
+    """Pivot long records to one row per metric, span, estimate/margin
+    and geography, with a column per year. Returns (header, rows)."""
+    years = sorted(set(r['ACS_YEAR'] for r in records))
+    key_cols = ['METRIC', 'ACS_SPAN', 'EST_OR_MARGIN', 'GEOTYPE', 'GEO.id', 'GEO.id2', 'GEO.display-label']
+    rows = {}
+    for r in records:
+        key = tuple(r[k] for k in ['METRIC', 'ACS_SPAN', 'EST_OR_MARGIN', 'GEOTYPE', 'GEO.id'])
+        row = rows.setdefault(key, {k: r[k] for k in key_cols})
+        row[r['ACS_YEAR']] = r['VALUE']
+        # labels drift a little between years; keep the latest.
+        row['GEO.display-label'] = r['GEO.display-label']
+        row['GEO.id2'] = r['GEO.id2']
+    header = key_cols + years
+    return header, [{k: row.get(k, '') for k in header} for row in rows.values()]
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Extract metrics of interest across years.')
+    parser.add_argument('-m', dest='metrics', default=METRICS_FILENAME, help='metrics of interest file')
+    parser.add_argument('-M', dest='metadata', default='all_metadata.csv', help='assembled metadata file')
+    parser.add_argument('-y', dest='years', nargs='+', help='only these ACS years')
+    parser.add_argument('-s', dest='span', default=None, help='only this ACS span (1, 3 or 5)')
+    parser.add_argument('-g', dest='geotypes', nargs='+', choices=['places', 'non_places'], help='only these geography types')
+    parser.add_argument('-e', dest='moe', action='store_false', help='estimates only, without margins of error')
+    parser.add_argument('-w', dest='wide', action='store_true', help='wide output, one column per year')
+    parser.add_argument('-x', dest='xlsx', default=None, help='write an Excel workbook, a sheet per metric with a column per year, to this file instead of CSV to stdout')
+    parser.add_argument('-j', dest='processes', type=int, default=None, help='number of processes (default: all cores)')
+    parser.add_argument('--no-cache', dest='cache', action='store_false', help="don't use or update the result cache")
+    return parser.parse_args(args)
+
+
+def output(args, header, rows):
+    if args.xlsx is not None:
+        titles = acs_workbook.write_workbook(args.xlsx, acs_workbook.trend_sheets(header, rows))
+        print('{0} sheets written to {1}'.format(len(titles), args.xlsx))
+    else:
+        acs_aff_colsearch.output(header, rows)
+
+
+def main():
+    args = parse_args()
+    if args.xlsx is not None:
+        args.wide = True
+    metrics = load_metrics(args.metrics)
+    tables = sorted(set(m['TABLE'] for m in metrics))
+    rules = [{'colname': 'TABLE', 'pattern': '^(' + '|'.join('{0}0*{1}{2}'.format(*table_key(t)) for t in tables) + ')$'}]
+    if args.years is not None:
+        rules.append({'colname': 'ACS_YEAR', 'pattern': '^(' + '|'.join(args.years) + ')$'})
+    cache = acs_result_cache.ResultCache()
+    key = acs_result_cache.query_key('trend', {
+        'years': args.years,
+        'span': args.span,
+        'geotypes': args.geotypes,
+        'moe': args.moe,
+        'wide': args.wide,
+        }, [args.metrics, args.metadata, acs_aff_assemble_metadata.partition_dir_for(args.metadata), 'acs'],
+        [sys.modules[__name__], acs_aff_colsearch, acs_aff_assemble_metadata])
+    if args.cache:
+        cached = cache.get(key)
+        if cached is not None:
+            output(args, *cached)
+            return
+    md = acs_aff_colsearch.load_metadata(args.metadata, rules, args.geotypes)
+    records = extract_trends(metrics, md, args.years, args.span, args.moe, args.processes)
+    if args.wide:
+        header, rows = widen(records)
+    else:
+        header, rows = LONG_HEADER, records
+    if args.cache:
+        cache.put(key, header, rows)
+    output(args, header, rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,340 @@
+# Parse American Fact Finder _with_ann.csv values a column at a time.
+#
+# Copyright 2016 R. A. Reitmeyer
+#
+# _with_ann.csv cells are mostly numbers, but carry Census annotations
+# in place of (or around) them:
+#     (X)      not applicable
+#     -        too few sample observations to compute an estimate
+#     N        not displayed, the sample being too small
+#     **       too few sample observations to compute a margin of error
+#     ***      median in an open-ended interval, so no margin of error
+#     *****    a controlled estimate, whose margin of error is 0
+#     +/-123   a margin of error, with the +/- written out
+#     2,500-   a median in the lowest or highest interval (a "jam value",
+#     250,000+ the interval's edge)
+# parse_column turns a whole column (or table) of such text into a
+# float64 array, NaN where there is no number, 0 for *****, and the edge
+# for jam values, plus a uint8 array of annotation codes (ANN_*) saying
+# which. It works on the text as a matrix of bytes, a character position
+# at a time across every cell, rather than calling float() in a
+# try/except per cell. load_with_ann reads a _with_ann.csv file straight
+# into such a matrix, splitting the CSV with NumPy too, so the cells
+# never become Python strings at all:
+#     header, geo, values, codes = load_with_ann('ACS_14_5YR_S2301_with_ann.csv')
+#     values['HC01_EST_VC01']  # a float64 array, a row per geography
+# Run as
+#     python3 acs_aff_values.py acs/places/2014/*_with_ann.csv
+# to time it against csv.reader and per-cell float().
+
+# Requires Python3.
+
+# Copyright R. A. Reitmeyer
+# Released under the GNU Public License, version 2, or later.
+
+import os
+import sys
+import csv
+import time
+import logging
+import argparse
+
+import numpy
+
+
+ANN_NONE = 0        # a plain number (or a +/- margin)
+ANN_EMPTY = 1
+ANN_NA = 2          # (X)
+ANN_DASH = 3        # -
+ANN_N = 4           # N
+ANN_NO_MOE = 5      # **
+ANN_OPEN_MOE = 6    # ***
+ANN_CONTROLLED = 7  # *****
+ANN_JAM_LOW = 8     # 2,500-
+ANN_JAM_HIGH = 9    # 250,000+
+ANN_OTHER = 10      # any other text
+ANN_CODES = {'': ANN_EMPTY, '(X)': ANN_NA, '-': ANN_DASH, 'N': ANN_N, '**': ANN_NO_MOE, '***': ANN_OPEN_MOE, '*****': ANN_CONTROLLED}
+ANN_NAMES = {code: text for text, code in ANN_CODES.items()}
+ANN_NAMES.update({ANN_NONE: 'number', ANN_EMPTY: 'empty', ANN_JAM_LOW: 'jam low', ANN_JAM_HIGH: 'jam high', ANN_OTHER: 'other'})
+NUMERIC_CODES = [ANN_NONE, ANN_JAM_LOW, ANN_JAM_HIGH]
+MAX_DIGITS = 15  # exact in a float64
+POWERS_OF_TEN = 10.0 ** numpy.arange(MAX_DIGITS+1)
+GEO_COLS = ('GEO.id', 'GEO.id2', 'GEO.display-label')
+BOM = b'\xef\xbb\xbf'
+
+
+def _key(text):
+    # the first 8 bytes of ASCII text as one integer
+    return numpy.frombuffer(text.encode('ascii')[:8].ljust(8, b'\0'), dtype=numpy.uint64)[0]
+
+
+def _parse_chars(chars):
+    # chars is a (width, cells) C-ordered uint8 matrix, a row per
+    # character position, a column per cell's ASCII text (0 past its end).
+    # Returns (float64 values, uint8 codes) a cell each.
+    n = chars.shape[1]
+    result = numpy.full(n, numpy.nan)
+    codes = numpy.zeros(n, dtype=numpy.uint8)
+    if n == 0:
+        return result, codes
+    if chars.shape[0] < 8:
+        chars = numpy.vstack([chars, numpy.zeros((8-chars.shape[0], n), dtype=numpy.uint8)])
+    blank = numpy.zeros(n, dtype=bool)
+    for row in chars:
+        blank |= (row - numpy.uint8(1)) < ord(' ')
+    if blank.any():
+        # leading or trailing whitespace (or a \r): strip it, the slow way,
+        # as it's rare.
+        chars = chars.copy()
+        for i in numpy.flatnonzero(blank):
+            stripped = bytes(chars[:, i]).rstrip(b'\0').strip()
+            chars[:, i] = 0
+            chars[:len(stripped), i] = numpy.frombuffer(stripped, dtype=numpy.uint8)
+
+    # Annotations: numbers start with a digit, a sign or a point, so only
+    # the other cells are compared, 8 bytes at a time.
+    maybe = numpy.flatnonzero((chars[0] - numpy.uint8(ord('0'))) >= 10)
+    keys = numpy.ascontiguousarray(chars[:8, maybe].T).view(numpy.uint64).reshape(-1)
+    for ann, code in ANN_CODES.items():
+        codes[maybe[keys == _key(ann)]] = code
+    result[codes == ANN_CONTROLLED] = 0.0
+
+    # Numbers: working down each character position across all the
+    # cells at once. Characters that aren't part of the number
+    # (commas, the +/- of a margin, a sign, a jam value's trailing + or -)
+    # are marked skipped, and the digits accumulated into an integer
+    # that's divided by 10 to the power of the digits after the point.
+    # Up to MAX_DIGITS digits the integer and the power of ten are exact
+    # in float64, so the quotient is the same correctly rounded double
+    # float() gives.
+    width = chars.shape[0]
+    cells = numpy.arange(n)
+    lengths = (chars != 0).sum(axis=0, dtype=numpy.int16)
+    numeric = codes == ANN_NONE
+    skip = chars == ord(',')
+    margin = numeric & (chars[0] == ord('+')) & (chars[1] == ord('/')) & (chars[2] == ord('-'))
+    skip[:3, margin] = True
+    negative = numeric & ~margin & (chars[0] == ord('-'))
+    skip[0, negative | (numeric & ~margin & (chars[0] == ord('+')))] = True
+    last = chars.reshape(-1)[numpy.maximum(lengths-1, 0).astype(numpy.intp)*n + cells]
+    jam = numeric & (lengths > 1) & ((last == ord('+')) | (last == ord('-')))
+    codes[jam & (last == ord('+'))] = ANN_JAM_HIGH
+    codes[jam & (last == ord('-'))] = ANN_JAM_LOW
+    skip[lengths[jam]-1, cells[jam]] = True
+
+    mantissa = numpy.zeros(n)
+    digits = numpy.zeros(n, dtype=numpy.int16)
+    decimals = numpy.zeros(n, dtype=numpy.int16)
+    dots = numpy.zeros(n, dtype=numpy.int16)
+    bad = numpy.zeros(n, dtype=bool)
+    for i in range(width):
+        c = chars[i]
+        d = c - numpy.uint8(ord('0'))
+        digit = d < 10
+        dot = c == ord('.')
+        bad |= ~(digit | dot | skip[i] | (c == 0))
+        mantissa *= digit.view(numpy.uint8)*numpy.uint8(9) + numpy.uint8(1)
+        mantissa += d*digit
+        digits += digit
+        decimals += digit & (dots > 0)
+        dots += dot
+    wanted = numpy.isin(codes, NUMERIC_CODES)
+    good = wanted & ~bad & (dots <= 1) & (digits > 0) & (digits <= MAX_DIGITS)
+    value = mantissa / POWERS_OF_TEN[numpy.minimum(decimals, MAX_DIGITS)]
+    value[negative] *= -1
+    result[good] = value[good]
+
+    # the rest (exponents, long numbers, stray text): one at a time,
+    # keeping a negative's sign so float() sees it.
+    skip[0, negative] = False
+    for i in numpy.flatnonzero(wanted & ~good):
+        try:
+            result[i] = float(bytes(chars[~skip[:, i] & (chars[:, i] != 0), i]).decode('ascii'))
+        except ValueError:
+            codes[i] = ANN_OTHER
+    return result, codes
+
+
+def parse_column(values):
+    """Parse _with_ann.csv cells: a column, or a whole table as a list of
+    rows. Returns (float64 array, uint8 annotation code array) of the same
+    shape.
+
+    >>> v, c = parse_column(['1,234', '+/-56', '(X)', '*****', '**', '250,000+', '2,500-', '-7.5', 'N', 'oops'])
+    >>> v.tolist()
+    [1234.0, 56.0, nan, 0.0, nan, 250000.0, 2500.0, -7.5, nan, nan]
+    >>> [ANN_NAMES[int(x)] for x in c]
+    ['number', 'number', '(X)', '*****', '**', 'jam high', 'jam low', 'number', 'N', 'other']
+    >>> parse_column([['0.1', '1e3'], [' 12 ', '.5'], ['', '3.']])[0].tolist()
+    [[0.1, 1000.0], [12.0, 0.5], [nan, 3.0]]
+    >>> v, c = parse_column(['-1e3', '- 5', '-1,234,567,890,123,456'])
+    >>> v.tolist(), [ANN_NAMES[int(x)] for x in c]
+    ([-1000.0, nan, -1234567890123456.0], ['number', 'other', 'number'])
+    """
+    text = numpy.asarray(values, dtype=numpy.str_)
+    points = text.reshape(-1).view(numpy.uint32).reshape(text.size, text.itemsize//4)
+    chars = points.T.astype(numpy.uint8, order='C')
+    if text.size and points.max() > 127:
+        chars[points.T > 127] = 0xff  # never part of a number
+    result, codes = _parse_chars(chars)
+    return result.reshape(text.shape), codes.reshape(text.shape)
+
+
+def parse_value(value):
+    """One cell, as parse_column would parse it.
+
+    >>> parse_value('+/-1,204'), parse_value('*****')
+    (1204.0, 0.0)
+    """
+    return float(parse_column([value])[0][0])
+
+
+def split_csv(data):
+    """Split CSV bytes (as a _with_ann.csv file has: no line breaks in
+    fields) into fields. Returns (starts, ends, columns): arrays of each
+    field's byte offsets, surrounding quotes and \\r excluded, a row after
+    another, and the number of fields in every row. Raises ValueError if
+    the rows don't all have the same number of fields.
+
+    >>> starts, ends, columns = split_csv(b'a,"b,c"\\r\\n1,2\\n')
+    >>> columns, [b'a,"b,c"\\r\\n1,2\\n'[s:e] for s, e in zip(starts, ends)]
+    (2, [b'a', b'b,c', b'1', b'2'])
+    """
+    buf = numpy.frombuffer(data, dtype=numpy.uint8)
+    first = len(BOM) if data.startswith(BOM) else 0
+    if not data.endswith(b'\n'):
+        buf = numpy.append(buf, numpy.uint8(ord('\n')))
+    # a comma or newline ends a field unless an odd number of quotes
+    # come before it.
+    quotes = numpy.flatnonzero(buf == ord('"'))
+    ends = numpy.flatnonzero((buf == ord(',')) | (buf == ord('\n')))
+    ends = ends[(numpy.searchsorted(quotes, ends) % 2 == 0) & (ends >= first)]
+    newline = buf[ends] == ord('\n')
+    starts = numpy.concatenate([[first], ends[:-1]+1])
+    rows = numpy.diff(numpy.concatenate([[-1], numpy.flatnonzero(newline)]))
+    blank = (rows == 1) & (starts[newline] == ends[newline])
+    if blank.any():
+        keep = numpy.ones(len(ends), dtype=bool)
+        keep[numpy.flatnonzero(newline)[blank]] = False
+        starts, ends, newline, rows = starts[keep], ends[keep], newline[keep], rows[~blank]
+    if len(rows) == 0:
+        return starts, ends, 0
+    if (rows != rows[0]).any():
+        raise ValueError('rows have {0} to {1} fields'.format(rows.min(), rows.max()))
+    ends = ends - (newline & (ends > starts) & (buf[ends-1] == ord('\r')))
+    quoted = (ends - starts >= 2) & (buf[starts] == ord('"')) & (buf[numpy.maximum(ends-1, 0)] == ord('"'))
+    return starts + quoted, ends - quoted, int(rows[0])
+
+
+def _field(data, start, end):
+    return data[start:end].decode('utf-8').replace('""', '"')
+
+
+def load_with_ann(filename, colnames=None, geo_cols=GEO_COLS):
+    """Read a _with_ann.csv file into typed columns. Returns (header, geo,
+    values, codes): the short column names, {geo column: list of str},
+    and {data column: float64 array} and {data column: uint8 annotation
+    code array} for colnames (default all but the geo columns), a row per
+    geography. The second header row, of long column names, is skipped."""
+    with open(filename, 'rb') as fp:
+        data = fp.read()
+    try:
+        starts, ends, columns = split_csv(data)
+    except ValueError as e:
+        logging.warning('%s: %s; reading it with the csv module', filename, e)
+        return _load_with_csv(filename, colnames, geo_cols)
+    if columns == 0:
+        return [], {}, {}, {}
+    starts = starts.reshape(-1, columns)
+    ends = ends.reshape(-1, columns)
+    header = [_field(data, s, e) for s, e in zip(starts[0], ends[0])]
+    starts = starts[2:]
+    ends = ends[2:]
+    geo = {c: [_field(data, s, e) for s, e in zip(starts[:, header.index(c)], ends[:, header.index(c)])] for c in geo_cols if c in header}
+    colnames = _colnames(filename, header, colnames, geo_cols)
+    index = [header.index(c) for c in colnames]
+    starts = starts[:, index].reshape(-1)
+    lengths = ends[:, index].reshape(-1) - starts
+    width = max(int(lengths.max()) if len(lengths) else 0, 1)
+    buf = numpy.frombuffer(data, dtype=numpy.uint8)
+    chars = numpy.empty((width, len(starts)), dtype=numpy.uint8)
+    for i in range(width):
+        buf.take(numpy.minimum(starts + i, len(buf)-1), out=chars[i])
+        chars[i, lengths <= i] = 0
+    values, codes = _parse_chars(chars)
+    values = values.reshape(-1, len(index))
+    codes = codes.reshape(-1, len(index))
+    return header, geo, {c: values[:, i] for i, c in enumerate(colnames)}, {c: codes[:, i] for i, c in enumerate(colnames)}
+
+
+def _colnames(filename, header, colnames, geo_cols):
+    if colnames is None:
+        return [c for c in header if c not in geo_cols]
+    for c in colnames:
+        if c not in header:
+            logging.warning('%s: no column %s', filename, c)
+    return [c for c in colnames if c in header]
+
+
+def _load_with_csv(filename, colnames, geo_cols):
+    with open(filename, 'r', newline='', encoding='utf-8') as fp:
+        reader = csv.reader(fp)
+        header = next(reader, [])
+        next(reader, None)  # long column names
+        rows = [row for row in reader if row]
+    geo = {c: [row[header.index(c)] for row in rows] for c in geo_cols if c in header}
+    colnames = _colnames(filename, header, colnames, geo_cols)
+    values = {}
+    codes = {}
+    for c in colnames:
+        i = header.index(c)
+        values[c], codes[c] = parse_column([row[i] if i < len(row) else '' for row in rows])
+    return header, geo, values, codes
+
+
+def _per_cell(value):
+    # the way acs_derive parsed values, a cell at a time
+    if value.strip('*') == '' and value != '':
+        return 0.0
+    try:
+        return float(value.replace(',', '').lstrip('+/-'))
+    except ValueError:
+        return numpy.nan
+
+
+def bench(paths):
+    """Time load_with_ann against csv.reader with float() per cell, over
+    each file's data columns. Returns a list of dicts."""
+    results = []
+    for path in paths:
+        start = time.perf_counter()
+        header, geo, values, codes = load_with_ann(path)
+        vectorized = time.perf_counter() - start
+        start = time.perf_counter()
+        with open(path, 'r', newline='', encoding='utf-8') as fp:
+            reader = csv.reader(fp)
+            next(reader)
+            next(reader)
+            rows = [[_per_cell(v) for v in row[len(GEO_COLS):]] for row in reader]
+        per_cell = time.perf_counter() - start
+        cells = sum(len(v) for v in values.values())
+        results.append({'file': path, 'cells': cells, 'seconds': vectorized, 'per_cell_seconds': per_cell,
+                        'speedup': per_cell/vectorized if vectorized > 0 else 0})
+    return results
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Time loading _with_ann.csv files as typed columns.')
+    parser.add_argument('paths', nargs='+', help='_with_ann.csv files')
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    print('file,cells,seconds,per_cell_seconds,speedup')
+    for r in bench(args.paths):
+        print('{file},{cells},{seconds:.4f},{per_cell_seconds:.4f},{speedup:.1f}'.format(**r))
+
+
+if __name__ == '__main__':
+    main()
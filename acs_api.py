@@ -0,0 +1,66 @@
+# One import for using the ACS tools as a library.
+#
+# Copyright 2016 R. A. Reitmeyer
+#
+# The tools are command line scripts first, but notebooks and services
+# want their pieces without the start-up cost: so
+#     import acs_api
+#     index = acs_api.MetadataIndex('all_metadata.csv')
+#     cols = index.search([acs_api.make_rule('LONGCOLNAME', 'civilian labor force')])
+# Importing this module (or any of the tools) does no I/O: logging is
+# only set up, and logs/ only created, by a tool's own main(). And each
+# name below is imported from its tool on first use, so NumPy, openpyxl,
+# requests and lxml are only loaded by the code that needs them.
+
+# Requires Python3.7 (for the module __getattr__).
+
+# Copyright R. A. Reitmeyer
+# Released under the GNU Public License, version 2, or later.
+
+import importlib
+
+
+# name -> tool module it comes from
+EXPORTS = {
+    'MetadataIndex': 'acs_aff_colsearch',
+    'load_metadata': 'acs_aff_colsearch',
+    'load_stats': 'acs_aff_colsearch',
+    'make_rule': 'acs_aff_colsearch',
+    'pattern_scan': 'acs_aff_colsearch',
+    'summarize_years': 'acs_aff_colsearch',
+    'load_metrics': 'acs_aff_trend',
+    'extract_trends': 'acs_aff_trend',
+    'widen': 'acs_aff_trend',
+    'diff_years': 'acs_aff_metadiff',
+    'link_columns': 'acs_aff_colmatch',
+    'GeoIndex': 'acs_aff_geoindex',
+    'Crosswalk': 'acs_crosswalk',
+    'Frame': 'acs_derive',
+    'derive': 'acs_derive',
+    'frame_from_trend': 'acs_derive',
+    'build_cube': 'acs_aff_cube',
+    'parse_column': 'acs_aff_values',
+    'load_with_ann': 'acs_aff_values',
+    'Cube': 'acs_aff_cube',
+    'ResultCache': 'acs_result_cache',
+    'Pipeline': 'acs_pipeline',
+    'ACSFetch': 'acs_sf_fetch',
+    'GeoFile': 'acs_sf_geo',
+    'load_sequence': 'acs_sf_load',
+    'GeoFilter': 'acs_sf_filter',
+    'Instrument': 'acs_instrument',
+    }
+
+__all__ = sorted(EXPORTS)
+
+
+def __getattr__(name):
+    if name not in EXPORTS:
+        raise AttributeError('module {0!r} has no attribute {1!r}'.format(__name__, name))
+    value = getattr(importlib.import_module(EXPORTS[name]), name)
+    globals()[name] = value  # later lookups skip __getattr__
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,208 @@
+# Crosswalk between summary-file table shell variables and American
+# Fact Finder columns.
+#
+# Copyright 2016 R. A. Reitmeyer
+#
+# table_shell_extract.py gives each summary-file variable a code (like
+# B01001_003) and an indent-derived description ("Total:; Male:; Under
+# 5 years"). acs_aff_assemble_metadata.py gives each AFF column a
+# SHORTCOLNAME (like HD01_VD03) and LONGCOLNAME ("Estimate; Total: -
+# Male: - Under 5 years"). This tool joins the two on year, table and a
+# normalized description and writes the result as crosswalk.csv. Run as
+#     python3 acs_crosswalk.py shells.csv all_metadata.csv crosswalk.csv
+#
+# The join is a hash join: the shell variables are put in a dict keyed
+# by (year, table, normalized description) and the metadata rows probe
+# it. Shell paths start at the universe total, which AFF names leave
+# out, so that level is dropped from the key (shell_key); subject tables
+# put the upper levels in the column group instead, which is probed too
+# (column_keys). Crosswalk then loads the file into dicts, so lookups in either
+# direction are constant-time.
+
+# Requires Python3.
+
+# Copyright R. A. Reitmeyer
+# Released under the GNU Public License, version 2, or later.
+
+import os
+import sys
+import re
+import csv
+import logging
+import argparse
+
+import acs_aff_colsearch
+
+
+CROSSWALK_HEADER = ['ACS_YEAR', 'TABLE', 'VARIABLE_CODE', 'SHORTCOLNAME', 'EST_OR_MARGIN', 'LONGCOLNAME_ar', 'FULL_DESC']
+
+
+def normalize_desc(segments):
+    """Normalize a description given as a list of hierarchy segments, so
+    shell and AFF spellings of the same line compare equal: years
+    abstracted, case and punctuation dropped, and any ' - ' inside a
+    segment treated as a level break.
+
+    >>> normalize_desc('Total:; Male:; Under 5 years'.split('; '))
+    'total|male|under 5 years'
+    >>> normalize_desc(['Total: - Male: - Under 5 years'])
+    'total|male|under 5 years'
+    """
+    parts = []
+    for segment in segments:
+        for s in segment.split(' - '):
+            s = re.sub('[^a-z0-9{}]+', ' ', acs_aff_colsearch.abstract_year(s).lower()).strip()
+            if s != '':
+                parts.append(s)
+    return '|'.join(parts)
+
+
+def shell_key(rec):
+    """The (year, table, normalized description) a shell record is
+    joined on. AFF names nested lines from below the universe total
+    ("Male: - Under 5 years"), while the shell path starts at it
+    ("Total:; Male:; Under 5 years"), so a leading Total segment is
+    dropped; the Total line itself keeps it.
+
+    >>> shell_key({'year': '2014', 'table.number': 'B01001', 'full_desc': 'Total:; Male:; Under 5 years'})
+    ('2014', 'B01001', 'male|under 5 years')
+    >>> shell_key({'year': '2014', 'table.number': 'B01001', 'full_desc': 'Total:'})
+    ('2014', 'B01001', 'total')
+    """
+    segments = rec['full_desc'].split('; ')
+    if len(segments) > 1 and normalize_desc(segments[:1]) == 'total':
+        segments = segments[1:]
+    return (str(rec['year']), rec['table.number'], normalize_desc(segments))
+
+
+def column_keys(rec, headings=()):
+    """The (year, table, normalized description) keys a metadata record
+    probes the shell index with, in order: its NAME, as detailed tables
+    name lines, then the subject-table layout, where the column group
+    (ROLLUP1, ROLLUP2) is the upper level of the shell path and NAME
+    starts with headings (the table's subject, its universe) that aren't
+    in the shell path. A Total column group is the universe line, dropped
+    as shell_key drops it.
+
+    >>> rec = {'ACS_YEAR': '2014', 'TABLE': 'S0101', 'NAME': 'SEX AND AGE - Under 5 years', 'ROLLUP1': 'Male', 'ROLLUP2': ''}
+    >>> [k[2] for k in column_keys(rec, {'sex and age', 'total population'})]
+    ['sex and age|under 5 years', 'male|under 5 years']
+    """
+    name = normalize_desc([rec['NAME']])
+    yield (rec['ACS_YEAR'], rec['TABLE'], name)
+    parts = name.split('|')
+    while parts and parts[0] in headings:
+        parts = parts[1:]
+    rollups = [normalize_desc([rec.get(r, '')]) for r in ['ROLLUP1', 'ROLLUP2']]
+    rollups = [r for r in rollups if r not in ['', 'total']]
+    if parts and len(parts) + len(rollups) > 1:
+        key = '|'.join(rollups + parts)
+        if key != name:
+            yield (rec['ACS_YEAR'], rec['TABLE'], key)
+
+
+def load_shells(shells_filename):
+    with open(shells_filename, 'r', newline='', encoding='utf-8') as fp:
+        return [ rec for rec in csv.DictReader(fp) ]
+
+
+def build_crosswalk(shells, md):
+    """Join shell records to metadata records. Returns a list of
+    crosswalk dicts keyed by CROSSWALK_HEADER, one per matched AFF
+    column (estimate and margin columns both map to the variable).
+
+    >>> shells = [{'year': '2014', 'table.number': 'B01001', 'variable.code': 'B01001_00'+n, 'full_desc': d} for n, d in [('1', 'Total:'), ('2', 'Total:; Male:'), ('3', 'Total:; Male:; Under 5 years')]]
+    >>> md = [{'ACS_YEAR': '2014', 'TABLE': 'B01001', 'SHORTCOLNAME': 'HD0{0}_VD03'.format(i), 'EST_OR_MARGIN': e, 'LONGCOLNAME': e+'; Male: - Under 5 years', 'NAME': 'Male: - Under 5 years'} for i, e in [(1, 'Estimate'), (2, 'Margin of Error')]]
+    >>> [(r['VARIABLE_CODE'], r['SHORTCOLNAME']) for r in build_crosswalk(shells, md)]
+    [('B01001_003', 'HD01_VD03'), ('B01001_003', 'HD02_VD03')]
+    """
+    shell_index = {}
+    headings = {}
+    for rec in shells:
+        shell_index.setdefault(shell_key(rec), rec)
+        h = headings.setdefault((str(rec['year']), rec['table.number']), set())
+        h.add(normalize_desc([rec.get('table.name', '')]))
+        h.add(normalize_desc([rec.get('population', '').replace('Universe:', '')]))
+    retval = []
+    seen = set()
+    probes = 0
+    for rec in md:
+        if rec['NAME'] == '':
+            continue
+        probes += 1
+        shell = None
+        for key in column_keys(rec, headings.get((rec['ACS_YEAR'], rec['TABLE']), ())):
+            shell = shell_index.get(key)
+            if shell is not None:
+                break
+        if shell is None:
+            continue
+        out = (rec['ACS_YEAR'], rec['TABLE'], shell['variable.code'], rec['SHORTCOLNAME'])
+        if out in seen:
+            continue # same column in another geography type or span
+        seen.add(out)
+        retval.append({
+            'ACS_YEAR': rec['ACS_YEAR'],
+            'TABLE': rec['TABLE'],
+            'VARIABLE_CODE': shell['variable.code'],
+            'SHORTCOLNAME': rec['SHORTCOLNAME'],
+            'EST_OR_MARGIN': rec['EST_OR_MARGIN'],
+            'LONGCOLNAME_ar': acs_aff_colsearch.abstract_year(rec['LONGCOLNAME']),
+            'FULL_DESC': shell['full_desc'],
+            })
+    logging.info('build_crosswalk: %d shell lines, %d metadata columns, %d matched', len(shell_index), probes, len(retval))
+    return retval
+
+
+def write_crosswalk(crosswalk, output_filename):
+    with open(output_filename, 'w', encoding='utf-8', newline='') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(CROSSWALK_HEADER)
+        for rec in crosswalk:
+            writer.writerow([rec[k] for k in CROSSWALK_HEADER])
+
+
+class Crosswalk(object):
+    """In-memory index over a crosswalk file. Lookups by variable code,
+    by AFF short column and by year-abstracted long name are dict hits.
+    """
+    def __init__(self, crosswalk_filename='crosswalk.csv'):
+        self.by_variable = {}
+        self.by_shortcolname = {}
+        self.by_longcolname = {}
+        with open(crosswalk_filename, 'r', newline='', encoding='utf-8') as fp:
+            for rec in csv.DictReader(fp):
+                self.by_variable.setdefault((rec['ACS_YEAR'], rec['VARIABLE_CODE']), []).append(rec)
+                self.by_shortcolname[(rec['ACS_YEAR'], rec['TABLE'], rec['SHORTCOLNAME'])] = rec
+                self.by_longcolname.setdefault(rec['LONGCOLNAME_ar'], []).append(rec)
+
+    def columns_for_variable(self, year, variable_code):
+        """AFF columns (estimate and margin) for a shell variable."""
+        return self.by_variable.get((str(year), variable_code), [])
+
+    def variable_for_column(self, year, table, shortcolname):
+        """The crosswalk record for an AFF column, or None."""
+        return self.by_shortcolname.get((str(year), table, shortcolname))
+
+    def columns_for_longname(self, longcolname):
+        """Every year's crosswalk records for a long column name; years in
+        the name are abstracted first, so any year's spelling works."""
+        return self.by_longcolname.get(acs_aff_colsearch.abstract_year(longcolname), [])
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Build the table shell / AFF column crosswalk.')
+    parser.add_argument('shells', help='CSV from table_shell_extract.py')
+    parser.add_argument('metadata', nargs='?', default='all_metadata.csv', help='assembled metadata file')
+    parser.add_argument('output', nargs='?', default='crosswalk.csv', help='crosswalk file to write')
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    md = acs_aff_colsearch.load_metadata(args.metadata)
+    write_crosswalk(build_crosswalk(load_shells(args.shells), md), args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,337 @@
+# Derived metrics from ACS estimates, with margin of error propagation.
+#
+# Copyright 2016 R. A. Reitmeyer
+#
+# Sums of age brackets, ratios, proportions and the like need their
+# margins of error propagated with the Census Bureau's approximations
+# (ACS "Instructions for Applying Statistical Testing" / Appendix 3 of
+# the ACS handbooks):
+#     sum, difference  MOE = sqrt(sum of MOE^2)
+#     proportion p=a/b MOE = sqrt(MOE_a^2 - p^2 MOE_b^2) / b
+#                      (the ratio formula when the radicand is negative)
+#     ratio r=a/b      MOE = sqrt(MOE_a^2 + r^2 MOE_b^2) / b
+#     product a*b      MOE = sqrt(a^2 MOE_b^2 + b^2 MOE_a^2)
+# Formulas are written over short column names, eg
+#     under_10 = HC01_EST_VC03 + HC01_EST_VC04
+#     pct_under_10 = proportion(HC01_EST_VC03 + HC01_EST_VC04, HC01_EST_VC01)
+# and each estimate is paired with its margin automatically. A short
+# name used by more than one table is written qualified, as
+# S0101.HC01_EST_VC01. Every formula is evaluated as whole-array NumPy
+# operations over all geographies and years at once. Run as
+#     python3 acs_aff_trend.py > trend.csv
+#     python3 acs_derive.py trend.csv -f "under_10 = HC01_EST_VC03 + HC01_EST_VC04"
+
+# Requires Python3.
+
+# Copyright R. A. Reitmeyer
+# Released under the GNU Public License, version 2, or later.
+
+import os
+import sys
+import re
+import ast
+import csv
+import logging
+import argparse
+
+import numpy
+
+import acs_aff_colsearch
+import acs_aff_trend
+import acs_aff_values
+
+
+# Keys identifying one cell (a geography in a year) of a frame built
+# from acs_aff_trend output.
+TREND_KEY = ['ACS_YEAR', 'ACS_SPAN', 'GEOTYPE', 'GEO.id', 'GEO.id2', 'GEO.display-label']
+
+
+class Quantity(object):
+    """An estimate array and its margin of error array. Arithmetic on
+    quantities propagates the margins with the Census formulas."""
+    def __init__(self, est, moe):
+        self.est = numpy.asarray(est, dtype=numpy.float64)
+        self.moe = numpy.asarray(moe, dtype=numpy.float64)
+
+    def __add__(self, other):
+        return total([self, as_quantity(other)])
+
+    def __radd__(self, other):
+        return total([as_quantity(other), self])
+
+    def __sub__(self, other):
+        return difference(self, as_quantity(other))
+
+    def __rsub__(self, other):
+        return difference(as_quantity(other), self)
+
+    def __mul__(self, other):
+        return product(self, as_quantity(other))
+
+    def __rmul__(self, other):
+        return product(as_quantity(other), self)
+
+    def __truediv__(self, other):
+        return ratio(self, as_quantity(other))
+
+    def __rtruediv__(self, other):
+        return ratio(as_quantity(other), self)
+
+    def __neg__(self):
+        return Quantity(-self.est, self.moe)
+
+
+def as_quantity(value):
+    """Constants have no margin of error."""
+    if isinstance(value, Quantity):
+        return value
+    return Quantity(value, 0.0)
+
+
+def total(quantities):
+    """Sum of quantities: MOE is the root sum of squared MOEs.
+
+    >>> q = total([Quantity([10.0], [3.0]), Quantity([20.0], [4.0])])
+    >>> float(q.est[0]), float(q.moe[0])
+    (30.0, 5.0)
+    """
+    est = quantities[0].est
+    moe2 = quantities[0].moe**2
+    for q in quantities[1:]:
+        est = est + q.est
+        moe2 = moe2 + q.moe**2
+    return Quantity(est, numpy.sqrt(moe2))
+
+
+def difference(a, b):
+    return Quantity(a.est - b.est, numpy.sqrt(a.moe**2 + b.moe**2))
+
+
+def ratio(a, b):
+    """Ratio of two quantities that are not subsets of one another.
+
+    >>> q = ratio(Quantity([50.0], [6.0]), Quantity([100.0], [8.0]))
+    >>> float(q.est[0]), round(float(q.moe[0]), 4)
+    (0.5, 0.0721)
+    """
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        r = a.est / b.est
+        return Quantity(r, numpy.sqrt(a.moe**2 + r**2 * b.moe**2) / numpy.abs(b.est))
+
+
+def proportion(a, b):
+    """Proportion where a is a subset of b. Falls back to the ratio
+    formula for cells where the proportion formula's radicand is negative.
+
+    >>> q = proportion(Quantity([50.0], [6.0]), Quantity([100.0], [8.0]))
+    >>> float(q.est[0]), round(float(q.moe[0]), 4)
+    (0.5, 0.0447)
+    """
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        p = a.est / b.est
+        radicand = a.moe**2 - p**2 * b.moe**2
+        radicand = numpy.where(radicand < 0, a.moe**2 + p**2 * b.moe**2, radicand)
+        return Quantity(p, numpy.sqrt(radicand) / numpy.abs(b.est))
+
+
+def product(a, b):
+    return Quantity(a.est * b.est, numpy.sqrt(a.est**2 * b.moe**2 + b.est**2 * a.moe**2))
+
+
+FUNCTIONS = {
+    'sum': lambda *args: total([as_quantity(a) for a in args]),
+    'difference': lambda a, b: difference(as_quantity(a), as_quantity(b)),
+    'ratio': lambda a, b: ratio(as_quantity(a), as_quantity(b)),
+    'proportion': lambda a, b: proportion(as_quantity(a), as_quantity(b)),
+    'product': lambda a, b: product(as_quantity(a), as_quantity(b)),
+    }
+
+
+class Frame(object):
+    """A set of columns over the same cells: keys is a list of dicts
+    describing each cell (eg geography and year), columns maps a column
+    name to its Quantity, one array element per cell."""
+    def __init__(self, keys, columns):
+        self.keys = keys
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.keys)
+
+
+def parse_value(value):
+    """A _with_ann.csv cell as a float: NaN for annotations like (X) or
+    '-', and 0 for '*****' (a controlled estimate's margin of error). For
+    more than one, acs_aff_values.parse_column does a column at once."""
+    return acs_aff_values.parse_value(value)
+
+
+def frame_from_trend(records):
+    """Build a Frame from long-format acs_aff_trend records. Columns are
+    keyed by TABLE.SHORTCOLNAME of the estimate, and also by the bare
+    SHORTCOLNAME when only one table uses it. Margin records are paired
+    with their estimates through acs_aff_trend.margin_colname."""
+    cell_index = {}
+    keys = []
+    for r in records:
+        k = tuple(r[c] for c in TREND_KEY[:4])
+        if k not in cell_index:
+            cell_index[k] = len(keys)
+            keys.append({c: r[c] for c in TREND_KEY})
+    margin_of = {}
+    for r in records:
+        if r['EST_OR_MARGIN'] == 'Estimate':
+            margin_of[(r['TABLE'], acs_aff_trend.margin_colname(r['SHORTCOLNAME']))] = r['SHORTCOLNAME']
+    est = {}
+    moe = {}
+    for r in records:
+        i = cell_index[tuple(r[c] for c in TREND_KEY[:4])]
+        if r['EST_OR_MARGIN'] == 'Estimate':
+            est.setdefault((r['TABLE'], r['SHORTCOLNAME']), {})[i] = r['VALUE']
+        elif (r['TABLE'], r['SHORTCOLNAME']) in margin_of:
+            moe.setdefault((r['TABLE'], margin_of[(r['TABLE'], r['SHORTCOLNAME'])]), {})[i] = r['VALUE']
+    columns = {}
+    tables_using = {}
+    for table, name in est:
+        tables_using.setdefault(name, []).append(table)
+        e = numpy.full(len(keys), numpy.nan)
+        m = numpy.full(len(keys), numpy.nan)
+        idx = numpy.fromiter(est[(table, name)].keys(), dtype=numpy.int64)
+        e[idx] = acs_aff_values.parse_column(list(est[(table, name)].values()))[0]
+        if (table, name) in moe:
+            idx = numpy.fromiter(moe[(table, name)].keys(), dtype=numpy.int64)
+            m[idx] = acs_aff_values.parse_column(list(moe[(table, name)].values()))[0]
+        columns[table+'.'+name] = Quantity(e, m)
+    for name, tables in tables_using.items():
+        if len(tables) == 1:
+            columns[name] = columns[tables[0]+'.'+name]
+    return Frame(keys, columns)
+
+
+def frame_from_sequence(logrecno, est, moe, columns):
+    """Build a Frame from a summary-file sequence (as returned by
+    acs_sf_load.load_sequence); cells are LOGRECNOs."""
+    keys = [{'LOGRECNO': int(l)} for l in logrecno]
+    return Frame(keys, {c: Quantity(est[:, i], moe[:, i]) for i, c in enumerate(columns)})
+
+
+def aggregate(frame, by):
+    """Aggregate every column across cells sharing the values of the key
+    columns in `by` (eg ['ACS_YEAR', 'ACS_SPAN'] to total all
+    geographies per year): estimates summed, margins root-sum-of-squares.
+    Evaluate ratios and proportions on the aggregated frame, not the
+    other way round."""
+    group_index = {}
+    groups = numpy.empty(len(frame.keys), dtype=numpy.int64)
+    keys = []
+    for i, k in enumerate(frame.keys):
+        g = tuple(k[c] for c in by)
+        if g not in group_index:
+            group_index[g] = len(keys)
+            keys.append({c: k[c] for c in by})
+        groups[i] = group_index[g]
+    columns = {}
+    for name, q in frame.columns.items():
+        est = numpy.bincount(groups, weights=q.est, minlength=len(keys))
+        moe = numpy.sqrt(numpy.bincount(groups, weights=q.moe**2, minlength=len(keys)))
+        columns[name] = Quantity(est, moe)
+    return Frame(keys, columns)
+
+
+def evaluate(frame, formula):
+    """Evaluate a formula expression over a frame's columns. Allowed are
+    column names (bare or TABLE.SHORTCOLNAME), numbers, + - * / and the
+    FUNCTIONS; anything else is rejected rather than handed to eval."""
+    def walk(node):
+        if isinstance(node, ast.Expression):
+            return walk(node.body)
+        if isinstance(node, (ast.Name, ast.Attribute)):
+            if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
+                name = node.value.id + '.' + node.attr
+            elif isinstance(node, ast.Name):
+                name = node.id
+            else:
+                raise ValueError('unsupported expression in formula: '+formula)
+            if name not in frame.columns:
+                raise KeyError('no column {0} for formula {1}'.format(name, formula))
+            return frame.columns[name]
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return node.value
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            return -walk(node.operand)
+        if isinstance(node, ast.BinOp):
+            left = as_quantity(walk(node.left))
+            right = walk(node.right)
+            if isinstance(node.op, ast.Add):
+                return left + right
+            if isinstance(node.op, ast.Sub):
+                return left - right
+            if isinstance(node.op, ast.Mult):
+                return left * right
+            if isinstance(node.op, ast.Div):
+                return left / right
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS and not node.keywords:
+            return FUNCTIONS[node.func.id](*[walk(a) for a in node.args])
+        raise ValueError('unsupported expression in formula: '+formula)
+    return as_quantity(walk(ast.parse(formula, mode='eval')))
+
+
+def parse_formula(text):
+    """Split 'name = expression'.
+
+    >>> parse_formula('under_10 = HC01_EST_VC03 + HC01_EST_VC04')
+    ('under_10', 'HC01_EST_VC03 + HC01_EST_VC04')
+    """
+    name, expression = text.split('=', 1)
+    return name.strip(), expression.strip()
+
+
+def derive(frame, formulas):
+    """Evaluate (name, expression) formulas in order; later formulas may
+    use earlier results by name. Returns {name: Quantity}."""
+    retval = {}
+    for name, expression in formulas:
+        q = evaluate(frame, expression)
+        frame.columns[name] = q
+        retval[name] = q
+    return retval
+
+
+def output(frame, results):
+    """Long-format CSV to stdout: the cell keys, then NAME, ESTIMATE, MOE."""
+    key_cols = list(frame.keys[0].keys()) if frame.keys else []
+    recs = []
+    for name, q in results.items():
+        for i, k in enumerate(frame.keys):
+            rec = dict(k)
+            rec['NAME'] = name
+            rec['ESTIMATE'] = repr(float(q.est[i]))
+            rec['MOE'] = repr(float(q.moe[i]))
+            recs.append(rec)
+    acs_aff_colsearch.output(key_cols + ['NAME', 'ESTIMATE', 'MOE'], recs)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Compute derived ACS metrics with margins of error.')
+    parser.add_argument('trend', help='long-format output of acs_aff_trend.py (with margins)')
+    parser.add_argument('-f', dest='formulas', action='append', default=[], help='NAME = EXPRESSION over short column names')
+    parser.add_argument('-F', dest='formula_file', help='file of NAME = EXPRESSION lines')
+    parser.add_argument('-a', dest='aggregate', nargs='+', help='first total all geographies sharing these key columns, eg ACS_YEAR ACS_SPAN')
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    formulas = [parse_formula(f) for f in args.formulas]
+    if args.formula_file is not None:
+        with open(args.formula_file, 'r', encoding='utf-8') as fp:
+            formulas += [parse_formula(l) for l in fp if l.strip() != '' and not l.startswith('#')]
+    with open(args.trend, 'r', newline='', encoding='utf-8') as fp:
+        frame = frame_from_trend(list(csv.DictReader(fp)))
+    if args.aggregate is not None:
+        frame = aggregate(frame, args.aggregate)
+    output(frame, derive(frame, formulas))
+
+
+if __name__ == '__main__':
+    main()
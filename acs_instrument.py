@@ -0,0 +1,193 @@
+# Per-stage timers, counters and profiling shared by the ACS tools.
+#
+# Copyright 2016 R. A. Reitmeyer
+#
+# A tool wraps each phase of its work in
+#     with acs_instrument.stage('parse'):
+#         ...
+# and counts what it handles with
+#     acs_instrument.count('rows', len(rows))
+# Stages accumulate wall and CPU seconds and a call count; stages may
+# nest, and each is timed on its own. Tools add the command line options
+# with add_arguments(parser) and call start(tool, args) first thing in
+# main(). At exit a JSON report of the stages and counters is written
+# to --report (by default logs/<tool>.<timestamp>.json), and with
+#     --profile cprofile      the whole run is profiled with cProfile
+#                             (stats saved next to the report as .prof,
+#                             the top functions included in the report)
+#     --profile tracemalloc   the top allocation sites and peak traced
+#                             memory are included in the report.
+# Timers and counters belong to the main process; work done in pool
+# workers shows up in the wall time of the stage that waits on the pool.
+
+# Requires Python3.
+
+# Copyright R. A. Reitmeyer
+# Released under the GNU Public License, version 2, or later.
+
+import os
+import sys
+import io
+import json
+import time
+import atexit
+import logging
+import contextlib
+try:
+    import resource
+except ImportError:
+    # Not on Windows; the report then has no peak memory.
+    resource = None
+
+
+PROFILE_CHOICES = ['cprofile', 'tracemalloc']
+PROFILE_TOP = 25
+
+
+def maxrss_kb(who):
+    """Peak resident set size of who (resource.RUSAGE_SELF or
+    RUSAGE_CHILDREN) in kilobytes. ru_maxrss is in kilobytes on Linux
+    but bytes on macOS."""
+    maxrss = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss //= 1024
+    return maxrss
+
+
+class Instrument(object):
+    """Stage timers and counters for one run.
+
+    >>> inst = Instrument()
+    >>> with inst.stage('walk'):
+    ...     inst.count('files', 3)
+    >>> inst.count('files')
+    >>> inst.stages['walk']['calls'], inst.counters['files']
+    (1, 4)
+    """
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            s = self.stages.setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+            s['calls'] += 1
+            s['wall_seconds'] += time.perf_counter() - wall
+            s['cpu_seconds'] += time.process_time() - cpu
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        """The stages and counters so far, as a JSON-ready dict."""
+        report = {
+            'wall_seconds': time.perf_counter() - self.wall_start,
+            'cpu_seconds': time.process_time() - self.cpu_start,
+            'stages': self.stages,
+            'counters': self.counters,
+            }
+        if resource is not None:
+            report['maxrss_kb'] = maxrss_kb(resource.RUSAGE_SELF)
+            report['child_maxrss_kb'] = maxrss_kb(resource.RUSAGE_CHILDREN)
+        return report
+
+
+INSTRUMENT = Instrument()
+
+
+def stage(name):
+    """Time a block as the named stage of this run."""
+    return INSTRUMENT.stage(name)
+
+
+def count(name, n=1):
+    """Add n to the named counter of this run."""
+    INSTRUMENT.count(name, n)
+
+
+def add_arguments(parser):
+    """Add --profile and --report to an argparse parser."""
+    parser.add_argument('--profile', dest='profile', choices=PROFILE_CHOICES, default=None, help='profile the run and include the results in the report')
+    parser.add_argument('--report', dest='report', default=None, help='JSON report file (default: logs/<tool>.<timestamp>.json)')
+    return parser
+
+
+LOG_FORMAT = '%(asctime)s|%(levelno)s|%(levelname)s|%(filename)s|%(lineno)s|%(message)s'
+
+
+def setup_logging(tool, level=logging.DEBUG):
+    """Send logging to logs/<tool>.<timestamp>.log, as the command line
+    tools do. Called from main(), never at import, so importing a tool
+    as a library creates no files."""
+    os.makedirs('logs', mode=0o755, exist_ok=True)
+    logging.basicConfig(
+        filename=os.path.join('logs', os.path.basename(tool)+time.strftime('.%Y%m%d_%H%M%S.log', time.localtime())),
+        format=LOG_FORMAT,
+        level=level
+        )
+
+
+def default_report_filename(tool):
+    return os.path.join('logs', os.path.basename(tool)+time.strftime('.%Y%m%d_%H%M%S.json', time.localtime()))
+
+
+def start(tool, args=None):
+    """Start instrumenting a run of tool (usually __file__), with the
+    --profile and --report options from args if given. The report is
+    written at exit, by this process only (not by pool workers)."""
+    profile = getattr(args, 'profile', None)
+    report_filename = getattr(args, 'report', None) or default_report_filename(tool)
+    profiler = None
+    if profile == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif profile == 'tracemalloc':
+        import tracemalloc
+        tracemalloc.start()
+    atexit.register(_finish, os.getpid(), os.path.basename(tool), list(sys.argv), profile, profiler, report_filename)
+
+
+def _profile_report(profile, profiler, report_filename):
+    if profile == 'cprofile':
+        import pstats
+        profiler.disable()
+        prof_filename = os.path.splitext(report_filename)[0]+'.prof'
+        profiler.dump_stats(prof_filename)
+        stats = pstats.Stats(profiler, stream=io.StringIO())
+        top = []
+        for func, (cc, nc, tt, ct, callers) in sorted(stats.stats.items(), key=lambda kv: kv[1][3], reverse=True)[:PROFILE_TOP]:
+            top.append({'function': '{0}:{1}({2})'.format(*func), 'calls': nc, 'tottime': tt, 'cumtime': ct})
+        return {'kind': profile, 'stats_file': prof_filename, 'top_cumulative': top}
+    if profile == 'tracemalloc':
+        import tracemalloc
+        current, peak = tracemalloc.get_traced_memory()
+        top = []
+        for s in tracemalloc.take_snapshot().statistics('lineno')[:PROFILE_TOP]:
+            top.append({'line': str(s.traceback[0]), 'bytes': s.size, 'blocks': s.count})
+        tracemalloc.stop()
+        return {'kind': profile, 'peak_bytes': peak, 'current_bytes': current, 'top_allocations': top}
+    return None
+
+
+def _finish(pid, tool, argv, profile, profiler, report_filename):
+    if os.getpid() != pid:
+        return
+    report = {'tool': tool, 'argv': argv, 'finished': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    report.update(INSTRUMENT.report())
+    if os.path.dirname(report_filename):
+        os.makedirs(os.path.dirname(report_filename), mode=0o755, exist_ok=True)
+    profile_report = _profile_report(profile, profiler, report_filename)
+    if profile_report is not None:
+        report['profile'] = profile_report
+    with open(report_filename, 'w', encoding='utf-8') as fp:
+        json.dump(report, fp, indent=2)
+        fp.write('\n')
+    logging.info('instrumentation report written to %s', report_filename)
@@ -0,0 +1,396 @@
+# Build everything derived from the American Fact Finder downloads.
+#
+# Copyright 2016 R. A. Reitmeyer
+#
+# The tools form a chain: (optionally) fetch the table shells, burst the
+# AFF zips in raw/ into acs/, assemble all_metadata.csv, index the data
+# files by geography, extract the table shells and build the crosswalk.
+# This runs the chain as a graph of tasks, each with declared inputs
+# and outputs:
+#     burst:<zip>         one per zip in raw/               -> acs/<type>/<year>/...
+#     metadata:<dir>      one per acs/<type>/<year>/        -> .pipeline/metadata/<dir>.csv
+#     metadata            merges the per-directory pieces   -> all_metadata.csv (+ stats, partitions)
+#     geo_index           every _with_ann.csv               -> geo_index.csv
+#     shells              acs_sf_downloads/table_shells/    -> shells.csv
+#     crosswalk           shells.csv, all_metadata.csv      -> crosswalk.csv
+#     fetch               (only with --fetch) re-crawls the table shells
+# A task is skipped when the content of its inputs, its arguments and
+# the source of the tools it runs are unchanged since its last success
+# and its outputs still exist. Content hashes are kept in
+# .pipeline_state.json with each file's size and modification time, so
+# files that haven't been touched are not read again and a no-op rerun
+# only costs a stat per file. Tasks whose inputs are ready run
+# concurrently on a process pool; each directory's metadata piece starts
+# as soon as the zips for that directory are burst, without waiting for
+# the rest. Run as
+#     python3 acs_pipeline.py               # everything
+#     python3 acs_pipeline.py metadata -n   # what would run to rebuild all_metadata.csv
+
+# Requires Python3.
+
+# Copyright R. A. Reitmeyer
+# Released under the GNU Public License, version 2, or later.
+
+import os
+import sys
+import csv
+import json
+import hashlib
+import logging
+import argparse
+import concurrent.futures
+
+import acs_aff_burst
+import acs_aff_assemble_metadata
+
+
+STATE_FILENAME = '.pipeline_state.json'
+WORK_DIR = '.pipeline'
+SHELLS_DIR = os.path.join('acs_sf_downloads', 'table_shells')
+STAGES = ['fetch', 'burst', 'metadata', 'geo_index', 'shells', 'crosswalk']
+
+
+class FileDigests(object):
+    """Content hashes of files, remembered with each file's size and
+    modification time so unchanged files are only stat'ed."""
+    def __init__(self, table=None):
+        self.table = table if table is not None else {}
+
+    def digest(self, path):
+        st = os.stat(path)
+        entry = self.table.get(path)
+        if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return entry[2]
+        h = hashlib.sha256()
+        with open(path, 'rb') as fp:
+            for block in iter(lambda: fp.read(1024*1024), b''):
+                h.update(block)
+        self.table[path] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+        return h.hexdigest()
+
+
+def code_digest(modules):
+    """Hash of the source of the named tool modules."""
+    h = hashlib.sha256()
+    for m in modules:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), m+'.py'), 'rb') as fp:
+            h.update(fp.read())
+    return h.hexdigest()
+
+
+class Task(object):
+    """One unit of work. inputs is a function returning the input files,
+    called once the dependencies are done (so it can list their
+    outputs). outputs lists the files the task writes, or is None when
+    fn returns the list. fn must be a module-level function, since it
+    runs in a pool worker. A task with fingerprint_inputs False always
+    runs."""
+    def __init__(self, name, deps, inputs, outputs, fn, args, code, fingerprint_inputs=True):
+        self.name = name
+        self.stage = name.split(':')[0]
+        self.deps = deps
+        self.inputs = inputs
+        self.outputs = outputs
+        self.fn = fn
+        self.args = args
+        self.code = code
+        self.fingerprint_inputs = fingerprint_inputs
+
+
+def list_files(topdir, kind=None, recursive=True):
+    """Sorted files under topdir; with kind, only ACS files of that kind
+    ('_metadata.csv', '_with_ann.csv')."""
+    retval = []
+    for (dirpath, dirnames, filenames) in os.walk(topdir):
+        dirnames.sort()
+        for fn in sorted(filenames):
+            if kind is None or acs_aff_assemble_metadata.parse_ACS_filename(fn).get('kind', '') == kind:
+                retval.append(os.path.join(dirpath, fn))
+        if not recursive:
+            break
+    return retval
+
+
+def fragment_filename(acs_dir, dirpath):
+    rel = os.path.relpath(dirpath, acs_dir)
+    if rel == '.':
+        rel = '_'
+    return os.path.join(WORK_DIR, 'metadata', rel.replace(os.sep, '__')+'.csv')
+
+
+def write_fragment(dirpath, fragment):
+    """Task: the all_metadata.csv rows for the _metadata.csv files
+    directly in dirpath, written to fragment."""
+    os.makedirs(os.path.dirname(fragment), mode=0o755, exist_ok=True)
+    tmpfile = fragment+'.part'
+    with open(tmpfile, 'w', encoding='utf-8', newline='') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(acs_aff_assemble_metadata.METADATA_HEADER)
+        for path in list_files(dirpath, '_metadata.csv', recursive=False):
+            fn = os.path.basename(path)
+            writer.writerows(acs_aff_assemble_metadata.metadata_rows(dirpath, fn, acs_aff_assemble_metadata.parse_ACS_filename(fn)))
+    os.replace(tmpfile, fragment)
+
+
+def fragment_groups(fragments):
+    """(year, geotype, table, rows) groups from fragments, one per source
+    _metadata.csv file, in the order assemble_metadata would write them."""
+    for fragment in fragments:
+        with open(fragment, 'r', encoding='utf-8', newline='') as fp:
+            reader = csv.reader(fp)
+            next(reader)
+            group = []
+            for row in reader:
+                if group and row[0] != group[0][0]:
+                    yield (group[0][1], acs_aff_assemble_metadata.geotype_of(os.path.dirname(group[0][0])), group[0][3], group)
+                    group = []
+                group.append(row)
+            if group:
+                yield (group[0][1], acs_aff_assemble_metadata.geotype_of(os.path.dirname(group[0][0])), group[0][3], group)
+
+
+def merge_fragments(fragments, metadata_filename):
+    """Task: write all_metadata.csv, its stats and partitions from the
+    per-directory fragments."""
+    tmpfile = metadata_filename+'.part'
+    acs_aff_assemble_metadata.write_metadata(fragment_groups(fragments), tmpfile,
+        acs_aff_assemble_metadata.stats_filename_for(metadata_filename),
+        acs_aff_assemble_metadata.partition_dir_for(metadata_filename))
+    os.replace(tmpfile, metadata_filename)
+
+
+def extract_shells(shells_dir, output_filename):
+    """Task: table_shell_extract.extract_all, logging any failures."""
+    import table_shell_extract
+    failures = table_shell_extract.extract_all(shells_dir, output_filename)
+    for path in sorted(failures):
+        logging.warning('shells: %s: %s', path, failures[path])
+
+
+def build_crosswalk(shells_filename, metadata_filename, output_filename):
+    """Task: acs_crosswalk from the extracted shells and the metadata."""
+    import acs_crosswalk
+    import acs_aff_colsearch
+    md = acs_aff_colsearch.load_metadata(metadata_filename)
+    acs_crosswalk.write_crosswalk(acs_crosswalk.build_crosswalk(acs_crosswalk.load_shells(shells_filename), md), output_filename)
+
+
+def fetch_shells(output_dir):
+    """Task: re-crawl the table shells (files already there are kept)."""
+    import acs_sf_fetch
+    acs_sf_fetch.ACSFetch(object_dir=os.path.join(output_dir, acs_sf_fetch.OBJECT_DIR)).crawl_shells(output_dir=output_dir)
+
+
+def _run_task(fn, args):
+    return fn(*args)
+
+
+def _fingerprint_task(name, args_repr, code, paths, table):
+    """Pool worker: the fingerprint of a task with the given input
+    paths, hashing them with table as the known digests. Returns
+    (fingerprint, the digest table entries for paths)."""
+    digests = FileDigests(table)
+    inputs = [(p, digests.digest(p)) for p in paths if os.path.isfile(p)]
+    text = json.dumps([name, args_repr, code_digest(code), inputs])
+    return hashlib.sha256(text.encode('utf-8')).hexdigest(), {p: digests.table[p] for p in paths if p in digests.table}
+
+
+class Pipeline(object):
+    """The task graph over one set of inputs and outputs, all paths
+    relative to the current directory as the other tools expect."""
+    def __init__(self, raw_dir='raw', acs_dir='acs', shells_dir=SHELLS_DIR, metadata_filename='all_metadata.csv',
+                 geo_index_filename=acs_aff_assemble_metadata.GEO_INDEX_FILENAME, shells_filename='shells.csv',
+                 crosswalk_filename='crosswalk.csv', state_filename=STATE_FILENAME, processes=None):
+        self.raw_dir = raw_dir
+        self.acs_dir = acs_dir
+        self.shells_dir = shells_dir
+        self.metadata_filename = metadata_filename
+        self.geo_index_filename = geo_index_filename
+        self.shells_filename = shells_filename
+        self.crosswalk_filename = crosswalk_filename
+        self.state_filename = state_filename
+        self.processes = processes
+
+    def tasks(self, fetch=False):
+        """The task graph, as {name: Task}."""
+        tasks = {}
+        def add(task):
+            tasks[task.name] = task
+
+        burst_by_dir = {}
+        for path in list_files(self.raw_dir):
+            zinfo = acs_aff_burst.parse_zipfilename(path)
+            if zinfo == {}:
+                continue
+            name = 'burst:'+path
+            add(Task(name, [], lambda path=path: [path], None, acs_aff_burst.burst_zip, (path, self.acs_dir), ['acs_aff_burst']))
+            burst_by_dir.setdefault(os.path.join(self.acs_dir, zinfo['type'], str(zinfo['year'])), []).append(name)
+        # directories that will get metadata from a zip, or already have some
+        metadata_dirs = set(burst_by_dir)
+        metadata_dirs |= set(os.path.dirname(p) for p in list_files(self.acs_dir, '_metadata.csv'))
+        fragments = []
+        for dirpath in sorted(metadata_dirs, key=lambda d: d.split(os.sep)):
+            fragment = fragment_filename(self.acs_dir, dirpath)
+            fragments.append(fragment)
+            add(Task('metadata:'+dirpath, burst_by_dir.get(dirpath, []),
+                     lambda dirpath=dirpath: list_files(dirpath, '_metadata.csv', recursive=False), [fragment],
+                     write_fragment, (dirpath, fragment), ['acs_aff_assemble_metadata', 'acs_pipeline']))
+        metadata_outputs = [self.metadata_filename, acs_aff_assemble_metadata.stats_filename_for(self.metadata_filename),
+                            os.path.join(acs_aff_assemble_metadata.partition_dir_for(self.metadata_filename), acs_aff_assemble_metadata.CATALOG_FILENAME)]
+        add(Task('metadata', ['metadata:'+d for d in metadata_dirs], lambda: fragments, metadata_outputs,
+                 merge_fragments, (fragments, self.metadata_filename), ['acs_aff_assemble_metadata', 'acs_pipeline']))
+        all_bursts = sorted(n for n in tasks if n.startswith('burst:'))
+        add(Task('geo_index', all_bursts, lambda: list_files(self.acs_dir, '_with_ann.csv'), [self.geo_index_filename],
+                 acs_aff_assemble_metadata.build_geo_index, (self.acs_dir, self.geo_index_filename), ['acs_aff_assemble_metadata']))
+        if fetch:
+            add(Task('fetch', [], lambda: [], [], fetch_shells, (os.path.dirname(self.shells_dir) or '.',), ['acs_sf_fetch'], fingerprint_inputs=False))
+        if fetch or os.path.isdir(self.shells_dir):
+            add(Task('shells', ['fetch'] if fetch else [], lambda: list_files(self.shells_dir), [self.shells_filename],
+                     extract_shells, (self.shells_dir, self.shells_filename), ['table_shell_extract']))
+            add(Task('crosswalk', ['shells', 'metadata'], lambda: [self.shells_filename, self.metadata_filename], [self.crosswalk_filename],
+                     build_crosswalk, (self.shells_filename, self.metadata_filename, self.crosswalk_filename), ['acs_crosswalk', 'acs_pipeline']))
+        return tasks
+
+    def select(self, tasks, targets):
+        """The tasks needed for the target stages (all if None)."""
+        if targets is None:
+            return tasks
+        wanted = set()
+        todo = [n for n in tasks if tasks[n].stage in targets]
+        while todo:
+            name = todo.pop()
+            if name not in wanted:
+                wanted.add(name)
+                todo += tasks[name].deps
+        return {n: tasks[n] for n in wanted}
+
+    def load_state(self):
+        if os.path.exists(self.state_filename):
+            with open(self.state_filename, 'r', encoding='utf-8') as fp:
+                return json.load(fp)
+        return {'files': {}, 'tasks': {}}
+
+    def save_state(self, state):
+        tmpfile = self.state_filename+'.part'
+        with open(tmpfile, 'w', encoding='utf-8') as fp:
+            json.dump(state, fp)
+        os.replace(tmpfile, self.state_filename)
+
+    def forget_removed(self, state, tasks):
+        """Delete what burst and metadata tasks that no longer exist (their
+        zip or directory is gone) wrote last time."""
+        for name in list(state['tasks']):
+            if name in tasks or name.split(':')[0] not in ['burst', 'metadata'] or ':' not in name:
+                continue
+            for path in state['tasks'][name]['outputs']:
+                if os.path.isfile(path):
+                    os.remove(path)
+            del state['tasks'][name]
+            logging.info('pipeline: removed outputs of %s', name)
+
+    def run(self, targets=None, force=False, dry_run=False, fetch=False, report=print):
+        """Run (or with dry_run, just report) the tasks needed for the
+        target stages. Returns {task name: 'skip', 'run', 'failed' or
+        'blocked'}.
+
+        Fingerprints are computed in the pool too, as a check job ahead
+        of each task, so hashing a large input tree overlaps with tasks
+        already running rather than holding up the scheduler."""
+        all_tasks = self.tasks(fetch)
+        tasks = self.select(all_tasks, targets)
+        state = self.load_state()
+        digests = FileDigests(state['files'])
+        if targets is None and not dry_run:
+            self.forget_removed(state, all_tasks)
+        status = {}
+        pending = dict(tasks)
+        running = {}
+        with concurrent.futures.ProcessPoolExecutor(self.processes) as pool:
+
+            def start(task, fingerprint):
+                # skip the task, or report or submit it
+                prior = state['tasks'].get(task.name)
+                upstream_ran = dry_run and any(status.get(d) == 'run' for d in task.deps)
+                if (not force and not upstream_ran and fingerprint is not None and prior is not None and prior['fingerprint'] == fingerprint
+                        and all(os.path.exists(p) for p in prior['outputs'])):
+                    status[task.name] = 'skip'
+                elif dry_run:
+                    report('would run '+task.name)
+                    status[task.name] = 'run'
+                else:
+                    report('running '+task.name)
+                    running[pool.submit(_run_task, task.fn, task.args)] = ('run', task, fingerprint)
+
+            while pending or running:
+                ready = sorted(n for n in pending if all(status.get(d) in ['skip', 'run'] for d in tasks[n].deps))
+                for name in ready:
+                    task = pending.pop(name)
+                    if not task.fingerprint_inputs:
+                        start(task, None)
+                        continue
+                    paths = task.inputs()
+                    known = {p: digests.table[p] for p in paths if p in digests.table}
+                    running[pool.submit(_fingerprint_task, name, repr(task.args), task.code, paths, known)] = ('check', task, None)
+                blocked = [n for n in pending if any(status.get(d) in ['failed', 'blocked'] for d in tasks[n].deps)]
+                for name in blocked:
+                    del pending[name]
+                    status[name] = 'blocked'
+                if ready or blocked:
+                    continue
+                if not running:
+                    raise RuntimeError('pipeline: tasks waiting on nothing: {0}'.format(sorted(pending)))
+                done, not_done = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    kind, task, fingerprint = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logging.exception('pipeline: %s failed', task.name)
+                        report('FAILED {0}: {1}'.format(task.name, e))
+                        status[task.name] = 'failed'
+                        state['tasks'].pop(task.name, None)
+                        continue
+                    if kind == 'check':
+                        fingerprint, table = result
+                        digests.table.update(table)
+                        start(task, fingerprint)
+                        continue
+                    status[task.name] = 'run'
+                    outputs = task.outputs if task.outputs is not None else result
+                    state['tasks'][task.name] = {'fingerprint': fingerprint, 'outputs': outputs}
+                    self.save_state(state)
+        if not dry_run:
+            self.save_state(state)
+        return status
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Build everything derived from the AFF downloads, skipping what is up to date.')
+    parser.add_argument('targets', nargs='*', help='stages to bring up to date: {0} (default: all)'.format(', '.join(STAGES)))
+    parser.add_argument('-n', dest='dry_run', action='store_true', help="only say what would run")
+    parser.add_argument('-f', dest='force', action='store_true', help='run even up-to-date tasks')
+    parser.add_argument('-j', dest='processes', type=int, default=None, help='number of tasks to run at once (default: all cores)')
+    parser.add_argument('--fetch', dest='fetch', action='store_true', help='re-crawl the table shells from census.gov first')
+    parser.add_argument('--raw', dest='raw_dir', default='raw', help='directory of AFF zips')
+    parser.add_argument('--shells', dest='shells_dir', default=SHELLS_DIR, help='table shells directory')
+    args = parser.parse_args(args)
+    for t in args.targets:
+        if t not in STAGES:
+            parser.error('unknown stage {0}; choose from {1}'.format(t, ', '.join(STAGES)))
+    return args
+
+
+def main():
+    args = parse_args()
+    pipeline = Pipeline(raw_dir=args.raw_dir, shells_dir=args.shells_dir, processes=args.processes)
+    status = pipeline.run(args.targets or None, args.force, args.dry_run, args.fetch)
+    counts = {}
+    for s in status.values():
+        counts[s] = counts.get(s, 0) + 1
+    print(', '.join('{0} {1}'.format(counts[s], s) for s in sorted(counts)))
+    if counts.get('failed', 0) or counts.get('blocked', 0):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+# Cache colsearch and trend results keyed by query and inputs.
+#
+# Copyright 2016 R. A. Reitmeyer
+#
+# Iterating on a report means running the same acs_aff_colsearch.py and
+# acs_aff_trend.py queries over and over against inputs that have not
+# changed. Results are kept here, in memory (most recently used first)
+# and on disk as gzipped CSV under result_cache/, keyed by a hash of
+#     - the normalized query (rules after flip_quotes and
+#       expand_all_patterns, flags, output columns and so on), and
+#     - a fingerprint of every input (all_metadata.csv and its partitions,
+#       the metrics file, ...): path, size and modification time of each
+#       file, and
+#     - a hash of the source of the tool code that computed the result.
+# Touching or rebuilding any input, or changing the code, changes the
+# key, so stale entries are never served; they just age out. The disk cache is held under a size
+# bound by removing the least recently used entries.
+
+# Requires Python3.
+
+# Copyright R. A. Reitmeyer
+# Released under the GNU Public License, version 2, or later.
+
+import os
+import sys
+import csv
+import gzip
+import json
+import hashlib
+import logging
+import collections
+
+
+CACHE_DIR = 'result_cache'
+CACHE_MAX_BYTES = 256*1024*1024
+CACHE_MAX_MEMORY_ENTRIES = 32
+
+
+def input_fingerprint(paths):
+    """Hash of the path, size and modification time of every file in
+    paths, walking directories. A missing path hashes as absent, so
+    building it later changes the fingerprint.
+
+    >>> input_fingerprint(['/nonexistent/all_metadata.csv']) == input_fingerprint(['/nonexistent/all_metadata.csv'])
+    True
+    >>> input_fingerprint(['/nonexistent/all_metadata.csv']) == input_fingerprint([])
+    False
+    """
+    h = hashlib.sha256()
+    for path in paths:
+        if not os.path.exists(path):
+            h.update('{0}\0absent\n'.format(path).encode('utf-8', 'surrogateescape'))
+        elif os.path.isdir(path):
+            for (dirpath, dirnames, filenames) in os.walk(path):
+                dirnames.sort()
+                for fn in sorted(filenames):
+                    st = os.stat(os.path.join(dirpath, fn))
+                    h.update('{0}\0{1}\0{2}\n'.format(os.path.join(dirpath, fn), st.st_size, st.st_mtime_ns).encode('utf-8', 'surrogateescape'))
+        else:
+            st = os.stat(path)
+            h.update('{0}\0{1}\0{2}\n'.format(path, st.st_size, st.st_mtime_ns).encode('utf-8', 'surrogateescape'))
+    return h.hexdigest()
+
+
+def code_version(modules):
+    """Hash of the source of the given modules (or module filenames).
+
+    >>> code_version([__file__]) == code_version([__file__]), code_version([__file__]) == code_version([])
+    (True, False)
+    """
+    h = hashlib.sha256()
+    for m in modules:
+        filename = m if isinstance(m, str) else m.__file__
+        with open(filename, 'rb') as fp:
+            h.update(hashlib.sha256(fp.read()).digest())
+    return h.hexdigest()
+
+
+def query_key(kind, query, inputs, code=()):
+    """Cache key for a query of the given kind ('colsearch', 'trend')
+    over the given input paths, computed by the code in the given modules
+    (see code_version). query must be JSON-serializable; dict order
+    doesn't matter.
+
+    >>> query_key('colsearch', {'a': 1, 'b': [2]}, []) == query_key('colsearch', {'b': [2], 'a': 1}, [])
+    True
+    >>> query_key('colsearch', {'a': 1}, []) == query_key('trend', {'a': 1}, [])
+    False
+    """
+    text = json.dumps([kind, query, input_fingerprint(inputs), code_version(code)], sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class ResultCache(object):
+    """(header, rows) results, rows being dicts, by key. Lookups try
+    memory, then disk.
+    Values read back from disk are strings, as they would be on output.
+    """
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, max_memory_entries=CACHE_MAX_MEMORY_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_memory_entries = max_memory_entries
+        self.memory = collections.OrderedDict()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key+'.csv.gz')
+
+    def get(self, key):
+        """The cached (header, rows) for key, or None."""
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        path = self.path(key)
+        try:
+            os.utime(path)  # mark as recently used
+            with gzip.open(path, 'rt', encoding='utf-8', newline='') as fp:
+                reader = csv.reader(fp)
+                header = next(reader)
+                rows = [dict(zip(header, row)) for row in reader]
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, StopIteration, csv.Error) as e:
+            logging.warning('result cache: dropping unreadable %s: %s', path, e)
+            os.remove(path)
+            return None
+        self._remember(key, (header, rows))
+        logging.info('result cache: hit %s', key)
+        return (header, rows)
+
+    def put(self, key, header, rows):
+        """Store a result under key, atomically, then evict."""
+        rows = list(rows)
+        self._remember(key, (header, rows))
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), mode=0o755, exist_ok=True)
+        tmpfile = path+'.part.{0}'.format(os.getpid())
+        with gzip.open(tmpfile, 'wt', encoding='utf-8', newline='') as fp:
+            writer = csv.writer(fp)
+            writer.writerow(header)
+            for r in rows:
+                writer.writerow([r[k] for k in header])
+        os.replace(tmpfile, path)
+        self.evict()
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def evict(self):
+        """Remove least recently used entries from disk until the cache
+        fits in max_bytes. Returns the number removed."""
+        entries = []
+        total = 0
+        for (dirpath, dirnames, filenames) in os.walk(self.cache_dir):
+            for fn in filenames:
+                if not fn.endswith('.csv.gz'):
+                    continue
+                path = os.path.join(dirpath, fn)
+                st = os.stat(path)
+                entries.append((st.st_mtime_ns, st.st_size, path))
+                total += st.st_size
+        removed = 0
+        for (mtime, size, path) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            self.memory.pop(os.path.basename(path)[:-len('.csv.gz')], None)
+            total -= size
+            removed += 1
+        if removed:
+            logging.info('result cache: evicted %d entries', removed)
+        return removed
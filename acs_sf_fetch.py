@@ -6,18 +6,28 @@ import sys
 import logging
 import re
 import pdb
+import time
+import argparse
+import zipfile
 import contextlib
 
-import requests  # the fabulous 3rd party package from Kenneth Reitz;
-                 # see http://docs.python-requests.org/en/master/
-import lxml, lxml.etree
+import acs_instrument
+import acs_sf_objects
+import acs_sf_unpack
+
+# requests (the fabulous 3rd party package from Kenneth Reitz; see
+# http://docs.python-requests.org/en/master/) and lxml are imported when
+# first needed, as are acs_sf_filter and acs_sf_load (and so NumPy), so
+# importing this module is cheap.
 
 
 CENSUS_URL = 'http://www2.census.gov'
 CENSUS_ACS_URL = "http://www2.census.gov/programs-surveys/acs/summary_file/"
 CENSUS_SHELLS_URL = "http://www2.census.gov/programs-surveys/acs/tech_docs/table_shells"
 OUTPUT_DIR = "acs_sf_downloads"
-HTML_PARSER = lxml.etree.HTMLParser
+OBJECT_DIR = 'objects'  # under the output dir
+RETRIES = 3
+RETRY_WAIT = 2.0  # seconds before the first retry, doubling after
 
 # areas of potential interest:
 # ../tech_docs/table_shells/<year>/*  # Excel files named by table
@@ -82,7 +92,16 @@ HTML_PARSER = lxml.etree.HTMLParser
 
 
 
-SESSION = requests.Session()
+SESSION = None
+
+
+def session():
+    """The requests session shared by all fetches, made on first use."""
+    global SESSION
+    if SESSION is None:
+        import requests
+        SESSION = requests.Session()
+    return SESSION
 ALL_STATES = [
     "Alabama",
     "Alaska",
@@ -139,46 +158,165 @@ ALL_STATES = [
     ]
 
 
+def listing_details(a):
+    """(last modified, size) text from the directory listing row
+    holding link a, or ('', '') if the row doesn't have them.
+
+    >>> import lxml.etree
+    >>> row = lxml.etree.fromstring('<tr><td><img/></td><td><a href="x.pdf">x.pdf</a></td><td align="right">2016-10-20 12:34  </td><td align="right">1.2M</td><td>&#160;</td></tr>')
+    >>> listing_details(row.find('.//a'))
+    ('2016-10-20 12:34', '1.2M')
+    """
+    td = a.getparent()
+    while td is not None and td.tag != 'td':
+        td = td.getparent()
+    if td is None:
+        return '', ''
+    after = [re.sub('[ \t\n\r]+', ' ', ''.join(c.itertext())).strip() for c in td.itersiblings('td')]
+    if len(after) < 2 or not re.match('^[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}', after[0]):
+        return '', ''
+    return after[0], after[1]
+
+
 class ACSFetch(object):
-    def __init__(self, states='*', tracts_and_block_groups=False, doc_extensions=None):
+    def __init__(self, states='*', tracts_and_block_groups=False, doc_extensions=None, object_dir=None, geo_filter=None, store_dir='acs_sf_store', unpack_processes=0, years=None):
         if states == '*':
             states = ALL_STATES
         self.states = states
+        self.years = years  # None for all, else a list of year strings
+        self.retry_wait = RETRY_WAIT
         self.tracts_and_block_groups = tracts_and_block_groups
         if doc_extensions is None:
             doc_extensions = ['.pdf', '.txt', '.xls', '.xlsx', '.csv']
         self.doc_extensions = doc_extensions
+        # documentation and table shells go through the object store, if
+        # there is one; see acs_sf_objects.py
+        self.objects = None
+        if object_dir is not None:
+            self.objects = acs_sf_objects.ObjectStore(object_dir)
+        self.listing = {}  # url -> (last modified, size) as listed
+        # with a geo_filter (an acs_sf_filter.GeoFilter), tract and block
+        # group zips aren't saved; their matching rows are loaded into
+        # the acs_sf_load store at store_dir instead.
+        self.geo_filter = geo_filter
+        self.store_dir = store_dir
+        self.templates = {}
+        # with unpack_processes (None meaning all cores), saved zips are
+        # verified and extracted by a pool while the crawl goes on; call
+        # finish() to wait for it.
+        self.unpack = None
+        if unpack_processes != 0:
+            self.unpack = acs_sf_unpack.UnpackPool(unpack_processes, fetch=self.refetch)
 
 
     def join_url(self, url_components):
         return '/'.join([c.rstrip('/') for c in url_components])
 
-    def save_file(self, url, outfile, overwrite=False):
+    def retrying(self, url, fn):
+        """Call fn, again after a wait if it raises an I/O error (HTTP
+        errors and dropped connections included), up to RETRIES times."""
+        for attempt in range(RETRIES+1):
+            try:
+                return fn()
+            except IOError as e:
+                if attempt == RETRIES:
+                    raise
+                logging.warning('%s: %s; retrying', url, e)
+                acs_instrument.count('retries')
+                time.sleep(self.retry_wait * 2**attempt)
+
+    def wanted_year(self, link_text):
+        return self.years is None or link_text.strip('/') in self.years
+
+    def save_file(self, url, outfile, overwrite=False, dedupe=False):
+        """Download url to outfile, unless outfile is already there (then
+        nothing is done, and the store isn't consulted). With dedupe (and
+        an object store), a missing outfile is linked from the store
+        without a download when this same url was fetched before and the
+        index listing still shows the same modification time and size.
+        Otherwise the download is stored by content hash and outfile
+        linked to it, so identical content from other urls shares one
+        copy on disk; it is still transferred each time."""
         print('    save_file('+url+', '+outfile+')')
         if os.path.exists(outfile):
             if overwrite:
                 os.unlink(outfile)
             else:
+                acs_instrument.count('files_skipped')
                 return
-        with contextlib.closing(SESSION.get(url, stream=True)) as resp:
-            tmpfile = outfile+'.part'
-            with open(tmpfile, 'wb') as fp:
-                for data in resp.iter_content(1024*1024):
-                    fp.write(data)
-                os.rename(tmpfile, outfile)
+        objects = self.objects if dedupe else None
+        modified, size = self.listing.get(url, ('', ''))
+        if objects is not None:
+            digest = objects.lookup(url, modified, size)
+            if digest is not None:
+                objects.link(digest, outfile)
+                acs_instrument.count('transfers_skipped')
+                return
+        tmpfile = outfile+'.part'
+        def download():
+            with contextlib.closing(session().get(url, stream=True)) as resp:
+                resp.raise_for_status()
+                with open(tmpfile, 'wb') as fp:
+                    for data in resp.iter_content(1024*1024):
+                        fp.write(data)
+                        acs_instrument.count('bytes', len(data))
+        with acs_instrument.stage('download'):
+            self.retrying(url, download)
+        if objects is None:
+            os.rename(tmpfile, outfile)
+        acs_instrument.count('files')
+        if objects is not None:
+            with acs_instrument.stage('dedupe'):
+                digest, new = objects.add(tmpfile)
+                objects.link(digest, outfile)
+                objects.record(url, modified, size, digest)
+            if not new:
+                acs_instrument.count('files_deduplicated')
     
     
+    def refetch(self, url, outfile):
+        self.save_file(url, outfile, overwrite=True)
+
+
+    def save_zip(self, url, outfile):
+        """save_file, then (when unpacking) hand the zip to the pool."""
+        self.save_file(url, outfile)
+        if self.unpack is not None:
+            self.unpack.submit(url, outfile)
+            self.unpack.collect()
+
+
+    def finish(self):
+        """Wait for any zips still being verified and extracted. Returns
+        the (url, filename, error) of any that failed every retry."""
+        if self.unpack is None:
+            return []
+        return self.unpack.close()
+
+
     def fetch_index_links(self, url, in_tbl_only=True):
-        index_resp = SESSION.get(url)
-        parser = lxml.etree.HTMLParser()
-        parser.feed(index_resp.content)
-        tree = parser.close()
+        def fetch():
+            resp = session().get(url)
+            resp.raise_for_status()
+            return resp
+        with acs_instrument.stage('index_fetch'):
+            index_resp = self.retrying(url, fetch)
+        acs_instrument.count('index_pages')
+        acs_instrument.count('index_bytes', len(index_resp.content))
+        with acs_instrument.stage('index_parse'):
+            import lxml.etree
+            parser = lxml.etree.HTMLParser()
+            parser.feed(index_resp.content)
+            tree = parser.close()
         search_tree = tree
         if in_tbl_only:
             search_tree = tree.xpath('//table')
             assert(len(search_tree) == 1)
             search_tree = search_tree[0]
         retval = {a.attrib['href']:a.text for a in search_tree.iterdescendants('a') if 'href' in a.attrib}
+        for a in search_tree.iterdescendants('a'):
+            if 'href' in a.attrib:
+                self.listing[self.join_url([url, a.attrib['href']])] = listing_details(a)
         for k in retval:
             if retval[k] is not None:
                 retval[k] = re.sub('[ \t\n\r]+', ' ', retval[k]).strip()
@@ -197,7 +335,7 @@ class ACSFetch(object):
         # get all the ACS links from the main census page
         all_links = self.fetch_index_links(url)
         pat = re.compile('^[0-9]{4}/$')
-        links = [l for l in all_links if pat.search(all_links[l])]
+        links = [l for l in all_links if pat.search(all_links[l]) and self.wanted_year(all_links[l])]
         print(links)
         for l in sorted(links):
             dirname = os.path.join(shells_dir, all_links[l]) 
@@ -215,7 +353,7 @@ class ACSFetch(object):
         # get all the ACS links from the main census page
         all_links = self.fetch_index_links(census_url)
         pat = re.compile('^[0-9]{4}/$')
-        links = [l for l in all_links if pat.search(all_links[l])]
+        links = [l for l in all_links if pat.search(all_links[l]) and self.wanted_year(all_links[l])]
         print(links)
         for l in sorted(links):
             dirname = os.path.join(output_dir, all_links[l]) 
@@ -269,7 +407,7 @@ class ACSFetch(object):
             self.recursive_fetch_all(self.join_url([url,d]), subdir, extensions)
         for f in sorted(doc_links):
             filename = os.path.join(dirname, all_links[f])
-            self.save_file(self.join_url([url,f]), filename)
+            self.save_file(self.join_url([url,f]), filename, dedupe=True)
 
 
     def recursive_fetch_states(self, url, dirname):
@@ -283,9 +421,16 @@ class ACSFetch(object):
             poststate_pat = re.compile('((_All_Geographies(_Not_Tracts_Block_Groups)?)|(_Tracts_Block_Groups_Only))?\\.zip')
             
         state_zips = [s for s in all_links if poststate_pat.sub('', all_links[s]) in self.states]
+        filtered_zips = []
+        if self.geo_filter is not None:
+            import acs_sf_load
+            import acs_sf_filter
+            filtered_zips = [s for s in state_zips if acs_sf_load.zip_part(all_links[s]) == acs_sf_filter.TRACTS_PART]
         for s in sorted(state_zips):
+            if s in filtered_zips:
+                continue
             filename = os.path.join(dirname, all_links[s])
-            self.save_file(self.join_url([url,s]), filename)
+            self.save_zip(self.join_url([url,s]), filename)
             
         # Any directories? If so, fetch them.
         state_links = [s for s in all_links if all_links[s].strip('/') in self.states]
@@ -299,7 +444,12 @@ class ACSFetch(object):
         for a in sorted(all_links):
             if re.match('.*File(_)?Templates\\.zip', all_links[a]):
                 filename = os.path.join(dirname, all_links[a])
-                self.save_file(self.join_url([url,a]), filename)
+                self.save_zip(self.join_url([url,a]), filename)
+
+        # the filtered tract zips need the templates, saved just above or
+        # in a parent directory.
+        for s in sorted(filtered_zips):
+            self.filter_state_zip(self.join_url([url,s]), dirname)
 
 
         # recurse into any directory that looks like N_year or N_year_by_state,
@@ -315,6 +465,31 @@ class ACSFetch(object):
                 self.recursive_fetch_states(self.join_url([url,d]), subdir)
         
 
+    def filter_state_zip(self, url, dirname):
+        """Load the geo_filter rows of a tract and block group zip
+        straight from url into the store, without saving the zip. An
+        archive that still fails after retrying is logged and skipped."""
+        print('    filter_state_zip('+url+', '+dirname+')')
+        import acs_sf_load
+        import acs_sf_filter
+        templates_zip = acs_sf_load.nearest_templates(dirname)
+        if templates_zip is None:
+            logging.warning('%s: no templates zip to filter with', url)
+            return
+        if templates_zip not in self.templates:
+            self.templates[templates_zip] = acs_sf_load.load_templates(templates_zip)
+        def filter_archive():
+            return acs_sf_filter.filter_archive(url, self.templates[templates_zip], self.store_dir, self.geo_filter, session())
+        try:
+            with acs_instrument.stage('filter'):
+                self.retrying(url, filter_archive)
+        except (IOError, ValueError, zipfile.BadZipfile) as e:
+            logging.error('%s: could not be filtered: %s', url, e)
+            acs_instrument.count('files_filter_failed')
+            return
+        acs_instrument.count('files_filtered')
+
+
     def fetch_state(self, url, dirname, state):
         print('    fetch_state('+url+', '+dirname+', '+state+')')
         pat = re.compile('^((all_[a-z]{2}\\.zip)|([a-z]{2}_all.zip)|(geo.*\\.zip)|(g[0-9]{4}.*\\.txt)|([a-z]{2}geo\\.[0-9]{4}-[0-9]yr))$')
@@ -322,7 +497,10 @@ class ACSFetch(object):
         grab_links = [l for l in all_links if pat.match(all_links[l])]
         for g in sorted(grab_links):
             filename = os.path.join(dirname, all_links[g])
-            self.save_file(self.join_url([url,g]), filename)
+            if filename.endswith('.zip'):
+                self.save_zip(self.join_url([url,g]), filename)
+            else:
+                self.save_file(self.join_url([url,g]), filename)
             
 
         
@@ -352,6 +530,59 @@ class ACSFetch(object):
 #         # Now find the data
 #         subdir_pat = re.compile('By_State_All_Tables/$')
 #         subdir_links = [l for l in all_links if dir_pat.search(all_links[l])]
-#         find_data(url, 
-    
-    
+#         find_data(url,
+
+
+def on_server(url, server):
+    """url, moved from census.gov to another server.
+
+    >>> on_server(CENSUS_ACS_URL, 'http://localhost:8000')
+    'http://localhost:8000/programs-surveys/acs/summary_file/'
+    """
+    return server.rstrip('/') + url[len(CENSUS_URL):]
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Fetch ACS summary files and table shells from census.gov.')
+    parser.add_argument('-o', dest='output_dir', default=OUTPUT_DIR, help='download directory')
+    parser.add_argument('-s', dest='states', nargs='+', default='*', help='states to fetch, as in ALL_STATES (default: all)')
+    parser.add_argument('-y', dest='years', nargs='+', default=None, help='years to fetch (default: all)')
+    parser.add_argument('-t', dest='tracts_and_block_groups', action='store_true', help='also fetch the tracts and block groups zips')
+    parser.add_argument('--shells', dest='shells', action='store_true', help='also fetch the table shells')
+    parser.add_argument('--no-acs', dest='acs', action='store_false', help="don't fetch the summary files")
+    parser.add_argument('--census-url', dest='census_url', default=CENSUS_URL, help='server to crawl, eg an acs_sf_mirror.py replay server (default: '+CENSUS_URL+')')
+    parser.add_argument('--geo', dest='geographies', nargs='+', default=None, help='with -t, load only these geographies (state or state+county FIPS codes, or GEO.ids) from the tracts and block groups zips, into the --store')
+    parser.add_argument('--store', dest='store_dir', default='acs_sf_store', help='acs_sf_load.py store for --geo')
+    parser.add_argument('--unpack', dest='unpack', action='store_true', help='verify and extract each zip while the crawl continues, re-fetching any that fail')
+    parser.add_argument('-j', dest='processes', type=int, default=None, help='number of --unpack processes (default: all cores)')
+    parser.add_argument('--objects', dest='object_dir', default=None, help='object store sharing identical documentation and table shells on disk, and skipping re-downloads of unchanged urls (default: <output dir>/'+OBJECT_DIR+')')
+    parser.add_argument('--no-objects', dest='use_objects', action='store_false', help='save every documentation file and table shell separately')
+    acs_instrument.add_arguments(parser)
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    acs_instrument.setup_logging(__file__)
+    acs_instrument.start(__file__, args)
+    object_dir = None
+    if args.use_objects:
+        object_dir = args.object_dir or os.path.join(args.output_dir, OBJECT_DIR)
+    geo_filter = None
+    if args.geographies:
+        import acs_sf_filter
+        geo_filter = acs_sf_filter.GeoFilter.from_strings(args.geographies)
+    fetcher = ACSFetch(args.states, args.tracts_and_block_groups, object_dir=object_dir, geo_filter=geo_filter, store_dir=args.store_dir, unpack_processes=args.processes if args.unpack else 0, years=args.years)
+    if args.acs:
+        with acs_instrument.stage('crawl_acs'):
+            fetcher.crawl_acs(census_url=on_server(CENSUS_ACS_URL, args.census_url), output_dir=args.output_dir)
+    if args.shells:
+        with acs_instrument.stage('crawl_shells'):
+            fetcher.crawl_shells(url=on_server(CENSUS_SHELLS_URL, args.census_url), output_dir=args.output_dir)
+    for url, filename, error in fetcher.finish():
+        logging.error('%s from %s could not be verified: %s', filename, url, error)
+        print('failed: {0} ({1})'.format(filename, error))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+# Load only the geographies of interest from ACS tract and block group
+# archives.
+#
+# Copyright 2016 R. A. Reitmeyer
+#
+# The _Tracts_Block_Groups_Only.zip archives run to GB per state, when
+# often only the tracts of a few counties are wanted. Given a geography
+# filter (two-digit state FIPS codes, five-digit state+county FIPS codes
+# and/or GEO.ids, in either the American Fact Finder 1400000US06075...
+# form or the summary file 14000US06075... form), this tool reads an
+# archive's geography file, works out which LOGRECNOs match, and streams
+# each sequence file through, keeping just those rows. The result goes
+# into the acs_sf_load.py store, as
+#     <store>/<year>_<span>yr/<st>/tracts/seq<NNNN>/
+# plus the matching geography lines in
+#     <store>/<year>_<span>yr/<st>/tracts/<geography file name>
+# The archive may be a local file or a URL; a URL is read with HTTP range
+# requests for just the parts of the zip needed (its directory and the
+# compressed members), so the archive is never written to disk. Memory
+# use is bounded by one member's kept rows. Run as
+#     python3 acs_sf_filter.py -g 06075 06081 -o acs_sf_store \
+#         -T acs_sf_downloads/2014/data/2014_5yr_Summary_FileTemplates.zip \
+#         http://www2.census.gov/programs-surveys/acs/summary_file/2014/data/5_year_by_state/California_Tracts_Block_Groups_Only.zip
+# or let acs_sf_fetch.py do it as it crawls, with -t --geo 06075 06081.
+
+# Requires Python3.
+
+# Copyright R. A. Reitmeyer
+# Released under the GNU Public License, version 2, or later.
+
+import os
+import sys
+import re
+import io
+import zipfile
+import logging
+import argparse
+
+import numpy
+
+import acs_instrument
+import acs_sf_geo
+import acs_sf_load
+
+
+RANGE_BUFFER_SIZE = 4*1024*1024
+TRACTS_PART = 'tracts'
+
+
+def sf_geoid(geo_id):
+    """A GEO.id in summary file form: American Fact Finder ids carry a
+    two-character geographic variant after the summary level, which the
+    summary file GEOID does not.
+
+    >>> sf_geoid('1400000US06075012345'), sf_geoid('14000US06075012345')
+    ('14000US06075012345', '14000US06075012345')
+    """
+    m = re.match('^([0-9]{3})[0-9A-Z]{2}([0-9A-Z]{2})US(.*)$', geo_id)
+    if m:
+        return '{0}{1}US{2}'.format(*m.groups())
+    return geo_id
+
+
+class GeoFilter(object):
+    """Which geographies to keep: any in one of the states, counties or
+    GEO.ids given. FIPS codes are given as strings, two digits for a
+    state and five (state then county) for a county."""
+    def __init__(self, fips=(), geo_ids=()):
+        self.states = set()
+        self.counties = set()
+        for code in fips:
+            if re.match('^[0-9]{2}$', code):
+                self.states.add(code)
+            elif re.match('^[0-9]{5}$', code):
+                self.counties.add(code)
+            else:
+                raise ValueError('not a state or county FIPS code: {0}'.format(code))
+        self.geo_ids = set(sf_geoid(g) for g in geo_ids)
+
+    @classmethod
+    def from_strings(cls, values):
+        """A filter from command line values, FIPS codes and GEO.ids mixed.
+
+        >>> f = GeoFilter.from_strings(['06', '36061', '1400000US06075012345'])
+        >>> sorted(f.states), sorted(f.counties), sorted(f.geo_ids)
+        (['06'], ['36061'], ['14000US06075012345'])
+        """
+        fips = [v for v in values if 'US' not in v]
+        return cls(fips, [v for v in values if 'US' in v])
+
+    def mask(self, geo):
+        """Boolean array over the rows of an acs_sf_geo.GeoFile."""
+        keep = numpy.zeros(len(geo), dtype=bool)
+        if self.states or self.counties:
+            state = geo.field('STATE')
+            keep |= numpy.isin(state, list(self.states))
+            if self.counties:
+                keep |= numpy.isin(numpy.char.add(state, geo.field('COUNTY')), list(self.counties))
+        if self.geo_ids:
+            if 'GEOID' not in geo.records.dtype.names:
+                raise ValueError('{0}: no GEOID field in the {1} layout to filter on'.format(geo.path, geo.year))
+            keep |= numpy.isin(geo.field('GEOID'), list(self.geo_ids))
+        return keep
+
+
+class HTTPRangeFile(io.RawIOBase):
+    """A read-only, seekable file over a URL, each read an HTTP range
+    request. Wrap it in io.BufferedReader so small reads (as zipfile
+    makes for headers) don't each become a request."""
+    def __init__(self, url, session=None):
+        if session is None:
+            import requests
+            session = requests.Session()
+        self.url = url
+        self.session = session
+        resp = self.session.head(url, allow_redirects=True)
+        resp.raise_for_status()
+        if resp.headers.get('Accept-Ranges', 'bytes') != 'bytes' or 'Content-Length' not in resp.headers:
+            raise IOError('{0}: server does not support range requests'.format(url))
+        self.url = resp.url
+        self.size = int(resp.headers['Content-Length'])
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.pos = max(0, offset)
+        return self.pos
+
+    def readinto(self, b):
+        if self.pos >= self.size or len(b) == 0:
+            return 0
+        last = min(self.pos + len(b), self.size) - 1
+        resp = self.session.get(self.url, headers={'Range': 'bytes={0}-{1}'.format(self.pos, last)})
+        if resp.status_code != 206:
+            raise IOError('{0}: range request answered with status {1}'.format(self.url, resp.status_code))
+        data = resp.content
+        b[:len(data)] = data
+        self.pos += len(data)
+        acs_instrument.count('range_requests')
+        acs_instrument.count('bytes', len(data))
+        return len(data)
+
+
+def open_archive(source, session=None):
+    """A zipfile.ZipFile over a local path or, for http(s) URLs, over
+    range requests."""
+    if re.match('^https?://', source):
+        return zipfile.ZipFile(io.BufferedReader(HTTPRangeFile(source, session), RANGE_BUFFER_SIZE), 'r')
+    return zipfile.ZipFile(source, 'r')
+
+
+def geography_member(names):
+    """The fixed-width geography file among an archive's member names,
+    or None.
+
+    >>> geography_member(['e20145ca0001000.txt', 'g20145ca.csv', 'g20145ca.txt'])
+    'g20145ca.txt'
+    """
+    for name in names:
+        if name.endswith('.txt') and acs_sf_geo.parse_geo_filename(name):
+            return name
+    return None
+
+
+def filter_lines(fp, keep):
+    """The lines of a sequence file (an iterable of byte lines) whose
+    LOGRECNO, the sixth field, is in the set keep, joined.
+
+    >>> filter_lines([b'ACSSF,2014e5,ca,000,0001,0000007,1,2\\r\\n', b'ACSSF,2014e5,ca,000,0001,0000008,3,4\\r\\n'], {8})
+    b'ACSSF,2014e5,ca,000,0001,0000008,3,4\\r\\n'
+    """
+    logrecno_field = len(acs_sf_load.ID_COLUMNS) - 1
+    kept = []
+    for line in fp:
+        if int(line.split(b',', logrecno_field+1)[logrecno_field]) in keep:
+            kept.append(line)
+    return b''.join(kept)
+
+
+def filter_archive(source, templates, store_dir, geo_filter, session=None):
+    """Load the rows of one tract and block group archive matching
+    geo_filter into store_dir. Returns the list of sequence directories
+    written (none if nothing matched)."""
+    written = []
+    with open_archive(source, session) as z:
+        names = z.namelist()
+        geo_name = geography_member(names)
+        if geo_name is None:
+            raise ValueError('{0}: no geography file in archive'.format(source))
+        with acs_instrument.stage('filter_geography'):
+            info = acs_sf_geo.parse_geo_filename(geo_name)
+            geo_data = z.read(geo_name)
+            geo = acs_sf_geo.GeoFile(geo_name, info['year'], data=geo_data)
+            mask = geo_filter.mask(geo)
+            keep = set(int(n) for n in geo.logrecno()[mask])
+        logging.info('%s: %d of %d geographies match', source, len(keep), len(geo))
+        acs_instrument.count('geographies_kept', len(keep))
+        if not keep:
+            return written
+        part_dir = os.path.dirname(acs_sf_load.sequence_dir(store_dir, info['year'], info['span'], info['state'], 0, TRACTS_PART))
+        os.makedirs(part_dir, mode=0o755, exist_ok=True)
+        with open(os.path.join(part_dir, os.path.basename(geo_name)), 'wb') as fp:
+            fp.write(geo.records[mask].tobytes())
+        del geo, geo_data
+
+        members = {}
+        for name in names:
+            seq_info = acs_sf_load.parse_sequence_filename(name)
+            if seq_info:
+                members[(seq_info['seq'], seq_info['kind'])] = name
+        for (seq, kind) in sorted(members):
+            if kind != 'e':
+                continue
+            columns = templates.get(seq)
+            if columns is None:
+                logging.warning('%s: no template for sequence %d', source, seq)
+                continue
+            with acs_instrument.stage('filter_sequences'):
+                with z.open(members[(seq, 'e')]) as fp:
+                    logrecno, est = acs_sf_load.parse_sequence(filter_lines(fp, keep), len(columns))
+                moe = numpy.full(est.shape, numpy.nan)
+                if (seq, 'm') in members:
+                    with z.open(members[(seq, 'm')]) as fp:
+                        moe_logrecno, moe = acs_sf_load.parse_sequence(filter_lines(fp, keep), len(columns))
+                    if not numpy.array_equal(logrecno, moe_logrecno):
+                        raise ValueError('{0}: sequence {1}: estimate and margin files have different LOGRECNOs'.format(source, seq))
+            out = acs_sf_load.sequence_dir(store_dir, info['year'], info['span'], info['state'], seq, TRACTS_PART)
+            acs_sf_load.write_sequence(out, logrecno, est, moe, columns)
+            acs_instrument.count('sequences')
+            written.append(out)
+    return written
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Load only the geographies of interest from ACS tract and block group archives.')
+    parser.add_argument('sources', nargs='+', help='_Tracts_Block_Groups_Only.zip files or URLs')
+    parser.add_argument('-g', dest='geographies', nargs='+', required=True, help='state or state+county FIPS codes, or GEO.ids, to keep')
+    parser.add_argument('-T', dest='templates', required=True, help='the year and span\'s summary file templates zip')
+    parser.add_argument('-o', dest='store_dir', default='acs_sf_store', help='output store directory')
+    acs_instrument.add_arguments(parser)
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    acs_instrument.start(__file__, args)
+    geo_filter = GeoFilter.from_strings(args.geographies)
+    templates = acs_sf_load.load_templates(args.templates)
+    written = []
+    for source in args.sources:
+        written += filter_archive(source, templates, args.store_dir, geo_filter)
+    print('{0} sequences written under {1}'.format(len(written), args.store_dir))
+
+
+if __name__ == '__main__':
+    main()
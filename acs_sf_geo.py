@@ -0,0 +1,214 @@
+# Read ACS summary file geography files.
+#
+# Copyright 2016 R. A. Reitmeyer
+#
+# ACSFetch.fetch_state downloads geography files named like g20081al.txt,
+# g2006al.txt or algeo.2007-3yr (and the 2009+ state zips hold more of
+# the same). They are fixed-width text, one geography per line, keyed by
+# LOGRECNO, the logical record number that ties a geography to its row
+# in every sequence file.
+#
+# Rather than slicing each line in Python, the file is memory-mapped and
+# viewed as a NumPy structured array whose fields sit at the layout's
+# byte offsets, so decoding a column is one vectorized operation. Run as
+#     python3 acs_sf_geo.py g20141ca.txt g20141tx.txt
+# to time reading and indexing each file, in rows/s.
+
+# Requires Python3.
+
+# Copyright R. A. Reitmeyer
+# Released under the GNU Public License, version 2, or later.
+
+import os
+import sys
+import re
+import mmap
+import time
+import logging
+import argparse
+
+import numpy
+
+
+# Field layouts, as (name, 1-based start column, width), from the ACS
+# summary file technical documentation. GEO_LAYOUTS maps the first year
+# a layout applies to onto the layout. For 2005-2008 only the leading
+# fields, which did not move, are described.
+GEO_LAYOUT_2005 = [
+    ('FILEID', 1, 6), ('STUSAB', 7, 2), ('SUMLEVEL', 9, 3), ('COMPONENT', 12, 2),
+    ('LOGRECNO', 14, 7), ('US', 21, 1), ('REGION', 22, 1), ('DIVISION', 23, 1),
+    ('STATECE', 24, 2), ('STATE', 26, 2), ('COUNTY', 28, 3), ('COUSUB', 31, 5),
+    ('PLACE', 36, 5), ('TRACT', 41, 6), ('BLKGRP', 47, 1),
+    ]
+GEO_LAYOUT_2009 = GEO_LAYOUT_2005 + [
+    ('CONCIT', 48, 5), ('AIANHH', 53, 4), ('AIANHHFP', 57, 5), ('AIHHTLI', 62, 1),
+    ('AITSCE', 63, 3), ('AITS', 66, 5), ('ANRC', 71, 5), ('CBSA', 76, 5),
+    ('CSA', 81, 3), ('METDIV', 84, 5), ('MACC', 89, 1), ('MEMI', 90, 1),
+    ('NECTA', 91, 5), ('CNECTA', 96, 3), ('NECTADIV', 99, 5), ('UA', 104, 5),
+    ('CDCURR', 114, 2), ('SLDU', 116, 3), ('SLDL', 119, 3), ('ZCTA5', 131, 5),
+    ('SUBMCD', 136, 5), ('SDELM', 141, 5), ('SDSEC', 146, 5), ('SDUNI', 151, 5),
+    ('UR', 156, 1), ('PCI', 157, 1), ('PUMA5', 169, 5), ('GEOID', 179, 40),
+    ('NAME', 219, 200),
+    ]
+GEO_LAYOUTS = {2005: GEO_LAYOUT_2005, 2009: GEO_LAYOUT_2009}
+
+
+def layout_for(year):
+    """The geography file layout in effect for an ACS year."""
+    retval = None
+    for first_year in sorted(GEO_LAYOUTS):
+        if first_year <= year:
+            retval = GEO_LAYOUTS[first_year]
+    return retval
+
+
+def parse_geo_filename(filename):
+    """Year, span and state of a geography file, from its name.
+
+    >>> parse_geo_filename('g20081al.txt') == {'year': 2008, 'span': 1, 'state': 'al'}
+    True
+    >>> parse_geo_filename('g2006al.txt') == {'year': 2006, 'span': 1, 'state': 'al'}
+    True
+    >>> parse_geo_filename('algeo.2007-3yr') == {'year': 2007, 'span': 3, 'state': 'al'}
+    True
+    >>> parse_geo_filename('e20141al0001000.txt')
+    {}
+    """
+    basename = os.path.basename(filename)
+    m = re.match('g(?P<year>[0-9]{4})(?P<span>[0-9]?)(?P<state>[a-z]{2})\\.(txt|csv)$', basename)
+    if m:
+        return {'year': int(m.group('year')), 'span': int(m.group('span') or 1), 'state': m.group('state')}
+    m = re.match('(?P<state>[a-z]{2})geo\\.(?P<year>[0-9]{4})-(?P<span>[0-9])yr$', basename)
+    if m:
+        return {'year': int(m.group('year')), 'span': int(m.group('span')), 'state': m.group('state')}
+    return {}
+
+
+def geo_dtype(layout, record_length):
+    """NumPy structured dtype laying the layout's fields over a record of
+    record_length bytes (line terminator included). Fields that run past
+    the end of the record are truncated or dropped."""
+    names = []
+    formats = []
+    offsets = []
+    for name, start, width in layout:
+        width = min(width, record_length - (start-1))
+        if width <= 0:
+            continue
+        names.append(name)
+        formats.append('S{0}'.format(width))
+        offsets.append(start-1)
+    return numpy.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': record_length})
+
+
+class GeoFile(object):
+    """A geography file viewed as a structured array of fixed-width
+    byte fields. When every line has the same length the array is a
+    zero-copy view of the memory-mapped file (or of data, when given the
+    file's bytes rather than a file); otherwise the lines are padded to
+    the longest one first.
+    """
+    def __init__(self, path, year=None, data=None):
+        if year is None:
+            year = parse_geo_filename(path)['year']
+        self.path = path
+        self.year = year
+        self.layout = layout_for(year)
+        if data is not None:
+            # already in memory, eg read from a zip member
+            buf, record_length = self._records_buffer(data, len(data))
+        else:
+            with open(path, 'rb') as fp:
+                size = os.fstat(fp.fileno()).st_size
+                buf = b''
+                if size:
+                    buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                buf, record_length = self._records_buffer(buf, size)
+        self.records = numpy.frombuffer(buf, dtype=geo_dtype(self.layout, record_length))
+        self._order = None
+
+    @staticmethod
+    def _records_buffer(buf, size):
+        """(buffer of equal-length records, record length) for a file's
+        bytes, padding the lines when they aren't already that.
+
+        >>> GeoFile._records_buffer(b'ab\\ncd\\n', 6)
+        (b'ab\\ncd\\n', 3)
+        >>> GeoFile._records_buffer(b'a\\nbcd\\n', 6)
+        (b'a  \\nbcd\\n', 4)
+        """
+        if size == 0:
+            return b'', 1
+        record_length = buf.find(b'\n') + 1 or size
+        if size % record_length != 0 or not (numpy.frombuffer(buf, dtype=numpy.uint8)[record_length-1::record_length] == ord('\n')).all():
+            # ragged lines (trailing blanks trimmed), even ones whose
+            # lengths happen to add up to a multiple: pad them out.
+            lines = buf[:].splitlines()
+            if isinstance(buf, mmap.mmap):
+                buf.close()
+            record_length = max(len(l) for l in lines) + 1
+            buf = b''.join(l.ljust(record_length-1) + b'\n' for l in lines)
+        return buf, record_length
+
+    def __len__(self):
+        return len(self.records)
+
+    def field(self, name):
+        """A field decoded to a str array, with padding stripped."""
+        return numpy.char.strip(numpy.char.decode(self.records[name], 'latin-1'))
+
+    def logrecno(self):
+        """LOGRECNO as an int64 array."""
+        return self.records['LOGRECNO'].astype(numpy.int64)
+
+    def logrecno_index(self):
+        """(sorted LOGRECNOs, positions that sort them), built once. Files
+        are normally already in LOGRECNO order, but don't rely on it."""
+        if self._order is None:
+            keys = self.logrecno()
+            self._order = numpy.argsort(keys, kind='stable')
+            self._sorted = keys[self._order]
+        return self._sorted, self._order
+
+    def rows_for(self, logrecnos):
+        """Positions of the given LOGRECNOs in the file, -1 where absent;
+        one vectorized search rather than a dict lookup per row."""
+        sorted_keys, order = self.logrecno_index()
+        logrecnos = numpy.asarray(logrecnos, dtype=numpy.int64)
+        if len(sorted_keys) == 0:
+            return numpy.full(len(logrecnos), -1, dtype=numpy.int64)
+        pos = numpy.searchsorted(sorted_keys, logrecnos).clip(0, len(sorted_keys)-1)
+        return numpy.where(sorted_keys[pos] == logrecnos, order[pos], -1)
+
+
+def bench(paths):
+    """Time opening, decoding LOGRECNO, SUMLEVEL and GEOID (where the
+    layout has it) and indexing each file. Returns a list of dicts."""
+    results = []
+    for path in paths:
+        start = time.perf_counter()
+        geo = GeoFile(path)
+        geo.logrecno_index()
+        geo.field('SUMLEVEL')
+        if 'GEOID' in geo.records.dtype.names:
+            geo.field('GEOID')
+        elapsed = time.perf_counter() - start
+        results.append({'file': path, 'rows': len(geo), 'seconds': elapsed, 'rows_per_second': len(geo)/elapsed if elapsed > 0 else 0})
+    return results
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Read and time ACS summary file geography files.')
+    parser.add_argument('paths', nargs='+', help='geography files')
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    print('file,rows,seconds,rows_per_second')
+    for r in bench(args.paths):
+        print('{file},{rows},{seconds:.4f},{rows_per_second:.0f}'.format(**r))
+
+
+if __name__ == '__main__':
+    main()
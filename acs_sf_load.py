@@ -0,0 +1,285 @@
+# Load ACS summary file sequence data into a columnar store.
+#
+# Copyright 2016 R. A. Reitmeyer
+#
+# ACSFetch.recursive_fetch_states saves *_Summary_FileTemplates.zip
+# (one spreadsheet per sequence, whose header row names the table cells
+# in that sequence) and per-state zips like Alabama_All_Geographies.zip
+# holding the sequence files: e20141al0001000.txt for estimates and
+# m20141al0001000.txt for margins of error, headerless CSV keyed by
+# LOGRECNO. This tool reads the templates once, streams the sequence
+# files straight out of the state zips (nothing is extracted to disk)
+# and writes, per state and sequence, a directory
+#     <store>/<year>_<span>yr/<st>/<part>/seq<NNNN>/
+# (part being 'tracts' for the _Tracts_Block_Groups_Only zips and 'all'
+# otherwise)
+# holding logrecno.npy, est.npy and moe.npy (est and moe are column-major
+# float64, NaN where the Census left the cell empty or '.', and can be
+# memory-mapped) and columns.txt. States are loaded in parallel. Run as
+#     python3 acs_sf_load.py acs_sf_downloads/2014 -o acs_sf_store
+
+# Requires Python3.
+
+# Copyright R. A. Reitmeyer
+# Released under the GNU Public License, version 2, or later.
+
+import os
+import sys
+import re
+import io
+import shutil
+import zipfile
+import logging
+import argparse
+import concurrent.futures
+
+import numpy
+
+
+SEQUENCE_FILE_RE = re.compile('(?P<kind>[em])(?P<year>[0-9]{4})(?P<span>[0-9])(?P<state>[a-z]{2})(?P<seq>[0-9]{4})(000)?\\.txt$')
+TEMPLATE_FILE_RE = re.compile('seq(uence)?_?(?P<seq>[0-9]+)\\.xlsx?$', re.IGNORECASE)
+TEMPLATES_ZIP_RE = re.compile('File_?Templates\\.zip$')
+STATE_ZIP_RE = re.compile('((_All_Geographies(_Not_Tracts_Block_Groups)?)|(_Tracts_Block_Groups_Only))\\.zip$')
+# Leading identifier columns of every sequence file; LOGRECNO is last.
+ID_COLUMNS = ['FILEID', 'FILETYPE', 'STUSAB', 'CHARITER', 'SEQUENCE', 'LOGRECNO']
+MISSING_RE = re.compile(b'(?<=,)\\.?(?=,|\\r?$)', re.MULTILINE)
+
+
+def parse_sequence_filename(filename):
+    """Kind (e or m), year, span, state and sequence of a sequence file.
+
+    >>> parse_sequence_filename('e20141al0001000.txt') == {'kind': 'e', 'year': 2014, 'span': 1, 'state': 'al', 'seq': 1}
+    True
+    >>> parse_sequence_filename('g20141al.txt')
+    {}
+    """
+    m = SEQUENCE_FILE_RE.search(os.path.basename(filename))
+    if m is None:
+        return {}
+    return {'kind': m.group('kind'), 'year': int(m.group('year')), 'span': int(m.group('span')), 'state': m.group('state'), 'seq': int(m.group('seq'))}
+
+
+def template_header(name, data):
+    """The first row of a sequence template spreadsheet, as strings."""
+    if name.lower().endswith('.xlsx'):
+        import openpyxl
+        workbook = openpyxl.load_workbook(io.BytesIO(data), read_only=True)
+        try:
+            row = next(workbook.active.iter_rows(max_row=1, values_only=True))
+        finally:
+            workbook.close()
+        return [str(v) for v in row if v is not None]
+    import xlrd
+    workbook = xlrd.open_workbook(file_contents=data, on_demand=True)
+    try:
+        return [str(v) for v in workbook.sheet_by_index(0).row_values(0) if v != '']
+    finally:
+        workbook.release_resources()
+
+
+def load_templates(templates_zip):
+    """Column maps from a templates zip: {sequence number: [cell ids]},
+    the cell ids (like B01001_001) being the data columns after the
+    leading identifier columns."""
+    retval = {}
+    with zipfile.ZipFile(templates_zip, 'r') as z:
+        for name in z.namelist():
+            m = TEMPLATE_FILE_RE.search(os.path.basename(name))
+            if m is None:
+                continue
+            header = template_header(name, z.read(name))
+            retval[int(m.group('seq'))] = header[len(ID_COLUMNS):]
+    logging.info('load_templates %s: %d sequences', templates_zip, len(retval))
+    return retval
+
+
+def parse_sequence(data, ncols):
+    """Parse a sequence file's bytes into (logrecno, values), values being
+    a rows x ncols float64 array. Empty and '.' cells become NaN with one
+    regex pass over the bytes, so NumPy's C parser does the rest."""
+    data = MISSING_RE.sub(b'nan', data)
+    if data.strip() == b'':
+        return numpy.zeros(0, dtype=numpy.int64), numpy.zeros((0, ncols))
+    first = len(ID_COLUMNS) - 1
+    table = numpy.loadtxt(io.BytesIO(data), delimiter=',', usecols=range(first, first+1+ncols), dtype=numpy.float64, ndmin=2)
+    return table[:, 0].astype(numpy.int64), table[:, 1:]
+
+
+def zip_part(state_zip):
+    """Which part of a state's geographies a state zip holds.
+
+    >>> zip_part('Alabama_Tracts_Block_Groups_Only.zip'), zip_part('Alabama_All_Geographies.zip')
+    ('tracts', 'all')
+    """
+    if '_Tracts_Block_Groups_Only' in os.path.basename(state_zip):
+        return 'tracts'
+    return 'all'
+
+
+def sequence_dir(store_dir, year, span, state, seq, part='all'):
+    return os.path.join(store_dir, '{0}_{1}yr'.format(year, span), state, part, 'seq{0:04d}'.format(seq))
+
+
+def write_sequence(out, logrecno, est, moe, columns):
+    """Write one sequence's arrays into directory out, replacing any
+    earlier copy only once the new one is complete."""
+    tmp = out + '.part'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp, mode=0o755)
+    numpy.save(os.path.join(tmp, 'logrecno.npy'), logrecno)
+    numpy.save(os.path.join(tmp, 'est.npy'), numpy.asfortranarray(est))
+    numpy.save(os.path.join(tmp, 'moe.npy'), numpy.asfortranarray(moe))
+    with open(os.path.join(tmp, 'columns.txt'), 'w', encoding='utf-8') as fp:
+        fp.write('\n'.join(columns) + '\n')
+    if os.path.exists(out):
+        shutil.rmtree(out)
+    os.rename(tmp, out)
+
+
+def load_state_zip(state_zip, templates, store_dir):
+    """Load every sequence in one state zip into store_dir. Returns the
+    list of sequence directories written. Raises ValueError if a
+    sequence's estimate and margin files don't cover the same records."""
+    written = []
+    with zipfile.ZipFile(state_zip, 'r') as z:
+        members = {}
+        for name in z.namelist():
+            info = parse_sequence_filename(name)
+            if info:
+                members[(info['year'], info['span'], info['state'], info['seq'], info['kind'])] = name
+        for (year, span, state, seq, kind) in sorted(members):
+            if kind != 'e':
+                continue
+            columns = templates.get(seq)
+            if columns is None:
+                logging.warning('%s: no template for sequence %d', state_zip, seq)
+                continue
+            logrecno, est = parse_sequence(z.read(members[(year, span, state, seq, 'e')]), len(columns))
+            moe = numpy.full(est.shape, numpy.nan)
+            if (year, span, state, seq, 'm') in members:
+                moe_logrecno, moe = parse_sequence(z.read(members[(year, span, state, seq, 'm')]), len(columns))
+                if not numpy.array_equal(logrecno, moe_logrecno):
+                    raise ValueError('{0}: sequence {1}: estimate and margin files have different LOGRECNOs'.format(state_zip, seq))
+            out = sequence_dir(store_dir, year, span, state, seq, zip_part(state_zip))
+            write_sequence(out, logrecno, est, moe, columns)
+            written.append(out)
+    return written
+
+
+def find_jobs(topdir):
+    """Pair each state zip under topdir with the templates zip in its own
+    directory or the nearest one above it (but not above topdir).
+    Returns [(state zip, templates zip)]."""
+    topdir = os.path.normpath(topdir)
+    top = os.path.abspath(topdir)
+    templates_by_dir = {}
+    state_zips = []
+    for (dirpath, dirnames, filenames) in os.walk(topdir):
+        dirnames.sort()
+        for fn in sorted(filenames):
+            if TEMPLATES_ZIP_RE.search(fn):
+                templates_by_dir[dirpath] = os.path.join(dirpath, fn)
+            elif STATE_ZIP_RE.search(fn):
+                state_zips.append(os.path.join(dirpath, fn))
+    retval = []
+    for state_zip in state_zips:
+        d = os.path.dirname(state_zip)
+        while d not in templates_by_dir and os.path.abspath(d) != top and os.path.commonpath([top, os.path.abspath(d)]) == top:
+            d = os.path.dirname(d)
+        if d in templates_by_dir:
+            retval.append((state_zip, templates_by_dir[d]))
+        else:
+            logging.warning('%s: no templates zip found', state_zip)
+    return retval
+
+
+def nearest_templates(dirpath):
+    """The templates zip in dirpath or the nearest directory above it
+    that has one, or None.
+
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as top:
+    ...     os.makedirs(os.path.join(top, '2014', 'data', '5_year_by_state'))
+    ...     open(os.path.join(top, '2014', '2014_5yr_Summary_FileTemplates.zip'), 'w').close()
+    ...     found = nearest_templates(os.path.join(top, '2014', 'data', '5_year_by_state'))
+    ...     os.path.relpath(found, top)
+    '2014/2014_5yr_Summary_FileTemplates.zip'
+    """
+    d = os.path.abspath(dirpath)
+    while True:
+        if os.path.isdir(d):
+            for fn in sorted(os.listdir(d)):
+                if TEMPLATES_ZIP_RE.search(fn):
+                    return os.path.join(d, fn)
+        if os.path.dirname(d) == d:
+            return None
+        d = os.path.dirname(d)
+
+
+_TEMPLATES = {}
+
+
+def _load_job(job):
+    """Pool worker: load one state zip. Returns (sequence directories
+    written, error message or None), so one bad zip doesn't sink the
+    whole load."""
+    state_zip, templates_zip, store_dir = job
+    try:
+        if templates_zip not in _TEMPLATES:
+            _TEMPLATES[templates_zip] = load_templates(templates_zip)
+        return (load_state_zip(state_zip, _TEMPLATES[templates_zip], store_dir), None)
+    except Exception as e:
+        return ([], '{0}: {1}'.format(type(e).__name__, e))
+
+
+def load_all(topdir, store_dir, processes=None):
+    """Load every state zip under topdir, one state per pool task. Each
+    worker reads a templates zip at most once. Returns (sequence
+    directories written, dict of failed state zips to error messages)."""
+    jobs = [(s, t, store_dir) for s, t in find_jobs(topdir)]
+    written = []
+    failures = {}
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        for (state_zip, templates_zip, d), (files, error) in zip(jobs, pool.map(_load_job, jobs)):
+            if error is not None:
+                logging.warning('state zip %s failed: %s', state_zip, error)
+                failures[state_zip] = error
+                continue
+            logging.info('%s: %d sequences', state_zip, len(files))
+            written += files
+    return written, failures
+
+
+def load_sequence(store_dir, year, span, state, seq, part='all', mmap_mode='r'):
+    """Open one stored sequence, memory-mapped by default. Returns
+    (logrecno, est, moe, columns)."""
+    path = sequence_dir(store_dir, year, span, state, seq, part)
+    with open(os.path.join(path, 'columns.txt'), 'r', encoding='utf-8') as fp:
+        columns = fp.read().split()
+    return (numpy.load(os.path.join(path, 'logrecno.npy'), mmap_mode=mmap_mode),
+            numpy.load(os.path.join(path, 'est.npy'), mmap_mode=mmap_mode),
+            numpy.load(os.path.join(path, 'moe.npy'), mmap_mode=mmap_mode),
+            columns)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Load ACS summary file sequences into a columnar store.')
+    parser.add_argument('topdir', help='directory tree of state and templates zips, eg acs_sf_downloads/2014')
+    parser.add_argument('-o', dest='store_dir', default='acs_sf_store', help='output store directory')
+    parser.add_argument('-j', dest='processes', type=int, default=None, help='number of processes (default: all cores)')
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    written, failures = load_all(args.topdir, args.store_dir, args.processes)
+    for state_zip, error in sorted(failures.items()):
+        print('{0}: {1}'.format(state_zip, error))
+    print('{0} sequences written under {1}'.format(len(written), args.store_dir))
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
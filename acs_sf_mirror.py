@@ -0,0 +1,424 @@
+# Record a slice of census.gov and replay it from a local server, for
+# exercising and timing the ACSFetch crawl offline.
+#
+# Copyright 2016 R. A. Reitmeyer
+#
+#     python3 acs_sf_mirror.py record mirror -y 2014 -s Alabama Alaska --shells
+# crawls census.gov as acs_sf_fetch.py would with the same options, but
+# rather than saving files into acs_sf_downloads/ it keeps every
+# directory listing and file it fetches in mirror/ (content in an
+# acs_sf_objects store, so repeats are kept once; mirror/manifest.csv
+# maps each URL path to its status, type, size and content). With
+# --max-file-bytes, larger files are recorded by size only and replayed
+# as that many zero bytes, which is enough for timing (though such zips
+# fail acs_sf_fetch.py --unpack verification).
+#     python3 acs_sf_mirror.py serve mirror -p 8000 --latency 0.05 --bandwidth 2000000 --fail-rate 0.02
+# serves the recording, with a delay before each response, a per
+# connection bandwidth cap (bytes/s), and a fraction of requests failed
+# with a 503 (--fail-rate) or cut off halfway (--truncate-rate); the
+# random choices are seeded, so a run can be repeated. Range requests
+# are supported, as acs_sf_filter.py needs. Point the crawler at it with
+#     python3 acs_sf_fetch.py --census-url http://localhost:8000 -y 2014 -s Alabama Alaska
+# or let
+#     python3 acs_sf_mirror.py bench mirror -y 2014 -s Alabama Alaska --latency 0.05
+# start a server and time whole crawls against it, reporting listings
+# fetched, files, bytes, retries and throughput. Nothing in replay ever
+# touches census.gov.
+
+# Requires Python3.
+
+# Copyright R. A. Reitmeyer
+# Released under the GNU Public License, version 2, or later.
+
+import os
+import sys
+import re
+import csv
+import time
+import shutil
+import random
+import logging
+import argparse
+import tempfile
+import threading
+import http.server
+import urllib.parse
+
+import acs_instrument
+import acs_sf_objects
+import acs_sf_fetch
+
+
+MANIFEST_FILENAME = 'manifest.csv'
+MANIFEST_HEADER = ['PATH', 'STATUS', 'CONTENT_TYPE', 'SIZE', 'SHA256']
+CHUNK_SIZE = 64*1024
+
+
+def url_path(url):
+    """The key a URL is recorded under: its path, without the server or
+    a trailing slash, since ACSFetch joins URLs without them.
+
+    >>> url_path('http://www2.census.gov/programs-surveys/acs/summary_file/'), url_path('/programs-surveys/acs/summary_file')
+    ('/programs-surveys/acs/summary_file', '/programs-surveys/acs/summary_file')
+    """
+    return urllib.parse.urlsplit(url).path.rstrip('/') or '/'
+
+
+class Mirror(object):
+    """A recording: the manifest, and the content in an object store."""
+    def __init__(self, mirror_dir):
+        self.mirror_dir = mirror_dir
+        self.objects = acs_sf_objects.ObjectStore(os.path.join(mirror_dir, 'objects'))
+        self.manifest_filename = os.path.join(mirror_dir, MANIFEST_FILENAME)
+        self.manifest = {}
+        if os.path.exists(self.manifest_filename):
+            with open(self.manifest_filename, 'r', newline='', encoding='utf-8') as fp:
+                for rec in csv.DictReader(fp):
+                    self.manifest[rec['PATH']] = rec  # later lines win
+        else:
+            with open(self.manifest_filename, 'w', newline='', encoding='utf-8') as fp:
+                csv.writer(fp).writerow(MANIFEST_HEADER)
+
+    def get(self, path):
+        return self.manifest.get(url_path(path))
+
+    def body_path(self, rec):
+        """Where a recorded body is, or None if only its size was kept."""
+        if not rec['SHA256']:
+            return None
+        return self.objects.path(rec['SHA256'])
+
+    def add(self, url, status, content_type, size, tmpfile=None):
+        digest = ''
+        if tmpfile is not None:
+            digest, new = self.objects.add(tmpfile)
+        rec = {'PATH': url_path(url), 'STATUS': status, 'CONTENT_TYPE': content_type, 'SIZE': size, 'SHA256': digest}
+        self.manifest[rec['PATH']] = rec
+        with open(self.manifest_filename, 'a', newline='', encoding='utf-8') as fp:
+            csv.writer(fp).writerow([rec[h] for h in MANIFEST_HEADER])
+        return rec
+
+    def record(self, session, url, max_file_bytes=None):
+        """Fetch url from the real server and record it, unless it
+        already is. Returns its manifest record."""
+        rec = self.get(url)
+        if rec is not None:
+            return rec
+        resp = session.get(url, stream=True)
+        try:
+            resp.raise_for_status()  # errors aren't recorded, so can be retried
+            content_type = resp.headers.get('Content-Type', '')
+            length = resp.headers.get('Content-Length')
+            if max_file_bytes is not None and length is not None and int(length) > max_file_bytes:
+                acs_instrument.count('recorded_size_only')
+                return self.add(url, resp.status_code, content_type, int(length))
+            tmpfile = os.path.join(self.mirror_dir, 'recording.part')
+            size = 0
+            with open(tmpfile, 'wb') as fp:
+                for data in resp.iter_content(1024*1024):
+                    fp.write(data)
+                    size += len(data)
+            acs_instrument.count('recorded')
+            acs_instrument.count('recorded_bytes', size)
+            return self.add(url, resp.status_code, content_type, size, tmpfile)
+        finally:
+            resp.close()
+
+
+class RecordedResponse(object):
+    """Just enough of a requests response, over a recording, for ACSFetch."""
+    def __init__(self, mirror, rec, url):
+        self.mirror = mirror
+        self.rec = rec
+        self.url = url
+        self.status_code = int(rec['STATUS'])
+        self.headers = {'Content-Type': rec['CONTENT_TYPE'], 'Content-Length': rec['SIZE']}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise IOError('{0}: status {1}'.format(self.url, self.status_code))
+
+    def iter_content(self, chunk_size=CHUNK_SIZE):
+        path = self.mirror.body_path(self.rec)
+        if path is None:
+            left = int(self.rec['SIZE'])
+            while left > 0:
+                yield bytes(min(chunk_size, left))
+                left -= min(chunk_size, left)
+            return
+        with open(path, 'rb') as fp:
+            for data in iter(lambda: fp.read(chunk_size), b''):
+                yield data
+
+    @property
+    def content(self):
+        return b''.join(self.iter_content())
+
+    def close(self):
+        pass
+
+
+class RecordingSession(object):
+    """Stands in for acs_sf_fetch's requests session while recording:
+    each GET is recorded, then answered from the recording."""
+    def __init__(self, mirror, max_file_bytes=None):
+        import requests
+        self.mirror = mirror
+        self.max_file_bytes = max_file_bytes
+        self.session = requests.Session()
+
+    def record(self, url):
+        return self.mirror.record(self.session, url, self.max_file_bytes)
+
+    def get(self, url, stream=False, **kwargs):
+        return RecordedResponse(self.mirror, self.record(url), url)
+
+
+class RecordingFetch(acs_sf_fetch.ACSFetch):
+    """ACSFetch that records files (through recorder, a
+    RecordingSession) instead of saving them."""
+    def __init__(self, recorder, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.recorder = recorder
+
+    def save_file(self, url, outfile, overwrite=False, dedupe=False):
+        print('    record('+url+')')
+        rec = self.retrying(url, lambda: self.recorder.record(url))
+        acs_instrument.count('files')
+        acs_instrument.count('bytes', int(rec['SIZE']))
+
+    def save_zip(self, url, outfile):
+        self.save_file(url, outfile)
+
+
+def record(mirror_dir, states='*', years=None, tracts_and_block_groups=False, acs=True, shells=False, max_file_bytes=None, census_url=acs_sf_fetch.CENSUS_URL):
+    """Crawl census.gov (or census_url) into a recording. Returns the Mirror."""
+    mirror = Mirror(mirror_dir)
+    recorder = RecordingSession(mirror, max_file_bytes)
+    acs_sf_fetch.SESSION = recorder  # for the directory listings
+    fetcher = RecordingFetch(recorder, states, tracts_and_block_groups, years=years)
+    with tempfile.TemporaryDirectory() as output_dir:  # for the crawl's empty directories
+        if acs:
+            fetcher.crawl_acs(census_url=acs_sf_fetch.on_server(acs_sf_fetch.CENSUS_ACS_URL, census_url), output_dir=output_dir)
+        if shells:
+            fetcher.crawl_shells(url=acs_sf_fetch.on_server(acs_sf_fetch.CENSUS_SHELLS_URL, census_url), output_dir=output_dir)
+    return mirror
+
+
+class ReplayServer(http.server.ThreadingHTTPServer):
+    """An HTTP server answering from a recording, with injected latency
+    (seconds before each response), bandwidth (bytes/s per connection,
+    None for no limit) and failures (fractions of requests answered 503,
+    or cut off halfway through the body)."""
+    daemon_threads = True
+
+    def __init__(self, mirror, port=0, latency=0.0, bandwidth=None, fail_rate=0.0, truncate_rate=0.0, seed=0):
+        super().__init__(('127.0.0.1', port), ReplayHandler)
+        self.mirror = mirror
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.fail_rate = fail_rate
+        self.truncate_rate = truncate_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'bytes': 0, 'not_found': 0, 'failed': 0, 'truncated': 0}
+
+    @property
+    def base_url(self):
+        return 'http://{0}:{1}'.format(*self.server_address)
+
+    def roll(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.stats[name] += n
+
+
+class ReplayHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug('replay: ' + format, *args)
+
+    def do_HEAD(self):
+        self.reply(body=False)
+
+    def do_GET(self):
+        self.reply(body=True)
+
+    def reply(self, body):
+        server = self.server
+        server.count('requests')
+        if server.latency:
+            time.sleep(server.latency)
+        rec = server.mirror.get(self.path)
+        if rec is None:
+            server.count('not_found')
+            self.send_error(404)
+            return
+        if server.roll(server.fail_rate):
+            server.count('failed')
+            self.send_error(503)
+            return
+        size = int(rec['SIZE'])
+        start, end = 0, size
+        status = int(rec['STATUS'])
+        m = re.match('^bytes=([0-9]+)-([0-9]*)$', self.headers.get('Range', ''))
+        if m and status == 200:
+            start = int(m.group(1))
+            end = min(int(m.group(2))+1 if m.group(2) else size, size)
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', rec['CONTENT_TYPE'] or 'application/octet-stream')
+        self.send_header('Content-Length', str(max(0, end-start)))
+        self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(start, end-1, size))
+        self.end_headers()
+        if not body:
+            return
+        if server.roll(server.truncate_rate):
+            server.count('truncated')
+            end = start + (end-start)//2
+            self.close_connection = True
+        self.send_body(rec, start, end)
+
+    def send_body(self, rec, start, end):
+        server = self.server
+        path = server.mirror.body_path(rec)
+        fp = open(path, 'rb') if path is not None else None
+        try:
+            if fp is not None:
+                fp.seek(start)
+            began = time.perf_counter()
+            sent = 0
+            while start + sent < end:
+                n = min(CHUNK_SIZE, end - start - sent)
+                data = fp.read(n) if fp is not None else bytes(n)
+                self.wfile.write(data)
+                sent += len(data)
+                if server.bandwidth:
+                    ahead = sent / server.bandwidth - (time.perf_counter() - began)
+                    if ahead > 0:
+                        time.sleep(ahead)
+            server.count('bytes', sent)
+        finally:
+            if fp is not None:
+                fp.close()
+
+
+def serve_in_thread(server):
+    """Run a ReplayServer in a daemon thread; stop it with server.shutdown()."""
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return thread
+
+
+def bench_crawl(mirror_dir, states='*', years=None, tracts_and_block_groups=False, acs=True, shells=False, unpack_processes=0, repeat=3, **server_args):
+    """Time whole crawls of a recording through a ReplayServer set up
+    with server_args. Returns a list of one dict of results."""
+    import acs_aff_benchmark
+    server = ReplayServer(Mirror(mirror_dir), **server_args)
+    serve_in_thread(server)
+    output_dir = tempfile.mkdtemp(prefix='acs_sf_mirror.')
+    counters = {}
+
+    def clear():
+        shutil.rmtree(output_dir)
+        os.mkdir(output_dir)
+        acs_instrument.INSTRUMENT = acs_instrument.Instrument()
+
+    def crawl():
+        fetcher = acs_sf_fetch.ACSFetch(states, tracts_and_block_groups, unpack_processes=unpack_processes, years=years)
+        fetcher.retry_wait = 0.1
+        if acs:
+            fetcher.crawl_acs(census_url=acs_sf_fetch.on_server(acs_sf_fetch.CENSUS_ACS_URL, server.base_url), output_dir=output_dir)
+        if shells:
+            fetcher.crawl_shells(url=acs_sf_fetch.on_server(acs_sf_fetch.CENSUS_SHELLS_URL, server.base_url), output_dir=output_dir)
+        fetcher.finish()
+        counters.clear()
+        counters.update(acs_instrument.INSTRUMENT.counters)
+
+    try:
+        m = acs_aff_benchmark.measure(crawl, clear, repeat)
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(output_dir)
+    m.pop('result')
+    result = {'latency': server.latency, 'bandwidth': server.bandwidth, 'fail_rate': server.fail_rate, 'truncate_rate': server.truncate_rate}
+    for name in ['index_pages', 'index_bytes', 'files', 'bytes', 'retries', 'zips_refetched']:
+        result[name] = counters.get(name, 0)
+    result.update(m)
+    result['bytes_per_second'] = result['bytes'] / result['seconds'] if result['seconds'] else 0
+    return [result]
+
+
+def add_crawl_arguments(parser):
+    parser.add_argument('mirror_dir', help='recording directory')
+    parser.add_argument('-s', dest='states', nargs='+', default='*', help='states, as in acs_sf_fetch.ALL_STATES (default: all)')
+    parser.add_argument('-y', dest='years', nargs='+', default=None, help='years (default: all)')
+    parser.add_argument('-t', dest='tracts_and_block_groups', action='store_true', help='include the tracts and block groups zips')
+    parser.add_argument('--shells', dest='shells', action='store_true', help='include the table shells')
+    parser.add_argument('--no-acs', dest='acs', action='store_false', help="don't include the summary files")
+
+
+def add_server_arguments(parser):
+    parser.add_argument('--latency', dest='latency', type=float, default=0.0, help='seconds before each response')
+    parser.add_argument('--bandwidth', dest='bandwidth', type=float, default=None, help='bytes/s per connection (default: no limit)')
+    parser.add_argument('--fail-rate', dest='fail_rate', type=float, default=0.0, help='fraction of requests answered 503')
+    parser.add_argument('--truncate-rate', dest='truncate_rate', type=float, default=0.0, help='fraction of bodies cut off halfway')
+    parser.add_argument('--seed', dest='seed', type=int, default=0, help='random seed for failures')
+
+
+def server_args(args):
+    return {'latency': args.latency, 'bandwidth': args.bandwidth, 'fail_rate': args.fail_rate, 'truncate_rate': args.truncate_rate, 'seed': args.seed}
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Record census.gov and replay it locally, to exercise and time the crawl.')
+    subparsers = parser.add_subparsers(dest='command')
+    rec = subparsers.add_parser('record', help='crawl census.gov into a recording')
+    add_crawl_arguments(rec)
+    rec.add_argument('--max-file-bytes', dest='max_file_bytes', type=int, default=None, help='record larger files by size only')
+    rec.add_argument('--census-url', dest='census_url', default=acs_sf_fetch.CENSUS_URL, help='server to record (default: '+acs_sf_fetch.CENSUS_URL+')')
+    serve = subparsers.add_parser('serve', help='serve a recording')
+    serve.add_argument('mirror_dir', help='recording directory')
+    serve.add_argument('-p', dest='port', type=int, default=8000, help='port')
+    add_server_arguments(serve)
+    bench = subparsers.add_parser('bench', help='time crawls of a recording')
+    add_crawl_arguments(bench)
+    add_server_arguments(bench)
+    bench.add_argument('-j', dest='processes', type=int, default=0, help='verify and extract zips with this many processes while crawling (default: 0, off)')
+    bench.add_argument('--repeat', dest='repeat', type=int, default=3, help='crawls; best is reported')
+    bench.add_argument('-o', dest='json', default=None, help='also write results to this JSON file')
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    if args.command == 'record':
+        mirror = record(args.mirror_dir, args.states, args.years, args.tracts_and_block_groups, args.acs, args.shells, args.max_file_bytes, args.census_url)
+        print('{0} URLs recorded in {1}'.format(len(mirror.manifest), args.mirror_dir))
+    elif args.command == 'serve':
+        server = ReplayServer(Mirror(args.mirror_dir), args.port, **server_args(args))
+        print('serving {0} at {1}'.format(args.mirror_dir, server.base_url))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            print(server.stats)
+    elif args.command == 'bench':
+        import acs_aff_benchmark
+        results = bench_crawl(args.mirror_dir, args.states, args.years, args.tracts_and_block_groups, args.acs, args.shells, args.processes, args.repeat, **server_args(args))
+        acs_aff_benchmark.output(results)
+        if args.json is not None:
+            acs_aff_benchmark.write_json(results, args.json, args)
+
+
+if __name__ == '__main__':
+    main()
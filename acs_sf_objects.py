@@ -0,0 +1,123 @@
+# Content-addressed store for files downloaded from census.gov.
+#
+# Copyright 2016 R. A. Reitmeyer
+#
+# Much of the documentation and many table shells are byte-for-byte the
+# same from year to year and span to span, yet ACSFetch saves a copy in
+# every year's tree. With a store, each download is hashed and kept
+# once, as
+#     <store>/<hh>/<sha256>
+# and the usual path under acs_sf_downloads/ is a hard link to it (a
+# copy where hard links aren't possible), so the layout the other tools
+# read is unchanged. <store>/index.csv records, for each URL, the
+# modification time and size shown in the census.gov directory listing
+# and the hash of what was downloaded; a later crawl that finds the same
+# URL listed with the same time and size links the known object rather
+# than downloading it again. That is the only transfer saved: the
+# listing's sizes are rounded (1.2M) and the server offers no content
+# hash, so identical content at a URL not seen before is downloaded,
+# found to be a known object, and only then shared on disk.
+#
+# Since the stored copies are shared, edit a downloaded file only after
+# breaking the link (copy it, then replace it).
+
+# Requires Python3.
+
+# Copyright R. A. Reitmeyer
+# Released under the GNU Public License, version 2, or later.
+
+import os
+import sys
+import csv
+import shutil
+import hashlib
+import logging
+
+
+INDEX_FILENAME = 'index.csv'
+INDEX_HEADER = ['URL', 'LISTED_MODIFIED', 'LISTED_SIZE', 'SIZE', 'SHA256']
+
+
+def file_digest(path):
+    """Hex SHA-256 of a file's content."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1024*1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ObjectStore(object):
+    """Downloads kept once each by content hash, with an index from URL
+    (and its directory listing details) to hash."""
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.index_filename = os.path.join(store_dir, INDEX_FILENAME)
+        self.index = {}
+        os.makedirs(store_dir, mode=0o755, exist_ok=True)
+        if os.path.exists(self.index_filename):
+            with open(self.index_filename, 'r', newline='', encoding='utf-8') as fp:
+                for rec in csv.DictReader(fp):
+                    self.index[rec['URL']] = rec  # later lines win
+        else:
+            with open(self.index_filename, 'w', newline='', encoding='utf-8') as fp:
+                csv.writer(fp).writerow(INDEX_HEADER)
+
+    def path(self, digest):
+        return os.path.join(self.store_dir, digest[:2], digest)
+
+    def lookup(self, url, listed_modified, listed_size):
+        """Hash of the object last downloaded from url, if the listing
+        still shows the same modification time and size and the object
+        is still in the store; else None. Without listing details there
+        is nothing to compare, so None."""
+        rec = self.index.get(url)
+        if rec is None or not listed_modified or not listed_size:
+            return None
+        if rec['LISTED_MODIFIED'] != listed_modified or rec['LISTED_SIZE'] != listed_size:
+            return None
+        if not os.path.exists(self.path(rec['SHA256'])):
+            return None
+        return rec['SHA256']
+
+    def add(self, filename):
+        """Move a downloaded file into the store, or drop it if the store
+        already has the same content. Returns (hash, True if new)."""
+        digest = file_digest(filename)
+        path = self.path(digest)
+        if os.path.exists(path):
+            os.remove(filename)
+            return digest, False
+        os.makedirs(os.path.dirname(path), mode=0o755, exist_ok=True)
+        os.replace(filename, path)
+        return digest, True
+
+    def link(self, digest, outfile):
+        """Make outfile a hard link to (or, failing that, a copy of) the
+        stored object."""
+        tmpfile = outfile+'.part'
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        try:
+            os.link(self.path(digest), tmpfile)
+        except OSError:
+            shutil.copyfile(self.path(digest), tmpfile)
+        os.replace(tmpfile, outfile)
+
+    def record(self, url, listed_modified, listed_size, digest):
+        rec = {'URL': url, 'LISTED_MODIFIED': listed_modified or '', 'LISTED_SIZE': listed_size or '',
+               'SIZE': os.path.getsize(self.path(digest)), 'SHA256': digest}
+        self.index[url] = rec
+        with open(self.index_filename, 'a', newline='', encoding='utf-8') as fp:
+            csv.writer(fp).writerow([rec[h] for h in INDEX_HEADER])
+
+    def usage(self):
+        """(objects, bytes stored) in the store."""
+        objects = 0
+        stored = 0
+        for (dirpath, dirnames, filenames) in os.walk(self.store_dir):
+            for fn in filenames:
+                if fn != INDEX_FILENAME:
+                    objects += 1
+                    stored += os.path.getsize(os.path.join(dirpath, fn))
+        return objects, stored
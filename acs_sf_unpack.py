@@ -0,0 +1,176 @@
+# Verify and extract downloaded ACS summary file zips while the crawl
+# continues.
+#
+# Copyright 2016 R. A. Reitmeyer
+#
+# ACSFetch saves zips one after another and never checks them, so a
+# truncated or corrupt download only shows up when something later
+# fails to read it. With an UnpackPool, each zip is handed to a pool of
+# worker processes as soon as it is saved; a worker extracts it into a
+# directory of the same name without the .zip (checking every member's
+# CRC as it goes) while the main process downloads the next one. A zip
+# that fails is deleted and fetched again, up to a retry limit. The
+# extraction directory only appears once the whole zip has been checked,
+# so its presence means the zip was good; on a rerun such zips aren't
+# read again.
+#     python3 acs_sf_fetch.py -s California --unpack
+# crawls this way; run
+#     python3 acs_sf_unpack.py acs_sf_downloads/2014
+# to verify and extract zips already downloaded.
+
+# Requires Python3.
+
+# Copyright R. A. Reitmeyer
+# Released under the GNU Public License, version 2, or later.
+
+import os
+import sys
+import shutil
+import zipfile
+import logging
+import argparse
+import concurrent.futures
+
+import acs_instrument
+
+
+RETRIES = 2
+
+
+def extract_dir(zip_filename):
+    """Where a zip is extracted to.
+
+    >>> extract_dir('acs_sf_downloads/2014/data/Alabama_All_Geographies.zip')
+    'acs_sf_downloads/2014/data/Alabama_All_Geographies'
+    """
+    return os.path.splitext(zip_filename)[0]
+
+
+def verify_extract(zip_filename):
+    """Extract a zip, checking each member's CRC, into extract_dir(zip)
+    (via a .part directory, renamed once complete). Runs in a pool worker.
+    Returns a dict with the zip name, 'ok', and 'error', 'files' and
+    'bytes' as applicable."""
+    out = extract_dir(zip_filename)
+    if os.path.isdir(out):
+        return {'zip': zip_filename, 'ok': True, 'files': 0, 'bytes': 0, 'skipped': True}
+    tmp = out + '.part'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    try:
+        with zipfile.ZipFile(zip_filename, 'r') as z:
+            infos = z.infolist()
+            # ZipFile.extractall reads every member through ZipExtFile,
+            # which raises BadZipFile on a CRC mismatch.
+            z.extractall(tmp)
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, EOFError, OSError) as e:
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        return {'zip': zip_filename, 'ok': False, 'error': '{0}: {1}'.format(type(e).__name__, e)}
+    os.rename(tmp, out)
+    return {'zip': zip_filename, 'ok': True, 'files': len(infos), 'bytes': sum(i.file_size for i in infos), 'skipped': False}
+
+
+class UnpackPool(object):
+    """Zips waiting on, or being verified and extracted by, a process
+    pool. fetch(url, filename) re-downloads a zip that fails; with no
+    fetch (or no url) a failed zip is just reported, as is one whose
+    worker died or whose re-fetch raised."""
+    def __init__(self, processes=None, fetch=None, retries=RETRIES):
+        self.pool = concurrent.futures.ProcessPoolExecutor(processes)
+        self.fetch = fetch
+        self.retries = retries
+        self.pending = {}  # future -> (url, filename, attempt)
+        self.failed = []   # (url, filename, error) given up on
+
+    def submit(self, url, filename, attempt=0):
+        future = self.pool.submit(verify_extract, filename)
+        self.pending[future] = (url, filename, attempt)
+        return future
+
+    def collect(self, wait=False):
+        """Handle the zips finished so far (with wait, all of them,
+        including any re-fetched along the way). Returns the results."""
+        results = []
+        while self.pending:
+            timeout = None if wait else 0
+            done, not_done = concurrent.futures.wait(list(self.pending), timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                url, filename, attempt = self.pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # The worker died (BrokenProcessPool) rather than
+                    # reporting a bad zip; the pool can't retry it.
+                    error = '{0}: {1}'.format(type(e).__name__, e)
+                    logging.error('%s could not be verified: %s', filename, error)
+                    acs_instrument.count('zips_failed')
+                    results.append({'zip': filename, 'ok': False, 'error': error})
+                    self.failed.append((url, filename, error))
+                    continue
+                results.append(result)
+                if result['ok']:
+                    if not result['skipped']:
+                        acs_instrument.count('zips_verified')
+                        acs_instrument.count('bytes_extracted', result['bytes'])
+                    continue
+                acs_instrument.count('zips_failed')
+                logging.warning('%s failed verification (attempt %d): %s', filename, attempt+1, result['error'])
+                if self.fetch is not None and url is not None and attempt < self.retries:
+                    acs_instrument.count('zips_refetched')
+                    try:
+                        os.remove(filename)
+                        self.fetch(url, filename)
+                        self.submit(url, filename, attempt+1)
+                    except Exception as e:
+                        error = '{0} (re-fetch failed: {1}: {2})'.format(result['error'], type(e).__name__, e)
+                        logging.error('%s: %s', filename, error)
+                        self.failed.append((url, filename, error))
+                else:
+                    self.failed.append((url, filename, result['error']))
+        return results
+
+    def close(self):
+        """Wait for everything outstanding, then shut the pool down.
+        Returns the (url, filename, error) of zips given up on."""
+        with acs_instrument.stage('unpack_wait'):
+            self.collect(wait=True)
+        self.pool.shutdown()
+        return self.failed
+
+
+def find_zips(topdir):
+    retval = []
+    for (dirpath, dirnames, filenames) in os.walk(topdir):
+        dirnames.sort()
+        retval += [os.path.join(dirpath, fn) for fn in sorted(filenames) if fn.endswith('.zip')]
+    return retval
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Verify and extract downloaded ACS summary file zips.')
+    parser.add_argument('topdir', help='directory tree of zips, eg acs_sf_downloads/2014')
+    parser.add_argument('-j', dest='processes', type=int, default=None, help='number of processes (default: all cores)')
+    acs_instrument.add_arguments(parser)
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    acs_instrument.start(__file__, args)
+    unpack = UnpackPool(args.processes)
+    zips = find_zips(args.topdir)
+    for zip_filename in zips:
+        unpack.submit(None, zip_filename)
+    failed = unpack.close()
+    for url, filename, error in failed:
+        print('{0}: {1}'.format(filename, error))
+    print('{0} zips checked, {1} failed'.format(len(zips), len(failed)))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
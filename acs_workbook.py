@@ -0,0 +1,146 @@
+# Write colsearch and trend results as Excel workbooks.
+#
+# Copyright 2016 R. A. Reitmeyer
+#
+# The last step of finding data across years is usually a spreadsheet of
+# the columns (or values) by year, as acs_aff_metrics_of_interest.csv
+# was exported from. acs_aff_colsearch.py -x and acs_aff_trend.py -x
+# write one directly:
+#     colsearch: a 'summary' sheet (as -y prints) and a sheet per table,
+#                one row per column name, holding its SHORTCOLNAME in
+#                each year's column
+#     trend:     a sheet per metric, one row per geography (and
+#                estimate/margin), holding its value in each year's column
+# Workbooks are written with openpyxl's write-only mode, which streams
+# each row to disk as it is appended, so memory stays flat however many
+# cells there are. Sheet names are cut to Excel's 31 characters and made
+# unique.
+
+# Requires Python3.
+
+# Copyright R. A. Reitmeyer
+# Released under the GNU Public License, version 2, or later.
+
+import os
+import sys
+import re
+import logging
+
+
+SHEET_TITLE_MAX = 31
+SHEET_TITLE_BAD = re.compile('[\\[\\]:*?/\\\\]')
+YEAR_RE = re.compile('^[0-9]{4}$')
+
+
+def sheet_title(name, used):
+    """An Excel-safe sheet title for name not already in the set used
+    (which it is added to).
+
+    >>> used = set()
+    >>> sheet_title('S0101', used), sheet_title('S0101', used), sheet_title('a/b: [c]', used)
+    ('S0101', 'S0101 (2)', 'a_b_ _c_')
+    >>> len(sheet_title('x'*40, used))
+    31
+    """
+    base = SHEET_TITLE_BAD.sub('_', name).strip("'") or 'sheet'
+    title = base[:SHEET_TITLE_MAX]
+    n = 1
+    while title.lower() in used:
+        n += 1
+        suffix = ' ({0})'.format(n)
+        title = base[:SHEET_TITLE_MAX-len(suffix)] + suffix
+    used.add(title.lower())
+    return title
+
+
+def cell_value(value):
+    """A number where the text is one, so Excel treats it as such; other
+    text (annotations like (X) or *****, and codes with leading zeros
+    like FIPS codes) as is.
+
+    >>> cell_value('1234'), cell_value('0.5'), cell_value('06075'), cell_value('+/-12.5'), cell_value('(X)'), cell_value('')
+    (1234, 0.5, '06075', '+/-12.5', '(X)', None)
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, str):
+        if re.match('^-?0[0-9]', value):
+            return value
+        try:
+            return int(value)
+        except ValueError:
+            pass
+        try:
+            return float(value)
+        except ValueError:
+            return value
+    return value
+
+
+def write_workbook(filename, sheets):
+    """Write a workbook of sheets, each (name, header, rows), the rows
+    dicts keyed by the header (or any iterable of them, consumed as it
+    is written). Returns the sheet titles used."""
+    import openpyxl
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font
+    workbook = openpyxl.Workbook(write_only=True)
+    bold = Font(bold=True)
+    used = set()
+    titles = []
+    for name, header, rows in sheets:
+        worksheet = workbook.create_sheet(sheet_title(name, used))
+        titles.append(worksheet.title)
+        worksheet.freeze_panes = 'A2'
+        header_cells = []
+        for h in header:
+            cell = WriteOnlyCell(worksheet, value=h)
+            cell.font = bold
+            header_cells.append(cell)
+        worksheet.append(header_cells)
+        for row in rows:
+            worksheet.append([cell_value(row.get(h)) for h in header])
+    if not titles:
+        workbook.create_sheet('empty')
+    tmpfile = filename + '.part'
+    workbook.save(tmpfile)
+    os.replace(tmpfile, filename)
+    logging.info('write_workbook %s: %d sheets', filename, len(titles))
+    return titles
+
+
+def colsearch_sheets(cols):
+    """Sheets for pattern_scan results (dicts with at least TABLE,
+    ACS_YEAR, SHORTCOLNAME and LONGCOLNAME_ar): the -y summary, then a
+    sheet per table with a row per LONGCOLNAME_ar and the SHORTCOLNAME
+    it had in each year.
+
+    >>> cols = [{'TABLE': 'S0101', 'ACS_YEAR': y, 'SHORTCOLNAME': s, 'LONGCOLNAME_ar': 'Total; Estimate; Median age'} for y, s in [('2009', 'HC01_EST_VC35'), ('2010', 'HC01_EST_VC37')]]
+    >>> [(name, header, list(rows)) for name, header, rows in colsearch_sheets(cols)][1]
+    ('S0101', ['LONGCOLNAME_ar', '2009', '2010'], [{'LONGCOLNAME_ar': 'Total; Estimate; Median age', '2009': 'HC01_EST_VC35', '2010': 'HC01_EST_VC37'}])
+    """
+    import acs_aff_colsearch  # not at the top: colsearch imports us
+    header, summary = acs_aff_colsearch.summarize_years(cols)
+    yield 'summary', header, summary
+    tables = {}
+    for c in cols:
+        row = tables.setdefault(c['TABLE'], {}).setdefault(c['LONGCOLNAME_ar'], {'LONGCOLNAME_ar': c['LONGCOLNAME_ar']})
+        shortcolnames = row.setdefault(c['ACS_YEAR'], [])
+        if c['SHORTCOLNAME'] not in shortcolnames:
+            shortcolnames.append(c['SHORTCOLNAME'])
+    for table in sorted(tables):
+        rows = tables[table]
+        years = sorted(set(k for row in rows.values() for k in row if k != 'LONGCOLNAME_ar'))
+        yield table, ['LONGCOLNAME_ar'] + years, ({k: (' '.join(v) if k in years else v) for k, v in rows[name].items()} for name in sorted(rows))
+
+
+def trend_sheets(header, rows):
+    """Sheets for acs_aff_trend wide output, one per METRIC, keeping the
+    header's year columns that metric has values for."""
+    key_cols = [h for h in header if not YEAR_RE.match(h) and h != 'METRIC']
+    metrics = {}
+    for row in rows:
+        metrics.setdefault(row['METRIC'], []).append(row)
+    for metric in sorted(metrics):
+        years = [h for h in header if YEAR_RE.match(h) and any(r.get(h, '') != '' for r in metrics[metric])]
+        yield metric, key_cols + years, metrics[metric]
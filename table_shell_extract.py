@@ -1,37 +1,127 @@
 # Copyright 2016 R. A. Reitmeyer
+#
+# Extract the variable hierarchy from ACS table shell workbooks, as
+# downloaded by ACSFetch.crawl_shells into table_shells/<year>/.
+#
+# Each shell has a header row, the table name, the universe
+# (population), then one row per line of the table: table id, line
+# number and a description whose indent level gives its place in the
+# hierarchy. Run as
+#     python3 table_shell_extract.py acs_sf_downloads/table_shells shells.csv
+# to extract every .xlsx and .xls shell in the tree on all cores.
+#
+# Parsed shells are cached per workbook under shell_cache/, keyed by a
+# hash of the workbook's content, so a rerun only parses shells that are
+# new or changed and rebuilds the output from the cached shards. Shards
+# sit under a directory named for a hash of this file's source, so a
+# change to the parsing (or SHARD_HEADER) starts a fresh cache rather
+# than serving shards the old code wrote.
 
 import os
 import sys
 import csv
 import re
+import gzip
+import hashlib
+import logging
+import argparse
+import concurrent.futures
 
+import acs_instrument
 
-import openpyxl 
+import openpyxl
+try:
+    import xlrd  # only needed for legacy .xls shells
+except ImportError:
+    xlrd = None
 
-def extract(writer, infilepath, write_header=True):
-    header = ['year', 'variable.code', 'table.number', 'table.name', 'population', 'desc', 'indent', 'full_desc', 'filepath']
-    if write_header:
-        writer.writerow(header)
-    m = re.search('table_shells/(?P<year>[0-9]{4})/', infilepath)
-    year = m.group('year')
-    workbook = openpyxl.load_workbook(infilepath)
-    worksheet = workbook.active # just one sheet
+
+HEADER = ['year', 'variable.code', 'table.number', 'table.name', 'population', 'desc', 'indent', 'full_desc', 'filepath']
+SHELL_EXTENSIONS = ['.xlsx', '.xls']
+
+# Shards hold only what depends on workbook content; year and filepath
+# come from where the workbook sits, and are filled in when merging.
+SHARD_HEADER = [h for h in HEADER if h not in ['year', 'filepath']]
+CACHE_DIR = 'shell_cache'
+
+
+def read_rows_xlsx(infilepath):
+    """Yield (col A value, col B value, col C value, col C indent) for
+    each row of the active sheet. Uses openpyxl's streaming read-only
+    mode; read-only cells still carry their style, so indents survive.
+    """
+    workbook = openpyxl.load_workbook(infilepath, read_only=True)
+    try:
+        worksheet = workbook.active # just one sheet
+        for row in worksheet.iter_rows(max_col=3):
+            cells = list(row) + [None]*(3-len(row))
+            values = [getattr(c, 'value', None) for c in cells]
+            indent = 0
+            if cells[2] is not None and hasattr(cells[2], 'alignment'):
+                indent = int(cells[2].alignment.indent)
+            yield (values[0], values[1], values[2], indent)
+    finally:
+        workbook.close()
+
+
+def read_rows_xls(infilepath):
+    """Yield (col A value, col B value, col C value, col C indent) for
+    each row of the first sheet of a legacy .xls shell, using xlrd with
+    formatting info for the indents."""
+    if xlrd is None:
+        raise ImportError('xlrd is needed to read .xls table shells: '+infilepath)
+    workbook = xlrd.open_workbook(infilepath, formatting_info=True, on_demand=True)
+    try:
+        worksheet = workbook.sheet_by_index(0)
+        for rownum in range(worksheet.nrows):
+            values = [worksheet.cell_value(rownum, c) if c < worksheet.row_len(rownum) else None for c in range(3)]
+            values = [None if v == '' else v for v in values]
+            indent = 0
+            if worksheet.row_len(rownum) >= 3:
+                xf = workbook.xf_list[worksheet.cell_xf_index(rownum, 2)]
+                indent = xf.alignment.indent_level
+            yield (values[0], values[1], values[2], indent)
+    finally:
+        workbook.release_resources()
+
+
+def read_rows(infilepath):
+    if infilepath.lower().endswith('.xls'):
+        return read_rows_xls(infilepath)
+    return read_rows_xlsx(infilepath)
+
+
+def shell_year(infilepath):
+    """The year of a shell, from its table_shells/<year>/ directory.
+
+    >>> shell_year('acs_sf_downloads/table_shells/2014/B01001.xlsx')
+    '2014'
+    """
+    m = re.search('table_shells[/\\\\](?P<year>[0-9]{4})[/\\\\]', infilepath)
+    return m.group('year')
+
+
+def extract_records(infilepath):
+    """Return the list of variable records (dicts keyed by HEADER) in one
+    table shell."""
+    year = shell_year(infilepath)
     indents_stack = []
     indents_desc = {}
     table_name = ''
     population = ''
-    for rownum, row in enumerate(worksheet.iter_rows()):
+    retval = []
+    for rownum, (value_a, value_b, value_c, indent) in enumerate(read_rows(infilepath)):
         if rownum == 0:
             continue # header
         if rownum == 1:
-            table_name = cell_c.value
+            table_name = value_c
             continue # table name
         if rownum == 2:
-            population = cell_c.value
+            population = value_c
             continue # population
-        assert(len(row) == 3)
-        (cell_a, cell_b, cell_c) = row
-        indent = cell_c.alignment.indent
+        if value_b is None or value_c is None:
+            continue # spacer or footnote row
+        table_id = value_a
 
         # would love to do indents_stack.find(indent) but that's not available.
         # so do it the tedious way.
@@ -42,18 +132,19 @@ def extract(writer, infilepath, write_header=True):
                 break
 
         if idx >= 0:
-            for j in range(idx, len(indents_stack)):
+            for j in indents_stack[idx:]:
                 del indents_desc[j]
             del indents_stack[idx:]
-        assert(indents_stack == [] or indents_stack[-1] < indent)
+        # a shallower indent than anything on the stack closes those levels too
+        while indents_stack and indents_stack[-1] > indent:
+            del indents_desc[indents_stack.pop()]
         indents_stack.append(indent)
-        idx
-        desc = cell_c.value         #.rstrip(': ').lstrip(' ')
+        desc = value_c         #.rstrip(': ').lstrip(' ')
         indents_desc[indent] = desc
         full_desc = '; '.join([indents_desc[i] for i in indents_stack])
-        variable_code = '{table_id}_{line_num:03d}'.format(table_id=table_id, line_num=int(cell_b.value))
-        
-        record = {
+        variable_code = '{table_id}_{line_num:03d}'.format(table_id=table_id, line_num=int(value_b))
+
+        retval.append({
             'year': year,
             'variable.code': variable_code,
             'table.number': table_id,
@@ -63,7 +154,158 @@ def extract(writer, infilepath, write_header=True):
             'indent': indent,
             'full_desc': full_desc,
             'filepath': infilepath,
-            }
-        writer.writerow([record[k] for k in header])
+            })
+    return retval
+
+
+def extract(writer, infilepath, write_header=True):
+    if write_header:
+        writer.writerow(HEADER)
+    for record in extract_records(infilepath):
+        writer.writerow([record[k] for k in HEADER])
+
+
+def find_shells(shells_dir):
+    """All the table shell workbooks under shells_dir, in sorted order."""
+    retval = []
+    for (dirpath, dirnames, filenames) in os.walk(shells_dir):
+        dirnames.sort()
+        for fn in sorted(filenames):
+            if os.path.splitext(fn)[1].lower() in SHELL_EXTENSIONS and not fn.startswith('~$'):
+                retval.append(os.path.join(dirpath, fn))
+    return retval
+
+
+def content_hash(path):
+    """Hex SHA-256 of a file's content."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1024*1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+_PARSER_VERSION = None
+
+
+def parser_version():
+    """Short hash of this module's source, naming the shard cache
+    generation."""
+    global _PARSER_VERSION
+    if _PARSER_VERSION is None:
+        _PARSER_VERSION = content_hash(os.path.abspath(__file__))[:16]
+    return _PARSER_VERSION
+
+
+def shard_path(cache_dir, digest):
+    return os.path.join(cache_dir, parser_version(), digest[:2], digest+'.csv.gz')
+
+
+def write_shard(path, records):
+    """Write records to a gzipped CSV shard, atomically."""
+    os.makedirs(os.path.dirname(path), mode=0o755, exist_ok=True)
+    tmpfile = path+'.part.{0}'.format(os.getpid())
+    with gzip.open(tmpfile, 'wt', encoding='utf-8', newline='') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(SHARD_HEADER)
+        for record in records:
+            writer.writerow([record[k] for k in SHARD_HEADER])
+    os.replace(tmpfile, path)
+
+
+def read_shard(path):
+    """Yield the SHARD_HEADER rows of a shard, as lists."""
+    with gzip.open(path, 'rt', encoding='utf-8', newline='') as fp:
+        reader = csv.reader(fp)
+        next(reader)
+        for row in reader:
+            yield row
+
+
+def _extract_one(job):
+    """Pool worker: parse one shell and, if a shard path is given, cache
+    the result there. Returns (records, error message or None), so one
+    bad workbook doesn't sink the whole batch."""
+    infilepath, shard = job
+    try:
+        records = extract_records(infilepath)
+        if shard is not None:
+            write_shard(shard, records)
+            return ([], None)
+        return (records, None)
+    except Exception as e:
+        return ([], '{0}: {1}'.format(type(e).__name__, e))
+
+
+def extract_all(shells_dir, output_filename, processes=None, cache_dir=CACHE_DIR):
+    """Extract every shell under shells_dir and write the merged records,
+    in file order, to output_filename. Shells without a cached shard in
+    cache_dir are parsed on a process pool and cached; the output is then
+    built by concatenating shards. With cache_dir=None every shell is
+    parsed and nothing is cached. Returns a dict of failed file paths to
+    error messages."""
+    with acs_instrument.stage('find_shells'):
+        paths = find_shells(shells_dir)
+    acs_instrument.count('shells', len(paths))
+    acs_instrument.count('bytes', sum(os.path.getsize(path) for path in paths))
+    failures = {}
+    shards = {}
+    if cache_dir is not None:
+        with acs_instrument.stage('hash'):
+            shards = {path: shard_path(cache_dir, content_hash(path)) for path in paths}
+    jobs = [(path, shards.get(path)) for path in paths if path not in shards or not os.path.exists(shards[path])]
+    logging.info('extract_all: %d shells, %d to parse', len(paths), len(jobs))
+    records_by_path = {}
+    acs_instrument.count('shells_parsed', len(jobs))
+    if len(jobs) > 0:
+        with acs_instrument.stage('parse'), concurrent.futures.ProcessPoolExecutor(processes) as pool:
+            for (path, shard), (records, error) in zip(jobs, pool.map(_extract_one, jobs, chunksize=16)):
+                if error is not None:
+                    logging.warning('table shell %s failed: %s', path, error)
+                    failures[path] = error
+                records_by_path[path] = records
+    rows = 0
+    with acs_instrument.stage('merge'), open(output_filename, 'w', encoding='utf-8', newline='') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(HEADER)
+        for path in paths:
+            if path in failures:
+                continue
+            if path in shards:
+                year = shell_year(path)
+                for row in read_shard(shards[path]):
+                    record = dict(zip(SHARD_HEADER, row), year=year, filepath=path)
+                    writer.writerow([record[k] for k in HEADER])
+                    rows += 1
+            else:
+                for record in records_by_path[path]:
+                    writer.writerow([record[k] for k in HEADER])
+                    rows += 1
+    acs_instrument.count('rows', rows)
+    acs_instrument.count('failures', len(failures))
+    logging.info('extract_all: %d shells, %d failed', len(paths), len(failures))
+    return failures
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Extract variables from ACS table shells.')
+    parser.add_argument('shells_dir', help='table_shells directory from ACSFetch.crawl_shells')
+    parser.add_argument('output', help='output CSV file')
+    parser.add_argument('-j', dest='processes', type=int, default=None, help='number of processes (default: all cores)')
+    parser.add_argument('-c', dest='cache_dir', default=CACHE_DIR, help='directory for cached parsed shells')
+    parser.add_argument('--no-cache', dest='cache_dir', action='store_const', const=None, help='parse every shell and cache nothing')
+    acs_instrument.add_arguments(parser)
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    acs_instrument.setup_logging(__file__)
+    acs_instrument.start(__file__, args)
+    failures = extract_all(args.shells_dir, args.output, args.processes, args.cache_dir)
+    for path in sorted(failures):
+        print(path+': '+failures[path], file=sys.stderr)
 
 
+if __name__ == '__main__':
+    main()